@@ -0,0 +1,80 @@
+# Micro-benchmark for normalize_repo_url, the pure CPU part of sanitize_repo_url
+# Checks every repo_url in the corpus normalizes to the expected output, then measures throughput on one core
+#
+# Usage:
+# python3 benchmark.py [iterations] [corpus_path]
+
+from discordbot             import normalize_repo_url
+import sys
+import time
+
+
+# Read the corpus of real world messy repo_urls, and the normalized repo_url we expect for each
+def load_corpus(corpus_path):
+    corpus = []
+
+    with open(corpus_path, encoding="utf-8") as corpus_file:
+        for line in corpus_file:
+            line = line.rstrip("\n")
+
+            # Skip comments and blank lines
+            if not line or line.startswith("#"):
+                continue
+
+            repo_url, expected_repo_url = line.split("\t")
+            corpus.append((repo_url, expected_repo_url))
+
+    return corpus
+
+
+# Make sure the optimizations didn't change the output
+def check_corpus(corpus):
+    failures = 0
+
+    for repo_url, expected_repo_url in corpus:
+        normalized_repo_url, _ = normalize_repo_url(repo_url)
+
+        if str(normalized_repo_url) != expected_repo_url:
+            failures += 1
+            print(
+                "MISMATCH: " + repr(repo_url)
+                + "\n expected: " + expected_repo_url
+                + "\n got:      " + str(normalized_repo_url)
+            )
+
+    return failures
+
+
+def run_benchmark(corpus, iterations):
+    repo_urls = [repo_url for repo_url, _ in corpus]
+
+    start = time.perf_counter()
+    for _ in range(iterations):
+        for repo_url in repo_urls:
+            normalize_repo_url(repo_url)
+    elapsed = time.perf_counter() - start
+
+    return len(repo_urls) * iterations, elapsed
+
+
+def main():
+    iterations  = int(sys.argv[1]) if len(sys.argv) > 1 else 2000
+    corpus_path = sys.argv[2] if len(sys.argv) > 2 else "benchmark_repo_urls.tsv"
+
+    corpus = load_corpus(corpus_path)
+
+    failures = check_corpus(corpus)
+    if failures:
+        print(f"{failures} of {len(corpus)} repo_urls didn't normalize as expected")
+        sys.exit(1)
+
+    normalized_count, elapsed = run_benchmark(corpus, iterations)
+    print(
+        f"normalize_repo_url: {normalized_count} repo_urls in {elapsed:.3f} s, "
+        f"{normalized_count / elapsed:,.0f} repo_urls/s, "
+        f"{elapsed / normalized_count * 1e6:.2f} µs/repo_url"
+    )
+
+
+if __name__ == "__main__":
+    main()
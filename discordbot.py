@@ -1,24 +1,14 @@
-# TODO: If repo does exist on the code host, check if it exists on the Sourcegraph instance, or if there's a GraphQL query to add it to the code host config on Sourcegraph
-# TODO: Find a GraphQL query that can check Sourcegraph for configured repo path patterns / code host names, so repo embeddings can be requested for newly added code hosts without having to update this list code_hostnames_on_dotcom
+# TODO: If the repo isn't on the Sourcegraph instance yet, find a GraphQL query to add it to the code host config on Sourcegraph
 # TODO: Add server URL validation to get_sourcegraph_server_addresses
 # TODO: If the SG_SERVER is invalid, don't send the GraphQL request
-# TODO: Improve error handling for GraphQL timeouts, provide the user with feedback
 # TODO: Sanitize file path, so if a user submits https://github.com/marcleblanc2/cody-embeddings-discord-bot/blob/main/discordbot.py, we can find what repo it's in
-# TODO: Find URL syntax for git.eclipse.org and git.savannah.gnu.org, how to parse them to extract the repo path, and match it to the path on Sourcegraph
 
 # TODO: Change default log level to WARNING after this has been running in prod for a while to reduce log spam
 
-# TODO: GraphQL query for embeddingExists every 1 minute to check if the embeddings job completed
-# TODO: Check the completed embeddings job for errors
-# TODO: Then tag the user in the thread when their embedding is ready
+# EmbeddingCompletionPoller checks embeddingExists / repoEmbeddingJobs in the background, and tags the user in their thread when the job completes or fails
 # Interaction tokens are valid for 15 minutes, meaning you can respond to an interaction within that amount of time.
 # https://discord.com/developers/docs/interactions/receiving-and-responding#followup-messages
 
-# TODO: Build a button the user can press to retry if there's an error
-# https://discord.com/developers/docs/interactions/message-components
-
-# TODO: Sort out where the asyncio timeout exception needs to go
-
 # Docs:
 # Are we actually using the pycord interface?
 # We have Cody embeddings for it
@@ -28,23 +18,110 @@
 # https://discordpy.readthedocs.io/en/latest/interactions/api.html
 
 from aiohttp                import web
+from bisect                 import bisect_left
 from config                 import SG_TOKEN, DISCORD_TOKEN
-from discord.ext.commands   import Bot
-from urllib.parse           import urlparse     # https://docs.python.org/3/library/urllib.parse.html
+from discord.ext.commands   import AutoShardedBot, Bot
+from collections            import OrderedDict, deque
+from concurrent.futures     import ThreadPoolExecutor
+from contextlib             import asynccontextmanager
+from datetime               import timezone
+from email.utils            import parsedate_to_datetime
+from types                  import MappingProxyType
+from urllib.parse           import quote, urlsplit  # https://docs.python.org/3/library/urllib.parse.html
+import aiohttp
 import asyncio
+import contextvars
 import discord
 import json
 import logging
+import logging.handlers
+import math
 import os
+import queue
+import random
 import re                   as regex
-import requests
+import signal
+import socket
+import sqlite3
 import string
 import sys
+import time
+import uuid
 import validators                               # https://validators.readthedocs.io/en/latest/#
 
 
+# Logging settings
+# "json" for one JSON object per line, for the log aggregator, or "text" for reading locally
+LOG_FORMAT                          = os.environ.get("LOG_FORMAT", "json")
+# Log at most one healthcheck per interval, in seconds, with a count of the ones skipped
+HEALTHCHECK_LOG_INTERVAL_SECONDS    = float(os.environ.get("HEALTHCHECK_LOG_INTERVAL_SECONDS", "60"))
+
+# The Discord interaction and user each log record is for, set at the start of each command
+# Tasks started by a command inherit them, so background work logs which command it's for
+log_request_id  = contextvars.ContextVar("log_request_id", default=None)
+log_user_id     = contextvars.ContextVar("log_user_id", default=None)
+
+# Writes the queued log records on a background thread, created by configure_logging()
+log_queue_listener = None
+
+
+# Copy the current command's ids onto each log record, on the thread that logged it, as the context doesn't follow the record to the writer thread
+class LogContextFilter(logging.Filter):
+
+    def filter(self, record):
+        record.request_id   = log_request_id.get()
+        record.user_id      = log_user_id.get()
+        return True
+
+
+# Hands log records to the writer thread, without formatting them on the event loop
+# The stdlib QueueHandler formats the whole record before queuing it, this only resolves the message's args,
+# so later changes to the args don't change the log, and leaves the timestamp, traceback, and JSON to the writer thread
+class BackgroundQueueHandler(logging.handlers.QueueHandler):
+
+    def prepare(self, record):
+        record.msg  = record.getMessage()
+        record.args = None
+        return record
+
+
+# Format each log record as one line of JSON, with the command's ids when there are any
+class JsonLogFormatter(logging.Formatter):
+
+    def format(self, record):
+        log_entry = {
+            "time":     self.formatTime(record, "%Y-%m-%dT%H:%M:%S") + f".{int(record.msecs):03d}",
+            "level":    record.levelname,
+            "logger":   record.name,
+            "message":  record.getMessage(),
+        }
+
+        request_id = getattr(record, "request_id", None)
+        if request_id is not None:
+            log_entry["request_id"] = str(request_id)
+
+        user_id = getattr(record, "user_id", None)
+        if user_id is not None:
+            log_entry["user_id"] = str(user_id)
+
+        if record.exc_info:
+            log_entry["exception"] = self.formatException(record.exc_info)
+        if record.stack_info:
+            log_entry["stack"] = self.formatStack(record.stack_info)
+
+        return json.dumps(log_entry, ensure_ascii=False, default=str)
+
+
 # Configure logging
+# Loggers put records on a queue, and one background thread formats and writes them,
+# so a slow stdout or disk never blocks the event loop
 def configure_logging():
+    global log_queue_listener
+
+    # Only configure once, like logging.basicConfig
+    if log_queue_listener is not None:
+        return
+
     # Get the log level if it's defined in the env vars
     if "LOGLEVEL" in os.environ:
         log_level = os.environ.get("LOGLEVEL")
@@ -71,476 +148,4426 @@ def configure_logging():
 
         logging_handlers = [
             logging.StreamHandler(sys.stdout),
-            logging.FileHandler("discordbot.log"),
+            logging.FileHandler("discordbot.log", encoding="utf-8"),
         ]
 
-    logging.basicConfig(
-        datefmt="%Y-%m-%d %H:%M:%S",
-        encoding="utf-8",
-        format="%(asctime)s: %(levelname)s: %(message)s",
-        handlers=logging_handlers,
-        level=log_level,
+    if LOG_FORMAT == "json":
+        formatter = JsonLogFormatter()
+    else:
+        formatter = logging.Formatter(
+            fmt="%(asctime)s: %(levelname)s: %(message)s",
+            datefmt="%Y-%m-%d %H:%M:%S",
+        )
+
+    for handler in logging_handlers:
+        handler.setFormatter(formatter)
+
+    log_queue = queue.SimpleQueue()
+    queue_handler = BackgroundQueueHandler(log_queue)
+    queue_handler.addFilter(LogContextFilter())
+
+    root_logger = logging.getLogger()
+    root_logger.handlers = [queue_handler]
+    root_logger.setLevel(log_level)
+
+    log_queue_listener = logging.handlers.QueueListener(log_queue, *logging_handlers, respect_handler_level=True)
+    log_queue_listener.start()
+
+
+# Write any queued log records, and stop the writer thread, on shutdown
+# Anything logged after this is written directly, rather than queued for a writer that's gone
+def stop_logging():
+    global log_queue_listener
+
+    if log_queue_listener is not None:
+        log_queue_listener.stop()
+        logging.getLogger().handlers = list(log_queue_listener.handlers)
+        log_queue_listener = None
+
+
+# Lets through at most one log per interval, for events that happen too often to log every time
+class LogRateLimiter:
+
+    def __init__(self, interval_seconds):
+        self.interval_seconds   = interval_seconds
+        self.next_log_at        = 0.0
+        self.suppressed         = 0
+
+    # Returns whether to log now, and how many logs were skipped since the last one
+    def allow(self):
+        now = time.monotonic()
+        if now < self.next_log_at:
+            self.suppressed += 1
+            return False, 0
+
+        suppressed = self.suppressed
+        self.suppressed = 0
+        self.next_log_at = now + self.interval_seconds
+        return True, suppressed
+
+
+# Shared, pooled HTTP client settings
+# Connect and read timeouts, in seconds, so a slow code host or Sourcegraph instance can't hold a command open forever
+HTTP_CONNECT_TIMEOUT            = float(os.environ.get("HTTP_CONNECT_TIMEOUT", "5"))
+HTTP_READ_TIMEOUT               = float(os.environ.get("HTTP_READ_TIMEOUT", "30"))
+# Caps on concurrent connections, in total and per host
+HTTP_MAX_CONNECTIONS            = int(os.environ.get("HTTP_MAX_CONNECTIONS", "100"))
+HTTP_MAX_CONNECTIONS_PER_HOST   = int(os.environ.get("HTTP_MAX_CONNECTIONS_PER_HOST", "20"))
+# How long to keep idle connections open for reuse
+HTTP_KEEPALIVE_TIMEOUT          = float(os.environ.get("HTTP_KEEPALIVE_TIMEOUT", "60"))
+
+# One long-lived HTTP client for the whole process, shared by the code host probes and the GraphQL requests
+# Created at startup by create_http_session(), because aiohttp sessions need to be created on the running event loop
+http_session = None
+
+
+# Create the shared HTTP client
+async def create_http_session():
+    global http_session
+
+    if http_session is not None and not http_session.closed:
+        return http_session
+
+    # The connector holds the connection pool, and keeps connections alive per host between commands
+    connector = aiohttp.TCPConnector(
+        limit=HTTP_MAX_CONNECTIONS,
+        limit_per_host=HTTP_MAX_CONNECTIONS_PER_HOST,
+        keepalive_timeout=HTTP_KEEPALIVE_TIMEOUT,
+        ttl_dns_cache=300,
     )
 
+    # No total timeout, so large responses aren't cut off, but bound the connect and each socket read
+    timeout = aiohttp.ClientTimeout(
+        total=None,
+        connect=HTTP_CONNECT_TIMEOUT,
+        sock_read=HTTP_READ_TIMEOUT,
+    )
 
-# All of the repo_url sanitization and validation code should happen in one function
-# The order of these operations is significant
-# This needs to happen on the client side, because the GraphQL API rejects invalid repo_urls instead of sanitizing them
-async def sanitize_repo_url(repo_url):
-    # Keep a copy of the repo_url the user gave us
-    initial_repo_url = repo_url
+    http_session = aiohttp.ClientSession(
+        connector=connector,
+        timeout=timeout,
+        raise_for_status=False,
+    )
+    logging.info("Created shared HTTP client session")
 
-    # Log it
-    logging.info("initial_repo_url: " + initial_repo_url)
+    return http_session
 
-    input_validation_messages_to_user = []
-    url_scheme = "https://"
 
-    try:
-        # Format required by embeddings scheduler
-        # github.com/org/repo
-
-        # Users have tried providing repo_urls like
-        # https://github.com/org/repo
-        # https://www.github.com/org/repo
-        # www.github.com/org/repo
-        # www.github.com/org/repo.git
-        # www.github.com/org/repo.git@ref
-        # https://www.github.com/org/repo.git@ref
-
-        # Remove any garbage / disallowed characters that break urlparse
-        # The list of valid characters a url
-        # string.ascii_letters = abcdefghijklmnopqrstuvwxyzABCDEFGHIJKLMNOPQRSTUVWXYZ, so this can be done before lowercasing
-        # string.digits = 0123456789
-        allowed_chars = set(string.ascii_letters + string.digits + ":/@-_.;?=&+#")
-        # This finds any characters in repo_url that are not allowed
-        disallowed_chars = set(repo_url) - allowed_chars
-
-        # If disallowed characters were found, remove them
-        removed_chars_string = ""
-        for disallowed_char in disallowed_chars:
-            removed_chars_string += disallowed_char
-            repo_url = repo_url.replace(disallowed_char, "")
-
-        # If disallowed characters were found, report them to the user
-        if len(removed_chars_string) > 0:
-            input_validation_messages_to_user.append(
-                "Removed invalid characters: "
-                + removed_chars_string
-            )
+# Close the shared HTTP client, and its pooled connections, on shutdown
+async def close_http_session():
+    global http_session
 
-        # Convert to lowercase
-        # Don't need to warn the user about case
-        repo_url = repo_url.lower()
-        logging.info("repo_url after converting to lowercase: " + repo_url)
+    if http_session is not None and not http_session.closed:
+        await http_session.close()
+        logging.info("Closed shared HTTP client session")
 
-        # Only need to use urlparse to get hostname and path
-        # urlparse doesn't work if the url doesn't start with a scheme://
-        # So we have to normalize that first
-        # Strip anything that looks like a schema
-        repo_url = regex.sub(r"^.*://", "", repo_url)
+    http_session = None
 
-        # Run it through urlparse, and extract the hostname and path, the only two components we need
-        try:
 
-            parsed_repo_url_namedtuple  = urlparse(url_scheme + repo_url)
-            parsed_hostname             = str(parsed_repo_url_namedtuple.hostname)
-            parsed_path                 = str(parsed_repo_url_namedtuple.path)
+# Prometheus metrics
+# Served in the Prometheus text format on /metrics, from the same web.Application as /healthcheck
+# Cheap enough to leave on in production: everything runs on the event loop thread, so no locks are needed,
+# and recording a sample is just a few integer / float additions, all the text formatting happens when /metrics is scraped
 
-        except Exception as exception:
-            error_string = "urlparse failed."
-            exception.add_note(error_string)
-            raise
+# Every metric registers itself here, in the order they're rendered
+metrics_registry = []
 
-        # Log the parsed hostname and path
-        logging.info("parsed_hostname: " + parsed_hostname)
-        logging.info("parsed_path:     " + parsed_path)
 
-        # Check if the hostname is valid
-        is_hostname_valid = validators.domain(parsed_hostname)
-        if is_hostname_valid:
-            logging.info("parsed_hostname is valid")
+class Counter:
 
-        else:
-            error_string = "Unsupported hostname provided: " + str(is_hostname_valid)
-            logging.error(error_string)
-            input_validation_messages_to_user.append(error_string)
-            return None, input_validation_messages_to_user
+    def __init__(self, name, description, label_name=None, function=None):
+        self.name           = name
+        self.description    = description
+        self.label_name     = label_name
+        # label value: count, or None: count if the counter has no label
+        self.values         = {}
+        # Optional function to read an unlabeled count when scraped, for counts something else already keeps, ie. TTLCache.hits
+        self.function       = function
+        metrics_registry.append(self)
 
-        # Clean up any extra junk that may be left in the host name
-        hostname_substrings_to_remove = [
-            "www.",
-        ]
+    def inc(self, label_value=None, amount=1):
+        self.values[label_value] = self.values.get(label_value, 0) + amount
 
-        # Loop through hostname_substrings_to_remove, warn the user, and remove them
-        for sub_string in hostname_substrings_to_remove:
-            if sub_string in parsed_hostname:
-                input_validation_messages_to_user.append("Removed: " + sub_string)
-                parsed_hostname = parsed_hostname.replace(sub_string, "")
-        # We don't need to accept all valid hostnames, only hostnames that match our code host config repo patterns on dotcom
-        code_hostnames_on_dotcom = [
-            "git.eclipse.org",
-            "git.savannah.gnu.org",
-            "github.com", # Tested
-            "gitlab.com", # Tested
+    def render(self):
+        lines = [
+            f"# HELP {self.name} {self.description}",
+            f"# TYPE {self.name} counter",
         ]
+        if self.function is not None:
+            lines.append(f"{self.name} {self.function()}")
+            return lines
+        if not self.values and self.label_name is None:
+            lines.append(f"{self.name} 0")
+        for label_value, value in self.values.items():
+            if label_value is None:
+                lines.append(f"{self.name} {value}")
+            else:
+                lines.append(f'{self.name}{{{self.label_name}="{label_value}"}} {value}')
+        return lines
 
-        if parsed_hostname not in code_hostnames_on_dotcom:
-            error_string = (
-                "Code host not configured on Sourcegraph instance: "
-                + parsed_hostname
-            )
-            logging.error(error_string)
-            input_validation_messages_to_user.append(error_string)
-            return None, input_validation_messages_to_user
 
-        # Remove file path in repo if present
-        regex_filter_for_file_path = r"(/-/.*|/blob/.*)$"
-        file_path_matches = regex.findall(
-            regex_filter_for_file_path,
-            parsed_path,
-        )
-        logging.info(file_path_matches)
-        for file_path_match in file_path_matches:
-            input_validation_messages_to_user.append(
-                "Removed file path: "
-                + file_path_match
-            )
-            parsed_path = parsed_path.replace(file_path_match, "")
-
-        # Remove @[ref] if present
-        # Branch name, tag name, or commit hash
-        # At this time point in the script, the only @ should be in the path, not the hostname
-        # At this time, it appears that the embeddings job web UI https://sourcegraph.com/site-admin/embeddings doesn't support @refs, only default branch at head
-        # This may change in the future, and would need to be removed then
-        regex_filter_for_git_refs = r"@[\w\d\./_-]*$"
-        git_ref_matches = regex.findall(regex_filter_for_git_refs, parsed_path)
-        for git_ref_match in git_ref_matches:
-            input_validation_messages_to_user.append(
-                "Removed rev: "
-                + git_ref_match
-                + ", only the HEAD revision of the default branch is supported for embeddings at this time."
-            )
-            parsed_path = parsed_path.replace(git_ref_match, "")
+class Gauge:
 
-        # Remove file type extension if present
-        regex_filter_for_file_extension = r"\.\w*$"
-        file_extension_matches = regex.findall(
-            regex_filter_for_file_extension,
-            parsed_path,
-        )
-        for file_extension_match in file_extension_matches:
-            if file_extension_match != ".git":
-                input_validation_messages_to_user.append(
-                    "Removed file type extension: "
-                    + file_extension_match
-                )
-            parsed_path = parsed_path.replace(file_extension_match, "")
-        # TODO: Validate the repo path is a valid org/repo?
+    def __init__(self, name, description, function=None, label_name=None):
+        self.name           = name
+        self.description    = description
+        self.label_name     = label_name
+        self.value          = 0
+        # Optional function to read the value when scraped, instead of keeping it up to date
+        # With a label_name, it returns {label value: value}, ie. one value per command lane
+        self.function       = function
+        metrics_registry.append(self)
 
-        # Set the repo_url to only the hostname and path, to clean out a bunch of possible junk
-        repo_url = parsed_hostname + parsed_path
+    def inc(self, amount=1):
+        self.value += amount
 
-        # Check if the URL is valid and publicly accessible
-        is_url_valid_and_public = validators.url(url_scheme + repo_url, public=True)
-        if is_url_valid_and_public:
-            logging.info("URL is valid and public")
+    def dec(self, amount=1):
+        self.value -= amount
 
-        else:
-            error_string = "URL is not valid or public: " + str(is_url_valid_and_public)
-            logging.error(error_string)
-            input_validation_messages_to_user.append(error_string)
-            return None, input_validation_messages_to_user
+    def set(self, value):
+        self.value = value
 
-        # Verify the repo exists, and is public
-        # Only on valid public code hosts, to avoid users using this guess and check for hostname resolution on our internal network
-        # This security check was completed earlier with "if parsed_hostname not in code_hostnames_on_dotcom:"
-        # Try a get request for this repo_url
-        try:
-            response = requests.get(url_scheme + repo_url)
-        except Exception as get_request_exception:
-            # We tried to get the repo from the matching code host, but that didn't go as expected
-            logging.exception(get_request_exception)
-
-        # Need to put more thought into what error states we could be in, and how we need to handle them
-        if response.status_code == 200:
-            message_to_user = "Repo exists: " + url_scheme + repo_url
-            logging.debug(message_to_user)
-        else:
-            message_to_user = "Could not validate if repo exists: " + url_scheme + repo_url
-            logging.error(message_to_user)
-            input_validation_messages_to_user.append(message_to_user)
+    def render(self):
+        lines = [
+            f"# HELP {self.name} {self.description}",
+            f"# TYPE {self.name} gauge",
+        ]
+        if self.label_name is not None:
+            for label_value, value in self.function().items():
+                lines.append(f'{self.name}{{{self.label_name}="{label_value}"}} {value}')
+            return lines
+        value = self.function() if self.function is not None else self.value
+        lines.append(f"{self.name} {value}")
+        return lines
 
-        # TODO: If repo does exist, check if it's on Sourcegraph.com, or if there's a way to add it to the code host config too
 
-    except Exception as exception:
-        error_string = (
-            "Failed to sanitize repo_url."
-            + "\n Started with: " + initial_repo_url
-            + "\n Ended with: " + repo_url
-            + "\n Exception: " + exception
-        )
-        input_validation_messages_to_user.append(error_string)
-        exception.add_note(error_string)
-        raise
+# Latency buckets, in seconds
+LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30)
 
-    return repo_url, input_validation_messages_to_user
 
+# Observations for one set of label values of a Histogram
+class HistogramSeries:
 
-# Determine Sourcegraph server URL, dotcom by default
-async def get_sourcegraph_server_addresses():
-    # Start with a default of dotcom
-    sg_server = "sourcegraph.com"
+    def __init__(self, bucket_count):
+        # One count per bucket, plus one for +Inf, kept non-cumulative so observe() only touches one of them
+        self.counts         = [0] * (bucket_count + 1)
+        self.sum            = 0.0
+        self.count          = 0
 
-    # If this service was started with the SG_SERVER environment variable, then use it
-    if "SG_SERVER" in os.environ:
-        sg_server = os.environ.get("SG_SERVER")
 
-    # If it's provided with http, replace it with https://
-    if "http://" in sg_server:
-        sg_server.replace("http://", "https://")
+class Histogram:
 
-    # If it doesn't have https, prepend it
-    if "https://" not in sg_server:
-        sg_server = "".join(["https://", sg_server])
+    def __init__(self, name, description, buckets=LATENCY_BUCKETS, label_name=None, label_values=()):
+        self.name           = name
+        self.description    = description
+        self.buckets        = tuple(buckets)
+        self.label_name     = label_name
+        # label value: HistogramSeries, or None: the series if the histogram has no label
+        # Series for label_values are there from the start, so they're exported before anything is observed
+        self.series         = {}
+        for label_value in (label_values if label_name is not None else (None,)):
+            self.series[label_value] = HistogramSeries(len(self.buckets))
+        metrics_registry.append(self)
 
-    # If it has .api/graphql, remove it
-    if ".api/graphql" in sg_server:
-        sg_server.replace(".api/graphql", "")
+    def observe(self, value, label_value=None):
+        series = self.series.get(label_value)
+        if series is None:
+            series = self.series[label_value] = HistogramSeries(len(self.buckets))
+        series.counts[bisect_left(self.buckets, value)] += 1
+        series.sum += value
+        series.count += 1
 
-    # If it ends with a trailing slash or two, remove it
-    sg_server = sg_server.rstrip("/")
+    def render(self):
+        lines = [
+            f"# HELP {self.name} {self.description}",
+            f"# TYPE {self.name} histogram",
+        ]
+        for label_value, series in self.series.items():
+            label = "" if label_value is None else f'{self.label_name}="{label_value}"'
+            bucket_label = label + "," if label else ""
+            series_labels = f"{{{label}}}" if label else ""
 
-    # Append the /.api/graphql endpoint to the sg_server, to get the sg_server_api
-    sg_server_api = "".join([sg_server, "/.api/graphql"])
+            cumulative_count = 0
+            for bucket, bucket_count in zip(self.buckets, series.counts):
+                cumulative_count += bucket_count
+                lines.append(f'{self.name}_bucket{{{bucket_label}le="{bucket}"}} {cumulative_count}')
+            lines.append(f'{self.name}_bucket{{{bucket_label}le="+Inf"}} {series.count}')
+            lines.append(f"{self.name}_sum{series_labels} {series.sum}")
+            lines.append(f"{self.name}_count{series_labels} {series.count}")
+        return lines
 
-    # Return both values
-    return sg_server, sg_server_api
 
+def render_metrics():
+    lines = []
+    for metric in metrics_registry:
+        lines.extend(metric.render())
+    return "\n".join(lines) + "\n"
 
-# Send the GraphQL API mutation to the Sourcegraph instance
-async def send_graphql_request(sanitized_repo_url, sg_server_api):
-    graphql_response_message = ""
-    success = False
 
-    queryBody = f"""
-        mutation {{
-            scheduleRepositoriesForEmbedding(
-                repoNames: [
-            "{sanitized_repo_url}"
-                ]
-            ) {{
-                alwaysNil
-            }}
-        }}
-    """
+sanitize_repo_url_seconds   = Histogram("discordbot_sanitize_repo_url_seconds", "Time to sanitize a repo_url, including the code host probe")
+code_host_probe_seconds     = Histogram("discordbot_code_host_probe_seconds", "Time to probe the code host for a repo, when not cached")
+graphql_request_seconds     = Histogram("discordbot_graphql_request_seconds", "Time to send a scheduleRepositoriesForEmbedding mutation")
+discord_api_call_seconds    = Histogram("discordbot_discord_api_call_seconds", "Time for each Discord API call made by the embedding command")
+validation_failures         = Counter("discordbot_validation_failures_total", "repo_urls rejected by sanitize_repo_url, by reason", "reason")
+graphql_errors              = Counter("discordbot_graphql_errors_total", "Failed GraphQL requests, by type", "type")
+graphql_retries             = Counter("discordbot_graphql_retries_total", "GraphQL request attempts retried, by reason", "reason")
+embedding_requests_total    = Counter("discordbot_embedding_requests_total", "embedding commands received")
+embedding_requests_in_flight = Gauge("discordbot_embedding_requests_in_flight", "embedding commands currently being processed")
+event_loop_lag_seconds      = Gauge("discordbot_event_loop_lag_seconds", "How late the event loop woke up from its last lag measurement sleep")
 
-    # Try / except block for GraphQL mutation
+
+# How often, in seconds, to measure event loop lag
+EVENT_LOOP_LAG_INTERVAL_SECONDS = float(os.environ.get("EVENT_LOOP_LAG_INTERVAL_SECONDS", "0.5"))
+
+
+# Measure how late the event loop wakes up from a short sleep, which is how long something blocked it
+async def measure_event_loop_lag():
+    loop = asyncio.get_running_loop()
+    while True:
+        start = loop.time()
+        await asyncio.sleep(EVENT_LOOP_LAG_INTERVAL_SECONDS)
+        event_loop_lag_seconds.set(max(0.0, loop.time() - start - EVENT_LOOP_LAG_INTERVAL_SECONDS))
+
+
+# Time a Discord API call, ie. await discord_api_call(thread.send(...))
+async def discord_api_call(coroutine):
+    start = time.perf_counter()
     try:
-        # Post the query to the API endpoint
-        response = requests.post(
-            url=sg_server_api,
-            json={"query": queryBody},
-            headers={"Authorization": f"token {SG_TOKEN}"},
-        )
+        return await coroutine
+    finally:
+        discord_api_call_seconds.observe(time.perf_counter() - start)
 
-    except asyncio.TimeoutError as exception:
-        logging.exception(f"GraphQL query timed out: {exception}")
-        graphql_response_message = "⚠️ Timed out submitting embeddings job to the Sourcegraph server, please try again!"
-        success = False
 
-    except Exception as exception:
-        logging.exception(f"GraphQL query failed: {exception} {response}")
-        success = False
+# Bounded, in-process cache with a time to live per entry, and least recently used eviction
+# Positive and negative results can have different TTLs, so a repo that was just created doesn't stay "not found" for long
+class TTLCache:
 
-    if response.status_code == 200:
-        logging.debug(
-            "GraphQL query connection succeeded: "
-            + str(response.status_code)
-            + response.text
-        )
-        success = True
-        response_json = json.loads(response.text)
+    def __init__(self, max_size, positive_ttl_seconds, negative_ttl_seconds):
+        self.max_size               = max(1, max_size)
+        self.positive_ttl_seconds   = positive_ttl_seconds
+        self.negative_ttl_seconds   = negative_ttl_seconds
+        # key: (expires_at, value), ordered from least to most recently used
+        self.entries                = OrderedDict()
+        self.hits                   = 0
+        self.misses                 = 0
+        self.evictions              = 0
 
-        if response_json.get("errors"):
-            logging.error(f"GraphQL query returned errors: {response.text}")
-            success = False
-            errors = response_json.get("errors")
-            graphql_response_message = errors
+    # Returns (found, value)
+    def get(self, key):
+        entry = self.entries.get(key)
 
-            if "repo not found" in response.text:
-                # There should only be one message, but GraphQL returns it in an array
-                messages = []
-                for error in errors:
-                    messages.append(error.get("message"))
-                graphql_response_message = "\n".join(messages)
+        if entry is None:
+            self.misses += 1
+            return False, None
 
-    else:
-        logging.error(
-            "GraphQL query connection failed: "
-            + str(response.status_code)
-            + response.text
-        )
-        success = False
+        expires_at, value = entry
+        if expires_at <= time.monotonic():
+            del self.entries[key]
+            self.misses += 1
+            return False, None
 
-    return success, graphql_response_message
+        self.entries.move_to_end(key)
+        self.hits += 1
+        return True, value
 
+    def set(self, key, value, positive=True):
+        ttl_seconds = self.positive_ttl_seconds if positive else self.negative_ttl_seconds
+        if ttl_seconds <= 0:
+            return
 
-# Configure and create an instance of the Discord bot
-intents = discord.Intents.default()
-intents.messages = True
-bot = Bot(command_prefix="embeddings", intents=intents)
+        self.entries[key] = (time.monotonic() + ttl_seconds, value)
+        self.entries.move_to_end(key)
 
+        while len(self.entries) > self.max_size:
+            self.entries.popitem(last=False)
+            self.evictions += 1
 
-# Define the event handler for when the slash_command is received
-@bot.slash_command(description="Request Cody embeddings for a repo")
-@discord.option(
-    name="repo_url",
-    description="Enter the public repo in the format: github.com/org/repo",
-)
-async def embedding(ctx: discord.ApplicationContext, repo_url: str):
-    error_state = False
+    def invalidate(self, key):
+        self.entries.pop(key, None)
 
-    # Try / except block for Discord bot messages
-    try:
-        # Acknowledge the command, to avoid showing an error to the user, "The application did not respond"
-        await ctx.send_response(
-            content="Received `/embedding` command, creating new thread in this channel, and deleting this message.",
-            ephemeral=True,  # Only show this message to this user, which provides them a button to delete this message
-            delete_after=3600,  # Auto delete this message after x seconds
-        )
+    def stats(self):
+        return {
+            "size": len(self.entries),
+            "hits": self.hits,
+            "misses": self.misses,
+            "evictions": self.evictions,
+        }
 
-        # Get the Sourcegraph server and GraphQL api endpoints
-        sg_server, sg_server_api = await get_sourcegraph_server_addresses()
 
-        # Sanitize the repo URL before responding to the Discord user, so the user can visually validate the sanitized repo URL is valid, and tag us for support if not
-        sanitized_repo_url, input_validation_messages_to_user = await sanitize_repo_url(
-            repo_url
-        )
-        if sanitized_repo_url is None:
-            thread_name = repo_url
-            error_state = True
+# Single-flight de-duplication of concurrent calls
+# Concurrent callers asking for the same key share one in-flight call, and all receive the same result
+class SingleFlight:
+
+    def __init__(self):
+        # key: future of the in-flight call
+        self.in_flight  = {}
+        self.calls      = 0
+        self.shared     = 0
+
+    async def do(self, key, function, *args):
+        future = self.in_flight.get(key)
+
+        if future is None:
+            self.calls += 1
+            future = asyncio.ensure_future(function(*args))
+            self.in_flight[key] = future
+            future.add_done_callback(lambda done_future: self.forget(key, done_future))
         else:
-            thread_name = sanitized_repo_url
+            self.shared += 1
+            logging.debug("Joined in-flight call for: %s", key)
 
-        # Create the thread to reply in
-        thread = await ctx.interaction.channel.create_thread(
-            name=thread_name,
-            auto_archive_duration=60,  # Auto archive this thread after x minutes
-            type=discord.ChannelType.public_thread,
-        )
+        # Shield the shared call, so one caller being cancelled doesn't cancel it for everyone else
+        return await asyncio.shield(future)
 
-        # Send the initial message
-        await thread.send(
-            content=(
-                ctx.author.mention
-                + "requested embeddings for \n"
-                + repo_url
-            ),
-            suppress=True,
-        )
+    def forget(self, key, done_future):
+        if self.in_flight.get(key) is done_future:
+            del self.in_flight[key]
 
-        # If the sanitization returned input_validation_messages_to_user, then respond to the user with them
-        if len(input_validation_messages_to_user) > 0:
-            input_validation_messages_to_user_string = "Input validation:"
 
-            for input_validation_message in input_validation_messages_to_user:
-                input_validation_messages_to_user_string += str(
-                    "\n- " + input_validation_message
-                )
+# Repo existence probe cache settings
+REPO_PROBE_CACHE_MAX_SIZE       = int(os.environ.get("REPO_PROBE_CACHE_MAX_SIZE", "10000"))
+# How long, in seconds, to remember that a repo exists on its code host
+REPO_PROBE_CACHE_POSITIVE_TTL   = float(os.environ.get("REPO_PROBE_CACHE_POSITIVE_TTL", "3600"))
+# How long, in seconds, to remember that a repo could not be found, kept short so newly created / published repos are picked up
+REPO_PROBE_CACHE_NEGATIVE_TTL   = float(os.environ.get("REPO_PROBE_CACHE_NEGATIVE_TTL", "300"))
 
-            await thread.send(
-                content=input_validation_messages_to_user_string,
-                suppress=True,
-            )
+# Cache of code host probe results, keyed on the sanitized hostname + path
+repo_probe_cache = TTLCache(
+    REPO_PROBE_CACHE_MAX_SIZE,
+    REPO_PROBE_CACHE_POSITIVE_TTL,
+    REPO_PROBE_CACHE_NEGATIVE_TTL,
+)
+Gauge("discordbot_repo_probe_cache_size", "Entries in the code host probe cache", lambda: len(repo_probe_cache.entries))
+Counter("discordbot_repo_probe_cache_hits_total", "Code host probe cache hits", function=lambda: repo_probe_cache.hits)
+Counter("discordbot_repo_probe_cache_misses_total", "Code host probe cache misses", function=lambda: repo_probe_cache.misses)
 
-        # If we're in an error state, then end the processing here
-        # TODO: Add a terminating error message
-        if error_state:
-            await thread.send(
-                content="❌ Terminating request",
-                suppress=True,
-            )
-            return
 
-        # Respond to the user's command
-        await thread.send(
-            content=(
-                "Submitting embeddings request for \n"
-                + sanitized_repo_url
-                + "\nto Sourcegraph instance \n"
-                + sg_server
-            ),
-            suppress=True,
-        )
+# Concurrent probes for the same repo share one outbound request
+repo_probe_single_flight = SingleFlight()
 
-        # Get the return value and respond to the user
-        graphql_send_success, graphql_response_message = await send_graphql_request(
-            sanitized_repo_url,
-            sg_server_api,
-        )
 
-        if graphql_send_success == True:
-            # Send a message back to the channel if the GraphQL mutation was successful
-            response_to_user = f"""
-✅ Embeddings are processing!
-Embeddings are usually available within 30 minutes, depending on the size of the repo.
-To check if the embeddings are completed and ready to use:
-1. Go to your repo on Sourcegraph {sg_server + "/" + sanitized_repo_url}
-2. Click the Ask Cody button, near the top right
-3. Check the Chat Context menu in the bottom left corner of the Ask Cody chat pane, for a checkmark (ready) or an X (not ready yet)
-4. If your Cody IDE extension doesn't show the embeddings are ready, try:
- 1. Ensure you're logged in to your Cody extension via {sg_server}
- 2. Reload your IDE window
- 3. Ensure the output of `git remote get-url origin` matches the repo name you submitted for embeddings
- 4. For best results, open a new IDE workspace at the root directory of the repo, and ensure `cody.codebase` is not in your workspace or user settings
-"""
-            await thread.send(
-                content=response_to_user,
-                suppress=True,
-            )
+# Repo existence probe verdicts
+PROBE_EXISTS            = "exists"
+# The code host says there's no such repo, most code hosts also say this for private repos, so they don't leak their names
+PROBE_NOT_FOUND         = "not_found"
+# The code host wants a login to see the repo
+PROBE_PRIVATE           = "private"
+PROBE_RATE_LIMITED      = "rate_limited"
+# Server errors, timeouts, and connection failures
+PROBE_HOST_DOWN         = "host_down"
+# Nothing we could make sense of
+PROBE_UNKNOWN           = "unknown"
+# The code host isn't one of the public code hosts in CODE_HOST_RULES, so we didn't send it any requests
+PROBE_SKIPPED           = "skipped"
 
-        else:
-            # Send a message back to the channel if the GraphQL mutation was not successful, show an error to the user
-            await thread.send(
-                content=(
-                    "❌ Error submitting embeddings job to the Sourcegraph server: "
-                    + graphql_response_message
-                ),
-                suppress=True,
-            )
+# How long, in seconds, to wait for each probe request
+REPO_PROBE_TIMEOUT_SECONDS      = float(os.environ.get("REPO_PROBE_TIMEOUT_SECONDS", "5"))
+# The most bytes to read from a git info/refs response, the first pkt-line says whether it's a git repo
+REPO_PROBE_INFO_REFS_MAX_BYTES  = 4096
 
-    except Exception as exception:
-        logging.exception(exception)
-        await thread.send(
-            content=(
-                "❌ Error occurred: "
-                + exception
-            ),
-            suppress=True,
-        )
+repo_probe_requests = Counter("discordbot_repo_probe_requests_total", "Code host probe requests, by strategy", "strategy")
+repo_probe_verdicts = Counter("discordbot_repo_probe_verdicts_total", "Code host probe results, by verdict", "verdict")
 
 
-# Provide a healthcheck endpoint for the container / pod
-async def healthcheck(request):
-    logging.info("Healthcheck endpoint called - returned 200 OK response")
-    return web.Response(text="OK")
+# Check if the repo exists on its code host, and return the verdict
+# Results are cached, so repeat requests for the same repo skip the outbound requests
+async def probe_repo_exists(repo_url, url_scheme="https://"):
+    # Only send requests to the public code hosts we know about
+    # Code hosts configured on the Sourcegraph instance may be on an internal network, and probing them would let users map it out
+    if repo_url.split("/", 1)[0] not in code_hostnames_on_dotcom:
+        repo_probe_verdicts.inc(PROBE_SKIPPED)
+        return PROBE_SKIPPED
 
+    found, verdict = repo_probe_cache.get(repo_url)
+    if found:
+        logging.debug("Repo probe cache hit: %s %s", repo_url, verdict)
+        return verdict
 
-async def start_web_server():
-    app = web.Application()
-    app.add_routes([web.get("/healthcheck", healthcheck)])
-    runner = web.AppRunner(app)
-    await runner.setup()
-    site = web.TCPSite(runner, os.environ.get("HTTP_HOST"), os.environ.get("HTTP_PORT"))
-    await site.start()
+    return await repo_probe_single_flight.do(
+        url_scheme + repo_url,
+        request_repo_probe,
+        repo_url,
+        url_scheme,
+    )
 
 
-async def main():
-    configure_logging()
-    await start_web_server()
+# Work out the verdict from a code host's HTTP response, or None if the response doesn't tell us, and the next strategy should try
+def probe_verdict_for_response(response):
+    status = response.status
 
+    if 200 <= status < 300:
+        # Some code hosts send users without access to the login page, rather than saying 401 or 404
+        if regex.search(r"/(login|sign_in|signin)\b", response.url.path):
+            return PROBE_PRIVATE
+        return PROBE_EXISTS
+    if status in (404, 410):
+        return PROBE_NOT_FOUND
+    if status == 401:
+        return PROBE_PRIVATE
+    if status == 429 or (status == 403 and (response.headers.get("X-RateLimit-Remaining") == "0" or "Retry-After" in response.headers)):
+        return PROBE_RATE_LIMITED
+    if status == 403:
+        return PROBE_PRIVATE
+    if status >= 500 and status != 501:
+        return PROBE_HOST_DOWN
 
-if __name__ == "__main__":
-    asyncio.get_event_loop().run_until_complete(main())
-    bot.run(DISCORD_TOKEN)
+    # e.g. 405 / 501 for a code host that doesn't answer HEAD requests
+    return None
+
+
+# Probe strategies, cheapest first, each returns a verdict, or None to pass to the next strategy
+# HEAD request for the repo's web page, the code host sends the status without the page
+async def probe_with_head(session, repo_url, url_scheme):
+    async with session.head(url_scheme + repo_url, allow_redirects=True, timeout=aiohttp.ClientTimeout(total=REPO_PROBE_TIMEOUT_SECONDS)) as response:
+        return probe_verdict_for_response(response)
+
+
+# git smart HTTP ref advertisement, which every git host serves, even when its web pages can't be probed
+# Only read the first pkt-line, then drop the connection, as the full advertisement lists every ref in the repo
+async def probe_with_git_info_refs(session, repo_url, url_scheme):
+    async with session.get(
+        url_scheme + repo_url + "/info/refs",
+        params={"service": "git-upload-pack"},
+        allow_redirects=True,
+        timeout=aiohttp.ClientTimeout(total=REPO_PROBE_TIMEOUT_SECONDS),
+    ) as response:
+        verdict = probe_verdict_for_response(response)
+        if verdict == PROBE_EXISTS:
+            first_bytes = await response.content.read(REPO_PROBE_INFO_REFS_MAX_BYTES)
+            # Code hosts that only speak the dumb protocol, or send a web page, don't count as an answer
+            if b"# service=git-upload-pack" not in first_bytes:
+                verdict = None
+        response.close()
+        return verdict
+
+
+# The repo's path on its code host, e.g. "sourcegraph/cody" for "github.com/sourcegraph/cody", or None for a bare hostname
+def repo_path_on_code_host(repo_url):
+    repo_path = repo_url.partition("/")[2].strip("/")
+    return repo_path or None
+
+
+# GitHub REST API, which has its own rate limits, so it can answer when the web pages are rate limiting us
+async def probe_with_github_api(session, repo_url, url_scheme):
+    # There's no repo to ask the API about, leave it to the next strategy
+    owner_and_repo = repo_path_on_code_host(repo_url)
+    if owner_and_repo is None:
+        return None
+
+    async with session.get(
+        "https://api.github.com/repos/" + owner_and_repo,
+        headers={"Accept": "application/vnd.github+json"},
+        timeout=aiohttp.ClientTimeout(total=REPO_PROBE_TIMEOUT_SECONDS),
+    ) as response:
+        # A few KB of JSON, read it so the connection goes back to the pool
+        await response.read()
+        return probe_verdict_for_response(response)
+
+
+# GitLab REST API, which takes the project path URL encoded, as one path segment
+async def probe_with_gitlab_api(session, repo_url, url_scheme):
+    hostname = repo_url.split("/", 1)[0]
+    project_path = repo_path_on_code_host(repo_url)
+    if project_path is None:
+        return None
+
+    async with session.get(
+        url_scheme + hostname + "/api/v4/projects/" + quote(project_path, safe=""),
+        timeout=aiohttp.ClientTimeout(total=REPO_PROBE_TIMEOUT_SECONDS),
+    ) as response:
+        await response.read()
+        return probe_verdict_for_response(response)
+
+
+# Probe strategies by name, for the code host rules' probe_strategies
+REPO_PROBE_STRATEGIES = {
+    "head":             probe_with_head,
+    "git_info_refs":    probe_with_git_info_refs,
+    "github_api":       probe_with_github_api,
+    "gitlab_api":       probe_with_gitlab_api,
+}
+
+
+# Send the probe requests to the code host, and cache the result
+async def request_repo_probe(repo_url, url_scheme):
+    hostname = repo_url.split("/", 1)[0]
+    strategy_names = CODE_HOST_RULES[hostname]["probe_strategies"]
+    session = await create_http_session()
+    start = time.perf_counter()
+
+    # Try each strategy until one gives a definite answer about the repo
+    # Rate limits and outages may only affect one strategy, e.g. the web pages but not the API, so they don't stop us trying the next one
+    verdict = PROBE_UNKNOWN
+    for strategy_name in strategy_names:
+        try:
+            strategy_verdict = await REPO_PROBE_STRATEGIES[strategy_name](session, repo_url, url_scheme)
+        except (aiohttp.ClientError, asyncio.TimeoutError) as exception:
+            logging.warning("Repo probe %s failed for %s: %s", strategy_name, repo_url, repr(exception))
+            strategy_verdict = PROBE_HOST_DOWN
+
+        repo_probe_requests.inc(strategy_name)
+
+        if strategy_verdict is not None:
+            verdict = strategy_verdict
+        if verdict in (PROBE_EXISTS, PROBE_NOT_FOUND, PROBE_PRIVATE):
+            break
+
+    code_host_probe_seconds.observe(time.perf_counter() - start)
+    repo_probe_verdicts.inc(verdict)
+
+    # Only cache answers about the repo, not about the code host, it may just be having a moment
+    if verdict in (PROBE_EXISTS, PROBE_NOT_FOUND, PROBE_PRIVATE):
+        repo_probe_cache.set(repo_url, verdict, positive=(verdict == PROBE_EXISTS))
+
+    return verdict
+
+
+# repo_url normalization rules
+# Compiled once at import time, so normalize_repo_url doesn't rebuild them on every call
+
+# Matches any character that is not valid in a url, and breaks urlparse
+# string.ascii_letters = abcdefghijklmnopqrstuvwxyzABCDEFGHIJKLMNOPQRSTUVWXYZ, so this can be done before lowercasing
+# string.digits = 0123456789
+REPO_URL_ALLOWED_CHARS          = string.ascii_letters + string.digits + ":/@-_.;?=&+#"
+REPO_URL_DISALLOWED_CHARS_REGEX = regex.compile("[^" + regex.escape(REPO_URL_ALLOWED_CHARS) + "]")
+
+# Anything that looks like a scheme://
+REPO_URL_SCHEME_REGEX           = regex.compile(r"^.*://")
+
+# Branch name, tag name, or commit hash at the end of the path
+REPO_URL_GIT_REF_REGEX          = regex.compile(r"@[\w\d\./_-]*$")
+
+# File type extension at the end of the path
+REPO_URL_FILE_EXTENSION_REGEX   = regex.compile(r"\.\w*$")
+
+# The path part of a url, as accepted by validators.url, for the characters that make it through REPO_URL_DISALLOWED_CHARS_REGEX and urlsplit
+REPO_URL_VALID_PATH_REGEX       = regex.compile(r"^(/[-a-z0-9._~%!$&'()*+,;=:@/]*)?$")
+
+# Substrings to clean out of the hostname
+REPO_URL_HOSTNAME_SUBSTRINGS_TO_REMOVE = ("www.",)
+
+# File path in a repo on GitHub / GitLab
+GITHUB_GITLAB_FILE_PATH_REGEX   = regex.compile(r"(/-/.*|/blob/.*)$")
+
+# Views of a repo in the cgit web UI, used by git.eclipse.org and git.savannah.gnu.org
+CGIT_FILE_PATH_REGEX            = regex.compile(r"(?<=\.git)(/(tree|blob|plain|log|commit|diff|refs|about|summary|stats|snapshot|patch|atom)(/.*)?)$")
+
+# Per code host normalization rules, keyed on the hostname, after removing www.
+# We don't need to accept all valid hostnames, only hostnames that match our code host config repo patterns on dotcom
+# These are also the only code hosts we send probe requests to, as we know they're public
+# file_path_regex:          Matches the file path / web UI view at the end of the repo url, to remove it
+# strip_trailing_slash:     Remove trailing slashes from the path
+# path_prefix_aliases:      Path prefixes that point to the same repos as canonical_path_prefix, ie. the web UI vs the clone url
+# canonical_path_prefix:    The path prefix of the repo names for this code host on Sourcegraph
+# repo_name_prefix:         What replaces the hostname in the repo names on Sourcegraph, from the code host's repositoryPathPattern, None to keep the hostname
+# probe_strategies:         REPO_PROBE_STRATEGIES to check the repo exists with, cheapest first, later ones are tried if earlier ones can't tell
+CODE_HOST_RULES = {
+    "git.eclipse.org": {
+        "file_path_regex":          CGIT_FILE_PATH_REGEX,
+        "strip_trailing_slash":     True,
+        # https://git.eclipse.org/c/jgit/jgit.git/tree/README.md, git://git.eclipse.org/gitroot/jgit/jgit.git
+        "path_prefix_aliases":      ("/c/", "/gitroot/"),
+        # https://git.eclipse.org/r/jgit/jgit
+        "canonical_path_prefix":    "/r/",
+        "repo_name_prefix":         None,
+        # The canonical path is the clone url, which answers git requests, rather than a web page
+        "probe_strategies":         ("git_info_refs", "head"),
+    },
+    "git.savannah.gnu.org": {
+        "file_path_regex":          CGIT_FILE_PATH_REGEX,
+        "strip_trailing_slash":     True,
+        # https://git.savannah.gnu.org/cgit/emacs.git/tree/README, git://git.savannah.gnu.org/emacs.git
+        "path_prefix_aliases":      ("/cgit/",),
+        # https://git.savannah.gnu.org/git/emacs.git
+        "canonical_path_prefix":    "/git/",
+        "repo_name_prefix":         None,
+        # The canonical path is the clone url, which answers git requests, rather than a web page
+        "probe_strategies":         ("git_info_refs", "head"),
+    },
+    "github.com": { # Tested
+        "file_path_regex":          GITHUB_GITLAB_FILE_PATH_REGEX,
+        "strip_trailing_slash":     False,
+        "path_prefix_aliases":      (),
+        "canonical_path_prefix":    "",
+        "repo_name_prefix":         None,
+        "probe_strategies":         ("head", "github_api", "git_info_refs"),
+    },
+    "gitlab.com": { # Tested
+        "file_path_regex":          GITHUB_GITLAB_FILE_PATH_REGEX,
+        "strip_trailing_slash":     False,
+        "path_prefix_aliases":      (),
+        "canonical_path_prefix":    "",
+        "repo_name_prefix":         None,
+        "probe_strategies":         ("head", "gitlab_api", "git_info_refs"),
+    },
+}
+code_hostnames_on_dotcom = frozenset(CODE_HOST_RULES)
+
+# Normalization rules for code hosts that aren't in CODE_HOST_RULES, but are configured on the Sourcegraph instance
+# These code hosts are never probed, see probe_repo_exists
+DEFAULT_CODE_HOST_RULE = {
+    "file_path_regex":          GITHUB_GITLAB_FILE_PATH_REGEX,
+    "strip_trailing_slash":     False,
+    "path_prefix_aliases":      (),
+    "canonical_path_prefix":    "",
+    "repo_name_prefix":         None,
+    "probe_strategies":         (),
+}
+
+# The code host rules in use, keyed on hostname
+# Starts as the dotcom defaults, then is replaced by the code hosts configured on the Sourcegraph instance, by refresh_code_host_rules()
+# Never modified in place, only replaced as a whole, so normalize_repo_url always sees a consistent set of rules with an O(1) lookup
+code_host_rules = MappingProxyType(dict(CODE_HOST_RULES))
+
+# Repo name prefix: hostname, for code hosts whose repositoryPathPattern doesn't start with their hostname
+repo_name_prefix_hostnames = MappingProxyType({})
+
+# Code host settings
+# How often, in seconds, to refresh the code hosts from the Sourcegraph instance, and how much random jitter to add, as a fraction of the interval
+CODE_HOST_REFRESH_SECONDS       = float(os.environ.get("CODE_HOST_REFRESH_SECONDS", "600"))
+CODE_HOST_REFRESH_JITTER        = float(os.environ.get("CODE_HOST_REFRESH_JITTER", "0.1"))
+
+# External service kinds that don't host git repos we can create embeddings for
+CODE_HOST_KINDS_TO_IGNORE = frozenset([
+    "GOMODULES",
+    "JVMPACKAGES",
+    "NPMPACKAGES",
+    "PERFORCE",
+    "PHABRICATOR",
+    "PYTHONPACKAGES",
+    "RUBYPACKAGES",
+    "RUSTPACKAGES",
+])
+
+# The config is JSONC, which may have comments and trailing commas, so pull the one setting we need out with a regex instead of parsing it
+REPOSITORY_PATH_PATTERN_REGEX = regex.compile(r'"repositoryPathPattern"\s*:\s*"([^"]*)"')
+
+# One page of the code hosts configured on the Sourcegraph instance, the after cursor is filled in for each page
+EXTERNAL_SERVICES_PAGE_SIZE = 100
+
+EXTERNAL_SERVICES_QUERY = """
+    query {
+        externalServices(first: %d, after: %s) {
+            nodes {
+                kind
+                url
+                config
+            }
+            pageInfo {
+                hasNextPage
+                endCursor
+            }
+        }
+    }
+"""
+
+# Stop paging after this many pages, in case the instance keeps returning the same cursor
+EXTERNAL_SERVICES_MAX_PAGES = 100
+
+
+# Build the code host rules from the externalServices GraphQL query response
+# Returns (rules, repo_name_prefix_hostnames)
+def build_code_host_rules(external_services):
+    rules = {}
+    prefix_hostnames = {}
+
+    for external_service in external_services:
+        if external_service.get("kind") in CODE_HOST_KINDS_TO_IGNORE:
+            continue
+
+        hostname = urlsplit(external_service.get("url") or "").hostname
+        if not hostname:
+            continue
+        hostname = hostname.lower()
+        for sub_string in REPO_URL_HOSTNAME_SUBSTRINGS_TO_REMOVE:
+            hostname = hostname.replace(sub_string, "")
+
+        # Don't accept repo urls for code hosts on private addresses, ie. an internal code host configured by IP address
+        if not validators.url("https://" + hostname + "/", public=True):
+            logging.info("Skipping code host on a private address: %s", hostname)
+            continue
+
+        # Use our parsing rules for the code hosts we know about, and the defaults for the rest
+        rule = dict(CODE_HOST_RULES.get(hostname, DEFAULT_CODE_HOST_RULE))
+
+        # Repo names on Sourcegraph follow the code host's repositoryPathPattern, which defaults to {host}/{nameWithOwner}
+        # We only need the part before the repo path, ie. "{host}" or "github"
+        repository_path_pattern_match = REPOSITORY_PATH_PATTERN_REGEX.search(external_service.get("config") or "")
+        if repository_path_pattern_match:
+            repo_name_prefix = regex.sub(r"/?\{[^}]*\}.*$", "", repository_path_pattern_match.group(1).replace("{host}", hostname, 1))
+            if repo_name_prefix and repo_name_prefix != hostname:
+                rule["repo_name_prefix"] = repo_name_prefix
+                prefix_hostnames[repo_name_prefix] = hostname
+
+        rules[hostname] = rule
+
+    return rules, prefix_hostnames
+
+
+# Load the code hosts configured on the Sourcegraph instance, and swap them in
+async def refresh_code_host_rules(sg_server_api):
+    global code_host_rules, repo_name_prefix_hostnames
+
+    # Page through all of the code hosts, an instance can have more than fit in one page
+    external_services = []
+    cursor = None
+    for _ in range(EXTERNAL_SERVICES_MAX_PAGES):
+        response_json = await post_graphql_query(EXTERNAL_SERVICES_QUERY % (EXTERNAL_SERVICES_PAGE_SIZE, json.dumps(cursor)), sg_server_api)
+        if response_json.get("errors"):
+            raise RuntimeError(f"externalServices query returned errors: {response_json.get('errors')}")
+
+        page = ((response_json.get("data") or {}).get("externalServices")) or {}
+        external_services.extend(page.get("nodes") or [])
+
+        page_info = page.get("pageInfo") or {}
+        if not page_info.get("hasNextPage") or not page_info.get("endCursor") or page_info.get("endCursor") == cursor:
+            break
+        cursor = page_info["endCursor"]
+    else:
+        logging.warning("Stopped paging through code hosts after %d pages", EXTERNAL_SERVICES_MAX_PAGES)
+
+    rules, prefix_hostnames = build_code_host_rules(external_services)
+
+    # Don't lock everyone out if the instance returned no code hosts, keep what we had
+    if not rules:
+        logging.warning("No code hosts returned from the Sourcegraph instance, keeping the current code host list")
+        return
+
+    code_host_rules = MappingProxyType(rules)
+    repo_name_prefix_hostnames = MappingProxyType(prefix_hostnames)
+    logging.info("Loaded %d code hosts from the Sourcegraph instance: %s", len(rules), ", ".join(sorted(rules)))
+
+
+# Keep refreshing the code hosts in the background, with jitter, so replicas don't all query at once
+async def refresh_code_host_rules_periodically(sg_server_api):
+    while True:
+        jitter = random.uniform(-CODE_HOST_REFRESH_JITTER, CODE_HOST_REFRESH_JITTER)
+        await asyncio.sleep(CODE_HOST_REFRESH_SECONDS * (1 + jitter))
+        try:
+            await refresh_code_host_rules(sg_server_api)
+        except Exception as exception:
+            # Keep using the last good list
+            logging.warning("Failed to refresh code hosts from the Sourcegraph instance: %s", exception)
+
+
+# Map a repo name on Sourcegraph back to its url on the code host, for code hosts with a custom repositoryPathPattern
+def code_host_url_for_repo_name(repo_url):
+    for repo_name_prefix, hostname in repo_name_prefix_hostnames.items():
+        if repo_url == repo_name_prefix or repo_url.startswith(repo_name_prefix + "/"):
+            return hostname + repo_url[len(repo_name_prefix):]
+    return repo_url
+
+
+# Normalize the repo_url the user gave us into the format required by the embeddings scheduler: github.com/org/repo
+# Pure CPU, no network calls, so it's cheap to call for every command, and easy to benchmark
+# Returns the normalized repo_url, or None if it can't be used, and the list of messages to show the user
+# The order of these operations is significant
+def normalize_repo_url(repo_url):
+    input_validation_messages_to_user = []
+    url_scheme = "https://"
+
+    # Users have tried providing repo_urls like
+    # https://github.com/org/repo
+    # https://www.github.com/org/repo
+    # www.github.com/org/repo
+    # www.github.com/org/repo.git
+    # www.github.com/org/repo.git@ref
+    # https://www.github.com/org/repo.git@ref
+
+    # Remove any garbage / disallowed characters that break urlparse, and report them to the user
+    disallowed_chars = REPO_URL_DISALLOWED_CHARS_REGEX.findall(repo_url)
+    if disallowed_chars:
+        repo_url = REPO_URL_DISALLOWED_CHARS_REGEX.sub("", repo_url)
+        input_validation_messages_to_user.append(
+            "Removed invalid characters: "
+            + "".join(dict.fromkeys(disallowed_chars))
+        )
+
+    # Convert to lowercase
+    # Don't need to warn the user about case
+    repo_url = repo_url.lower()
+
+    # Only need to use urlsplit to get hostname and path
+    # urlsplit doesn't work if the url doesn't start with a scheme://
+    # So we have to normalize that first
+    # Strip anything that looks like a schema
+    if "://" in repo_url:
+        repo_url = REPO_URL_SCHEME_REGEX.sub("", repo_url)
+
+    # Run it through urlsplit, and extract the hostname and path, the only two components we need
+    # This gives the same hostname and path as urlparse(...).hostname and .path, without the overhead of building the rest
+    try:
+
+        split_repo_url  = urlsplit(url_scheme + repo_url)
+        # Drop any user:password@ and :port, brackets for IPv6 addresses were already removed as disallowed characters
+        parsed_hostname = split_repo_url.netloc.rpartition("@")[2].partition(":")[0] or "None"
+        parsed_path     = split_repo_url.path
+        # Drop any ;params from the last path segment, like urlparse does
+        if ";" in parsed_path:
+            params_index = parsed_path.find(";", parsed_path.rfind("/"))
+            if params_index >= 0:
+                parsed_path = parsed_path[:params_index]
+
+    except Exception as exception:
+        error_string = "urlsplit failed."
+        exception.add_note(error_string)
+        raise
+
+    # Clean up any extra junk that may be left in the host name
+    hostname = parsed_hostname
+    removed_hostname_substrings = []
+    for sub_string in REPO_URL_HOSTNAME_SUBSTRINGS_TO_REMOVE:
+        if sub_string in hostname:
+            removed_hostname_substrings.append("Removed: " + sub_string)
+            hostname = hostname.replace(sub_string, "")
+
+    code_host_rule = code_host_rules.get(hostname)
+
+    # Hostnames in the rule table are known to be valid, so only pay for validators.domain when the hostname isn't supported
+    if code_host_rule is None:
+
+        # Check if the hostname is valid
+        is_hostname_valid = validators.domain(parsed_hostname)
+        if not is_hostname_valid:
+            error_string = "Unsupported hostname provided: " + str(is_hostname_valid)
+            logging.error(error_string)
+            validation_failures.inc("unsupported_hostname")
+            input_validation_messages_to_user.append(error_string)
+            return None, input_validation_messages_to_user
+
+        input_validation_messages_to_user.extend(removed_hostname_substrings)
+        error_string = (
+            "Code host not configured on Sourcegraph instance: "
+            + hostname
+        )
+        logging.error(error_string)
+        validation_failures.inc("code_host_not_configured")
+        input_validation_messages_to_user.append(error_string)
+        return None, input_validation_messages_to_user
+
+    input_validation_messages_to_user.extend(removed_hostname_substrings)
+
+    if code_host_rule["strip_trailing_slash"]:
+        parsed_path = parsed_path.rstrip("/")
+
+    # Remove file path in repo if present
+    file_path_match = code_host_rule["file_path_regex"].search(parsed_path)
+    if file_path_match:
+        file_path = file_path_match.group(0)
+        input_validation_messages_to_user.append(
+            "Removed file path: "
+            + file_path
+        )
+        parsed_path = parsed_path.replace(file_path, "")
+
+    # Remove @[ref] if present
+    # Branch name, tag name, or commit hash
+    # At this time point in the script, the only @ should be in the path, not the hostname
+    # At this time, it appears that the embeddings job web UI https://sourcegraph.com/site-admin/embeddings doesn't support @refs, only default branch at head
+    # This may change in the future, and would need to be removed then
+    git_ref_match = REPO_URL_GIT_REF_REGEX.search(parsed_path)
+    if git_ref_match:
+        git_ref = git_ref_match.group(0)
+        input_validation_messages_to_user.append(
+            "Removed rev: "
+            + git_ref
+            + ", only the HEAD revision of the default branch is supported for embeddings at this time."
+        )
+        parsed_path = parsed_path.replace(git_ref, "")
+
+    # Remove file type extension if present
+    file_extension_match = REPO_URL_FILE_EXTENSION_REGEX.search(parsed_path)
+    if file_extension_match:
+        file_extension = file_extension_match.group(0)
+        if file_extension != ".git":
+            input_validation_messages_to_user.append(
+                "Removed file type extension: "
+                + file_extension
+            )
+        parsed_path = parsed_path.replace(file_extension, "")
+
+    # Map the web UI / alternate clone url paths to the repo names on Sourcegraph
+    canonical_path_prefix = code_host_rule["canonical_path_prefix"]
+    if canonical_path_prefix and parsed_path and not parsed_path.startswith(canonical_path_prefix):
+        for path_prefix_alias in code_host_rule["path_prefix_aliases"]:
+            if parsed_path.startswith(path_prefix_alias):
+                parsed_path = parsed_path[len(path_prefix_alias) - 1:]
+                break
+        parsed_path = canonical_path_prefix.rstrip("/") + parsed_path
+    # TODO: Validate the repo path is a valid org/repo?
+
+    # Set the repo_url to only the hostname and path, to clean out a bunch of possible junk
+    repo_url = (code_host_rule["repo_name_prefix"] or hostname) + parsed_path
+
+    # Check if the URL is valid and publicly accessible
+    # Hostnames on our list of public code hosts only need the path checked, so only call validators.url if the path looks off
+    # Hostnames that came from the instance's code host config could be anything, including private addresses, so always check them
+    if hostname not in code_hostnames_on_dotcom or not REPO_URL_VALID_PATH_REGEX.match(parsed_path):
+        is_url_valid_and_public = validators.url(url_scheme + repo_url, public=True)
+        if not is_url_valid_and_public:
+            error_string = "URL is not valid or public: " + str(is_url_valid_and_public)
+            logging.error(error_string)
+            validation_failures.inc("url_not_valid_or_public")
+            input_validation_messages_to_user.append(error_string)
+            return None, input_validation_messages_to_user
+
+    return repo_url, input_validation_messages_to_user
+
+
+# What to tell the user when the probe can't confirm the repo exists, followed by the repo's url
+REPO_PROBE_VERDICT_MESSAGES = {
+    PROBE_NOT_FOUND:        "Repo not found on its code host, please check it's public and spelled right: ",
+    PROBE_PRIVATE:          "Repo needs a login on its code host, only public repos can be embedded: ",
+    PROBE_RATE_LIMITED:     "Could not validate if repo exists, its code host is rate limiting us: ",
+    PROBE_HOST_DOWN:        "Could not validate if repo exists, its code host isn't responding: ",
+    PROBE_UNKNOWN:          "Could not validate if repo exists: ",
+}
+
+
+# All of the repo_url sanitization and validation code should happen in one function
+# This needs to happen on the client side, because the GraphQL API rejects invalid repo_urls instead of sanitizing them
+async def sanitize_repo_url(repo_url):
+    # Keep a copy of the repo_url the user gave us
+    initial_repo_url = repo_url
+    url_scheme = "https://"
+    start = time.perf_counter()
+
+    # Log it
+    logging.info("initial_repo_url: %s", initial_repo_url)
+
+    try:
+        repo_url, input_validation_messages_to_user = normalize_repo_url(repo_url)
+
+        if repo_url is None:
+            return None, input_validation_messages_to_user
+
+        logging.info("normalized repo_url: %s", repo_url)
+
+        # Verify the repo exists, and is public
+        # Only on the public code hosts in CODE_HOST_RULES, to avoid users using this guess and check for hostname resolution on our internal network
+        # probe_repo_exists skips the rest, ie. code hosts from the Sourcegraph instance's config
+        code_host_repo_url = code_host_url_for_repo_name(repo_url)
+        verdict = await probe_repo_exists(code_host_repo_url, url_scheme)
+
+        # Only tell the user, and carry on, as the Sourcegraph instance may have access to repos we can't see,
+        # and the presence check on the instance has the final say
+        if verdict == PROBE_EXISTS:
+            logging.debug("Repo exists: %s%s", url_scheme, code_host_repo_url)
+        elif verdict == PROBE_SKIPPED:
+            logging.debug("Skipped probing code host not on our public list: %s%s", url_scheme, code_host_repo_url)
+        else:
+            message_to_user = REPO_PROBE_VERDICT_MESSAGES.get(verdict, REPO_PROBE_VERDICT_MESSAGES[PROBE_UNKNOWN]) + url_scheme + code_host_repo_url
+            logging.warning(message_to_user)
+            validation_failures.inc("repo_" + verdict)
+            input_validation_messages_to_user.append(message_to_user)
+
+    except Exception as exception:
+        error_string = (
+            "Failed to sanitize repo_url."
+            + "\n Started with: " + initial_repo_url
+            + "\n Ended with: " + str(repo_url)
+            + "\n Exception: " + str(exception)
+        )
+        exception.add_note(error_string)
+        raise
+
+    finally:
+        sanitize_repo_url_seconds.observe(time.perf_counter() - start)
+
+    return repo_url, input_validation_messages_to_user
+
+
+# The (sg_server, sg_server_api) worked out by get_sourcegraph_server_addresses()
+sourcegraph_server_addresses = None
+
+
+# Determine Sourcegraph server URL, dotcom by default
+async def get_sourcegraph_server_addresses():
+    global sourcegraph_server_addresses
+
+    # The environment doesn't change while we're running, so only work these out once
+    if sourcegraph_server_addresses is not None:
+        return sourcegraph_server_addresses
+
+    # Start with a default of dotcom
+    sg_server = "sourcegraph.com"
+
+    # If this service was started with the SG_SERVER environment variable, then use it
+    if "SG_SERVER" in os.environ:
+        sg_server = os.environ.get("SG_SERVER")
+
+    # If it's provided with http, replace it with https://
+    if "http://" in sg_server:
+        sg_server = sg_server.replace("http://", "https://")
+
+    # If it doesn't have https, prepend it
+    if "https://" not in sg_server:
+        sg_server = "".join(["https://", sg_server])
+
+    # If it has .api/graphql, remove it
+    if ".api/graphql" in sg_server:
+        sg_server = sg_server.replace(".api/graphql", "")
+
+    # If it ends with a trailing slash or two, remove it
+    sg_server = sg_server.rstrip("/")
+
+    # Append the /.api/graphql endpoint to the sg_server, to get the sg_server_api
+    sg_server_api = "".join([sg_server, "/.api/graphql"])
+
+    # Return both values
+    sourcegraph_server_addresses = (sg_server, sg_server_api)
+    return sourcegraph_server_addresses
+
+
+# Admission control settings
+# Token buckets: each user / guild can burst up to BURST embedding commands, then gets PER_MINUTE more per minute
+USER_RATE_LIMIT_BURST               = float(os.environ.get("USER_RATE_LIMIT_BURST", "3"))
+USER_RATE_LIMIT_PER_MINUTE          = float(os.environ.get("USER_RATE_LIMIT_PER_MINUTE", "3"))
+GUILD_RATE_LIMIT_BURST              = float(os.environ.get("GUILD_RATE_LIMIT_BURST", "30"))
+GUILD_RATE_LIMIT_PER_MINUTE         = float(os.environ.get("GUILD_RATE_LIMIT_PER_MINUTE", "30"))
+# The most GraphQL requests in flight to the Sourcegraph instance at once, across all commands and background work
+SOURCEGRAPH_MAX_CONCURRENT_CALLS    = int(os.environ.get("SOURCEGRAPH_MAX_CONCURRENT_CALLS", "10"))
+# The most embedding commands submitting to Sourcegraph at once, and the most waiting in line behind them
+# Each command holds its slot while its repo waits in the micro-batch window, so a batch from single commands never has more
+# repos than there are slots, and the shared batchers send as soon as they hold min(this, EMBEDDING_BATCH_MAX_SIZE) repos
+EMBEDDING_MAX_CONCURRENT_SUBMISSIONS = int(os.environ.get("EMBEDDING_MAX_CONCURRENT_SUBMISSIONS", "20"))
+EMBEDDING_MAX_QUEUED_SUBMISSIONS    = int(os.environ.get("EMBEDDING_MAX_QUEUED_SUBMISSIONS", "200"))
+# The most chunks of repos one bulk command submits at once, each chunk takes one of the submission slots above
+BULK_EMBEDDING_MAX_CONCURRENT_CHUNKS = int(os.environ.get("BULK_EMBEDDING_MAX_CONCURRENT_CHUNKS", "2"))
+# How many commands are processed at once, after they're acknowledged, and the most waiting for a worker
+COMMAND_WORKERS                     = int(os.environ.get("COMMAND_WORKERS", "32"))
+COMMAND_MAX_QUEUED                  = int(os.environ.get("COMMAND_MAX_QUEUED", "500"))
+# The most workers bulk commands can take at once, so they can't crowd out single commands
+COMMAND_MAX_ACTIVE_BULK             = int(os.environ.get("COMMAND_MAX_ACTIVE_BULK", "2"))
+# How long, in seconds, to let queued and running commands finish on shutdown, inside the container's stop grace period
+COMMAND_DRAIN_SECONDS               = float(os.environ.get("COMMAND_DRAIN_SECONDS", "20"))
+
+
+# Token bucket rate limiter
+# Holds up to capacity tokens, refilled at refill_per_second, each request spends one token
+class TokenBucket:
+
+    def __init__(self, capacity, refill_per_second):
+        self.capacity           = capacity
+        self.refill_per_second  = refill_per_second
+        self.tokens             = capacity
+        self.updated_at         = time.monotonic()
+
+    def refill(self, now):
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated_at) * self.refill_per_second)
+        self.updated_at = now
+
+    # Seconds until the next token is available, 0 if one is available now, or None if the bucket never refills
+    def retry_after(self):
+        if self.tokens >= 1:
+            return 0.0
+        if self.refill_per_second <= 0:
+            return None
+        return (1 - self.tokens) / self.refill_per_second
+
+
+# A token bucket per key, ie. per user id, with the least recently used buckets dropped once there are max_size of them
+# A dropped bucket comes back full, which is fine, as it would have refilled while idle anyway
+class TokenBuckets:
+
+    def __init__(self, capacity, refill_per_minute, max_size=100000):
+        self.capacity           = capacity
+        self.refill_per_second  = refill_per_minute / 60
+        self.max_size           = max_size
+        self.buckets            = OrderedDict()
+
+    def get(self, key):
+        bucket = self.buckets.get(key)
+        if bucket is None:
+            bucket = TokenBucket(self.capacity, self.refill_per_second)
+            self.buckets[key] = bucket
+            if len(self.buckets) > self.max_size:
+                self.buckets.popitem(last=False)
+        else:
+            self.buckets.move_to_end(key)
+        return bucket
+
+
+# Shared state settings
+# Where to keep state that has to be shared between replicas: de-duplication keys, rate limit buckets, caches, and pending jobs
+# memory:// (the default) keeps it in this process, for running one replica
+# redis://[:password@]host[:port][/db] keeps it on a Redis compatible server, for running several replicas
+STATE_BACKEND_URL               = os.environ.get("STATE_BACKEND_URL", "memory://")
+# Prefix for every key we store, so several deployments can share one Redis server
+STATE_BACKEND_KEY_PREFIX        = os.environ.get("STATE_BACKEND_KEY_PREFIX", "discordbot:")
+# How long, in seconds, to wait for the state backend to answer each command
+STATE_BACKEND_TIMEOUT_SECONDS   = float(os.environ.get("STATE_BACKEND_TIMEOUT_SECONDS", "2"))
+# After the state backend couldn't be reached, or stopped answering, how long, in seconds, to fail its calls straight away, before trying it again
+# Callers fall back to this replica's state in the meantime, rather than each waiting out its own timeout
+STATE_BACKEND_RETRY_SECONDS     = float(os.environ.get("STATE_BACKEND_RETRY_SECONDS", "5"))
+# This replica's name, for leader election, and to tell which replica recorded a job
+REPLICA_ID                      = os.environ.get("REPLICA_ID", socket.gethostname())
+
+state_backend_errors = Counter("discordbot_state_backend_errors_total", "Failed shared state backend calls, by operation", "operation")
+
+
+# Error reply from a Redis compatible server
+class RedisError(Exception):
+    pass
+
+
+# State kept in this process's memory, for running one replica
+# All methods are async, to match the Redis backend, and values are strings, so callers can't tell the backends apart
+class InMemoryStateBackend:
+
+    # Whether other replicas can see this state
+    shared = False
+
+    def __init__(self):
+        # key: (expires_at or None, value)
+        self.values         = {}
+        # name: {field: value}
+        self.hashes         = {}
+        # scope: TokenBuckets
+        self.rate_limits    = {}
+
+    def live_value(self, key):
+        entry = self.values.get(key)
+        if entry is None:
+            return None
+        expires_at, value = entry
+        if expires_at is not None and expires_at <= time.monotonic():
+            del self.values[key]
+            return None
+        return value
+
+    async def get(self, key):
+        return self.live_value(key)
+
+    async def set(self, key, value, ttl_seconds):
+        self.values[key] = (time.monotonic() + ttl_seconds, value)
+
+    # Set the key only if it isn't already set, returns whether it was set
+    async def set_if_absent(self, key, value, ttl_seconds):
+        if self.live_value(key) is not None:
+            return False
+        await self.set(key, value, ttl_seconds)
+        return True
+
+    # Extend the key's expiry, only if it's still set to value, returns whether it was
+    async def renew_if_owner(self, key, value, ttl_seconds):
+        if self.live_value(key) != value:
+            return False
+        await self.set(key, value, ttl_seconds)
+        return True
+
+    # Delete the key, only if it's still set to value
+    async def release_if_owner(self, key, value):
+        if self.live_value(key) == value:
+            del self.values[key]
+
+    async def delete(self, key):
+        self.values.pop(key, None)
+
+    # Spend a token from each of the token buckets, only if every bucket has one
+    # buckets is a list of (scope, key, capacity, refill_per_second), returns (allowed, retry_after_seconds, scope)
+    async def take_tokens(self, buckets):
+        now = time.monotonic()
+        token_buckets = []
+
+        for scope, key, capacity, refill_per_second in buckets:
+            token_buckets_for_scope = self.rate_limits.get(scope)
+            if token_buckets_for_scope is None:
+                token_buckets_for_scope = TokenBuckets(capacity, refill_per_second * 60)
+                self.rate_limits[scope] = token_buckets_for_scope
+            bucket = token_buckets_for_scope.get(key)
+
+            # Only spend tokens if every bucket has one, so a request rejected by the guild limit doesn't count against the user
+            bucket.refill(now)
+            retry_after = bucket.retry_after()
+            if retry_after is None or retry_after > 0:
+                return False, retry_after, scope
+            token_buckets.append(bucket)
+
+        for bucket in token_buckets:
+            bucket.tokens -= 1
+
+        return True, 0.0, None
+
+    async def hash_set(self, name, field, value):
+        self.hashes.setdefault(name, {})[field] = value
+
+    async def hash_delete(self, name, field):
+        self.hashes.get(name, {}).pop(field, None)
+
+    async def hash_get_all(self, name):
+        return dict(self.hashes.get(name, {}))
+
+    async def close(self):
+        pass
+
+
+# Lua scripts, so each multi-step operation is atomic on the Redis server
+# Take a token from every bucket in KEYS, or from none of them, using the server's clock so replicas agree on the time
+# ARGV has a capacity and refill_per_second for each key, returns {allowed, retry_after, index of the empty bucket}
+# retry_after is "blocked" if the empty bucket never refills
+REDIS_TAKE_TOKENS_SCRIPT = """
+local time = redis.call("TIME")
+local now = tonumber(time[1]) + tonumber(time[2]) / 1000000
+local tokens = {}
+for index, key in ipairs(KEYS) do
+    local capacity = tonumber(ARGV[index * 2 - 1])
+    local refill_per_second = tonumber(ARGV[index * 2])
+    local bucket = redis.call("HMGET", key, "tokens", "updated_at")
+    local bucket_tokens = tonumber(bucket[1]) or capacity
+    local updated_at = tonumber(bucket[2]) or now
+    bucket_tokens = math.min(capacity, bucket_tokens + math.max(0, now - updated_at) * refill_per_second)
+    if bucket_tokens < 1 then
+        if refill_per_second <= 0 then
+            return {0, "blocked", index}
+        end
+        return {0, tostring((1 - bucket_tokens) / refill_per_second), index}
+    end
+    tokens[index] = bucket_tokens
+end
+for index, key in ipairs(KEYS) do
+    local capacity = tonumber(ARGV[index * 2 - 1])
+    local refill_per_second = tonumber(ARGV[index * 2])
+    redis.call("HSET", key, "tokens", tostring(tokens[index] - 1), "updated_at", tostring(now))
+    if refill_per_second > 0 then
+        redis.call("PEXPIRE", key, math.ceil(capacity / refill_per_second * 1000))
+    end
+end
+return {1, "0", 0}
+"""
+
+REDIS_RENEW_IF_OWNER_SCRIPT = """
+if redis.call("GET", KEYS[1]) == ARGV[1] then
+    return redis.call("PEXPIRE", KEYS[1], ARGV[2])
+end
+return 0
+"""
+
+REDIS_RELEASE_IF_OWNER_SCRIPT = """
+if redis.call("GET", KEYS[1]) == ARGV[1] then
+    return redis.call("DEL", KEYS[1])
+end
+return 0
+"""
+
+
+# State kept on a Redis compatible server, shared by every replica
+# Speaks the Redis protocol (RESP) directly, over one pipelined connection, so there's no client library to install
+class RedisStateBackend:
+
+    shared = True
+
+    def __init__(self, url, key_prefix=STATE_BACKEND_KEY_PREFIX, timeout_seconds=STATE_BACKEND_TIMEOUT_SECONDS, retry_seconds=STATE_BACKEND_RETRY_SECONDS):
+        parsed_url              = urlsplit(url)
+        self.host               = parsed_url.hostname or "localhost"
+        self.port               = parsed_url.port or 6379
+        self.password           = parsed_url.password
+        self.database           = int(parsed_url.path.strip("/") or 0)
+        self.key_prefix         = key_prefix
+        self.timeout_seconds    = timeout_seconds
+        self.retry_seconds      = retry_seconds
+        self.reader             = None
+        self.writer             = None
+        self.reader_task        = None
+        # Futures waiting for replies, in the order the commands were sent, as the server replies in order
+        self.pending_replies    = deque()
+        # The connection attempt in progress, shared by every command that needs it
+        self.connecting         = None
+        # time.monotonic() until which the backend is treated as down, and commands fail without trying it
+        self.down_until         = 0.0
+
+    def key(self, key):
+        return self.key_prefix + key
+
+    async def connect(self):
+        self.reader, self.writer = await asyncio.wait_for(
+            asyncio.open_connection(self.host, self.port),
+            self.timeout_seconds,
+        )
+        self.reader_task = asyncio.get_running_loop().create_task(self.read_replies(self.reader))
+
+        try:
+            if self.password:
+                await self.send_command("AUTH", self.password)
+            if self.database:
+                await self.send_command("SELECT", self.database)
+        except Exception as exception:
+            # Don't leave an unauthenticated connection, or one on the wrong database, for later commands to fail on
+            self.disconnect(exception)
+            raise
+
+    # Connect, or mark the backend down for retry_seconds if we can't
+    async def connect_or_mark_down(self):
+        try:
+            await self.connect()
+        except Exception:
+            self.down_until = time.monotonic() + self.retry_seconds
+            raise
+        finally:
+            self.connecting = None
+
+    # Wait for a connection, joining the attempt in progress if there is one, so a down backend costs one timeout, not one per caller
+    async def ensure_connected(self):
+        if self.connecting is None and (self.writer is None or self.writer.is_closing()):
+            retry_in_seconds = self.down_until - time.monotonic()
+            if retry_in_seconds > 0:
+                raise ConnectionError(f"State backend is down, retrying it in {retry_in_seconds:.1f} s")
+            self.connecting = asyncio.get_running_loop().create_task(self.connect_or_mark_down())
+
+        if self.connecting is not None:
+            # Shielded, so one caller giving up doesn't cancel the attempt for the others
+            await asyncio.shield(self.connecting)
+
+    def disconnect(self, exception):
+        if self.writer is not None:
+            self.writer.close()
+        self.reader = None
+        self.writer = None
+
+        # The connection is gone, so these replies will never come
+        while self.pending_replies:
+            future = self.pending_replies.popleft()
+            if not future.done():
+                future.set_exception(exception)
+
+    async def read_reply(self, reader):
+        line = await reader.readuntil(b"\r\n")
+        reply_type, body = line[:1], line[1:-2]
+
+        if reply_type == b"+":
+            return body.decode("utf-8")
+        if reply_type == b"-":
+            return RedisError(body.decode("utf-8"))
+        if reply_type == b":":
+            return int(body)
+        if reply_type == b"$":
+            length = int(body)
+            if length < 0:
+                return None
+            return (await reader.readexactly(length + 2))[:-2].decode("utf-8")
+        if reply_type == b"*":
+            length = int(body)
+            if length < 0:
+                return None
+            return [await self.read_reply(reader) for _ in range(length)]
+
+        raise RedisError(f"Unexpected reply from the state backend: {line!r}")
+
+    # Hand each reply to the command waiting for it
+    async def read_replies(self, reader):
+        try:
+            while True:
+                reply = await self.read_reply(reader)
+                future = self.pending_replies.popleft()
+                # The command may have timed out, its reply still has to be read, to keep the rest in order
+                if future.done():
+                    continue
+                if isinstance(reply, RedisError):
+                    future.set_exception(reply)
+                else:
+                    future.set_result(reply)
+        except Exception as exception:
+            if reader is self.reader:
+                logging.warning("Lost connection to the state backend: %s", repr(exception))
+                self.disconnect(ConnectionError(f"Lost connection to the state backend: {exception!r}"))
+
+    async def send_command(self, *arguments):
+        future = asyncio.get_running_loop().create_future()
+        self.pending_replies.append(future)
+
+        encoded_arguments = [str(argument).encode("utf-8") for argument in arguments]
+        self.writer.write(
+            b"*%d\r\n" % len(encoded_arguments)
+            + b"".join(b"$%d\r\n%s\r\n" % (len(argument), argument) for argument in encoded_arguments)
+        )
+        await self.writer.drain()
+
+        return await asyncio.wait_for(future, self.timeout_seconds)
+
+    async def command(self, *arguments):
+        await self.ensure_connected()
+
+        try:
+            return await self.send_command(*arguments)
+        except asyncio.TimeoutError as exception:
+            # The server stopped answering, the commands queued behind this one won't get replies either
+            self.down_until = time.monotonic() + self.retry_seconds
+            self.disconnect(exception)
+            raise
+        except (ConnectionError, OSError) as exception:
+            self.disconnect(exception)
+            raise
+
+    async def get(self, key):
+        return await self.command("GET", self.key(key))
+
+    async def set(self, key, value, ttl_seconds):
+        await self.command("SET", self.key(key), value, "PX", max(1, int(ttl_seconds * 1000)))
+
+    async def set_if_absent(self, key, value, ttl_seconds):
+        return await self.command("SET", self.key(key), value, "PX", max(1, int(ttl_seconds * 1000)), "NX") is not None
+
+    async def renew_if_owner(self, key, value, ttl_seconds):
+        return await self.command("EVAL", REDIS_RENEW_IF_OWNER_SCRIPT, 1, self.key(key), value, max(1, int(ttl_seconds * 1000))) == 1
+
+    async def release_if_owner(self, key, value):
+        await self.command("EVAL", REDIS_RELEASE_IF_OWNER_SCRIPT, 1, self.key(key), value)
+
+    async def delete(self, key):
+        await self.command("DEL", self.key(key))
+
+    async def take_tokens(self, buckets):
+        keys = [self.key(f"rate_limit:{scope}:{key}") for scope, key, _, _ in buckets]
+        limits = []
+        for _, _, capacity, refill_per_second in buckets:
+            limits.extend([capacity, refill_per_second])
+
+        allowed, retry_after, index = await self.command("EVAL", REDIS_TAKE_TOKENS_SCRIPT, len(keys), *keys, *limits)
+        if allowed:
+            return True, 0.0, None
+
+        return False, None if retry_after == "blocked" else float(retry_after), buckets[index - 1][0]
+
+    async def hash_set(self, name, field, value):
+        await self.command("HSET", self.key(name), field, value)
+
+    async def hash_delete(self, name, field):
+        await self.command("HDEL", self.key(name), field)
+
+    async def hash_get_all(self, name):
+        reply = await self.command("HGETALL", self.key(name))
+        return dict(zip(reply[0::2], reply[1::2]))
+
+    async def close(self):
+        if self.reader_task is not None:
+            self.reader_task.cancel()
+            self.reader_task = None
+        self.disconnect(ConnectionError("State backend closed"))
+
+
+def create_state_backend(url):
+    scheme = urlsplit(url).scheme
+    if scheme == "memory":
+        return InMemoryStateBackend()
+    if scheme == "redis":
+        return RedisStateBackend(url)
+    raise ValueError(f"Unsupported STATE_BACKEND_URL scheme: {scheme}")
+
+
+# One state backend for the process
+state_backend = create_state_backend(STATE_BACKEND_URL)
+
+
+# Look up a value in a local cache, then in the shared state backend, which other replicas may have filled
+# Shared values are JSON, keyed on the namespace and the JSON of the cache key
+async def get_shared_cached(cache, namespace, key):
+    found, value = cache.get(key)
+    if found or not state_backend.shared:
+        return found, value
+
+    try:
+        stored_value = await state_backend.get(f"{namespace}:{json.dumps(key)}")
+    except Exception as exception:
+        state_backend_errors.inc("get")
+        logging.warning("State backend get failed: %s", repr(exception))
+        return False, None
+
+    if stored_value is None:
+        return False, None
+
+    value = json.loads(stored_value)
+    cache.set(key, value, positive=bool(value))
+    return True, value
+
+
+# Set a value in a local cache, and in the shared state backend, with the cache's TTL
+async def set_shared_cached(cache, namespace, key, value, positive=True):
+    cache.set(key, value, positive=positive)
+    if not state_backend.shared:
+        return
+
+    ttl_seconds = cache.positive_ttl_seconds if positive else cache.negative_ttl_seconds
+    if ttl_seconds <= 0:
+        return
+
+    try:
+        await state_backend.set(f"{namespace}:{json.dumps(key)}", json.dumps(value), ttl_seconds)
+    except Exception as exception:
+        state_backend_errors.inc("set")
+        logging.warning("State backend set failed: %s", repr(exception))
+
+
+async def invalidate_shared_cached(cache, namespace, key):
+    cache.invalidate(key)
+    if not state_backend.shared:
+        return
+
+    try:
+        await state_backend.delete(f"{namespace}:{json.dumps(key)}")
+    except Exception as exception:
+        state_backend_errors.inc("delete")
+        logging.warning("State backend delete failed: %s", repr(exception))
+
+
+rate_limited_requests = Counter("discordbot_rate_limited_requests_total", "embedding commands rejected by the rate limits, by scope", "scope")
+
+# Rate limits to fall back on if the shared state backend is down, so we don't turn everyone away, or let everyone through
+fallback_rate_limits = InMemoryStateBackend()
+
+
+# Check the user's and the guild's rate limits, and spend a token from each if both allow it
+# The buckets are in the shared state backend, so a user gets the same limit whichever replica their command lands on
+# Returns (allowed, retry_after_seconds, scope), retry_after_seconds is None if the limit never refills, ie. *_PER_MINUTE is 0
+async def check_rate_limits(user_id, guild_id):
+    buckets = [("user", str(user_id), USER_RATE_LIMIT_BURST, USER_RATE_LIMIT_PER_MINUTE / 60)]
+    if guild_id is not None:
+        buckets.append(("guild", str(guild_id), GUILD_RATE_LIMIT_BURST, GUILD_RATE_LIMIT_PER_MINUTE / 60))
+
+    try:
+        allowed, retry_after, scope = await state_backend.take_tokens(buckets)
+    except Exception as exception:
+        state_backend_errors.inc("take_tokens")
+        logging.warning("State backend rate limit check failed, using this replica's rate limits: %s", repr(exception))
+        allowed, retry_after, scope = await fallback_rate_limits.take_tokens(buckets)
+
+    if not allowed:
+        rate_limited_requests.inc(scope)
+
+    return allowed, retry_after, scope
+
+
+# When to tell a rate limited user to try again
+def describe_rate_limit_retry(retry_after):
+    if retry_after is None:
+        return "and this limit doesn't reset on its own, please tag us for support."
+    return f"please retry in {math.ceil(retry_after)} s."
+
+
+# How long to keep the rate limit message around, at least until the user can retry
+def rate_limit_message_lifetime(retry_after):
+    if retry_after is None:
+        return 60
+    return max(60, math.ceil(retry_after))
+
+
+class AdmissionQueueFull(Exception):
+    pass
+
+
+# Concurrency limiter with a bounded, first in first out wait queue
+# Callers over max_active wait in line, and are told their position, callers over max_waiting are turned away
+class AdmissionQueue:
+
+    def __init__(self, max_active, max_waiting):
+        self.max_active     = max(1, max_active)
+        self.max_waiting    = max_waiting
+        self.active         = 0
+        self.waiters        = deque()
+
+    # Wait for a slot, calling on_queued(position) if we have to wait in line
+    # Raises AdmissionQueueFull if the line is already full
+    @asynccontextmanager
+    async def slot(self, on_queued=None):
+        if self.active < self.max_active and not self.waiters:
+            self.active += 1
+        else:
+            if len(self.waiters) >= self.max_waiting:
+                raise AdmissionQueueFull()
+
+            future = asyncio.get_running_loop().create_future()
+            self.waiters.append(future)
+
+            try:
+                if on_queued is not None:
+                    await on_queued(len(self.waiters))
+                # release() hands its slot straight to us
+                await future
+            except BaseException:
+                if future.done() and not future.cancelled():
+                    # We were handed a slot, but can't use it, so pass it on
+                    self.release()
+                else:
+                    future.cancel()
+                    if future in self.waiters:
+                        self.waiters.remove(future)
+                raise
+
+        try:
+            yield
+        finally:
+            self.release()
+
+    def release(self):
+        while self.waiters:
+            future = self.waiters.popleft()
+            if not future.done():
+                future.set_result(None)
+                return
+        self.active -= 1
+
+
+# Limits how many embedding commands are submitting to Sourcegraph at once, the rest wait in line
+embedding_submission_queue = AdmissionQueue(EMBEDDING_MAX_CONCURRENT_SUBMISSIONS, EMBEDDING_MAX_QUEUED_SUBMISSIONS)
+Gauge("discordbot_embedding_submissions_active", "embedding commands currently submitting to Sourcegraph", lambda: embedding_submission_queue.active)
+Gauge("discordbot_embedding_submissions_queued", "embedding commands waiting in line to submit to Sourcegraph", lambda: len(embedding_submission_queue.waiters))
+
+# Command worker pool lanes, highest priority first
+# Retries go first, as the user has already waited once, and bulk commands go last, as they're long and nobody's watching them closely
+COMMAND_LANE_RETRY      = "retry"
+COMMAND_LANE_SINGLE     = "single"
+COMMAND_LANE_BULK       = "bulk"
+COMMAND_LANES           = (COMMAND_LANE_RETRY, COMMAND_LANE_SINGLE, COMMAND_LANE_BULK)
+
+
+class CommandQueueFull(Exception):
+    pass
+
+
+# Fixed size pool of workers, processing commands after the handlers have acknowledged them
+# Keeps the number of commands in progress bounded, however many arrive at once, and acknowledgements fast, however slow the work is
+# Each lane is first in first out, and workers take from the highest priority lane that has work, and is under its limit
+class CommandWorkPool:
+
+    def __init__(self, worker_count, max_queued, lane_max_active):
+        self.worker_count       = max(1, worker_count)
+        self.max_queued         = max_queued
+        # lane: the most workers it can take at once, lanes not in here can take them all
+        self.lane_max_active    = lane_max_active
+        # lane: deque of (queued_at, log_request_id, log_user_id, function, args)
+        self.lanes              = {lane: deque() for lane in COMMAND_LANES}
+        self.active             = {lane: 0 for lane in COMMAND_LANES}
+        self.workers            = []
+        self.accepting          = True
+        # Set when there may be work a waiting worker can take
+        self.work_available     = asyncio.Event()
+        # Set when nothing is queued or running, for draining on shutdown
+        self.idle               = asyncio.Event()
+        self.idle.set()
+
+    def queued(self):
+        return sum(len(jobs) for jobs in self.lanes.values())
+
+    # Queue function(*args) to run on a worker, returns how many commands are ahead of it
+    # Raises CommandQueueFull if the queue is full, or we're shutting down
+    def submit(self, lane, function, *args):
+        if not self.accepting or self.queued() >= self.max_queued:
+            raise CommandQueueFull()
+
+        # Jobs ahead of this one, in this lane and the higher priority lanes
+        position = 0
+        for queued_lane in COMMAND_LANES:
+            position += len(self.lanes[queued_lane])
+            if queued_lane == lane:
+                break
+
+        # Carry the command's log context over to the worker
+        self.lanes[lane].append((time.monotonic(), log_request_id.get(), log_user_id.get(), function, args))
+        self.idle.clear()
+        self.work_available.set()
+        return position
+
+    def next_job(self):
+        for lane in COMMAND_LANES:
+            if self.lanes[lane] and self.active[lane] < self.lane_max_active.get(lane, self.worker_count):
+                return lane, self.lanes[lane].popleft()
+        return None, None
+
+    async def worker(self):
+        while True:
+            lane, job = self.next_job()
+            if job is None:
+                self.work_available.clear()
+                await self.work_available.wait()
+                continue
+
+            queued_at, request_id, user_id, function, args = job
+            command_queue_wait_seconds.observe(time.monotonic() - queued_at, lane)
+            log_request_id.set(request_id)
+            log_user_id.set(user_id)
+
+            self.active[lane] += 1
+            try:
+                await function(*args)
+            except Exception as exception:
+                logging.exception(exception)
+            finally:
+                self.active[lane] -= 1
+                # A lane under its limit again may let a waiting worker take its next job
+                self.work_available.set()
+                if not self.queued() and not any(self.active.values()):
+                    self.idle.set()
+
+    def start(self):
+        self.accepting = True
+        loop = asyncio.get_running_loop()
+        while len(self.workers) < self.worker_count:
+            self.workers.append(loop.create_task(self.worker()))
+
+    # Wait until nothing is queued or running
+    async def join(self):
+        await self.idle.wait()
+
+    # Stop taking new commands, give the queued and running ones up to drain_seconds to finish, then stop the workers
+    async def stop(self, drain_seconds):
+        self.accepting = False
+
+        # Nothing to drain, so don't wait, or warn, even with no time to drain in
+        if not self.idle.is_set():
+            try:
+                await asyncio.wait_for(self.join(), drain_seconds)
+            except asyncio.TimeoutError:
+                logging.warning(
+                    "Shutting down with %d queued and %d running commands unfinished",
+                    self.queued(),
+                    sum(self.active.values()),
+                )
+
+        for worker in self.workers:
+            worker.cancel()
+        await asyncio.gather(*self.workers, return_exceptions=True)
+        self.workers = []
+
+
+command_queue_wait_seconds = Histogram(
+    "discordbot_command_queue_wait_seconds",
+    "Time commands waited in the queue for a worker, by lane",
+    label_name="lane",
+    label_values=COMMAND_LANES,
+)
+
+# One worker pool for the process, started by main()
+command_work_pool = CommandWorkPool(COMMAND_WORKERS, COMMAND_MAX_QUEUED, {COMMAND_LANE_BULK: COMMAND_MAX_ACTIVE_BULK})
+Gauge("discordbot_command_workers_busy", "Command workers currently processing a command", lambda: sum(command_work_pool.active.values()))
+Gauge(
+    "discordbot_command_queue_depth",
+    "Commands waiting in the queue for a worker, by lane",
+    lambda: {lane: len(jobs) for lane, jobs in command_work_pool.lanes.items()},
+    label_name="lane",
+)
+
+# Limits how many GraphQL requests are in flight to the Sourcegraph instance at once, using our site-admin SG_TOKEN
+sourcegraph_call_semaphore = asyncio.Semaphore(SOURCEGRAPH_MAX_CONCURRENT_CALLS)
+
+
+# Sourcegraph GraphQL client resilience settings
+# Deadline, in seconds, for each attempt, so one slow request can't use up the whole command
+SOURCEGRAPH_ATTEMPT_TIMEOUT_SECONDS     = float(os.environ.get("SOURCEGRAPH_ATTEMPT_TIMEOUT_SECONDS", "10"))
+# The most attempts for each GraphQL request, including the first
+SOURCEGRAPH_MAX_ATTEMPTS                = int(os.environ.get("SOURCEGRAPH_MAX_ATTEMPTS", "3"))
+# Backoff between attempts, doubling from the base delay up to the max delay, with full jitter
+# If Sourcegraph asks us to wait longer than the max delay with Retry-After, give up instead of holding the command open
+SOURCEGRAPH_RETRY_BASE_DELAY_SECONDS    = float(os.environ.get("SOURCEGRAPH_RETRY_BASE_DELAY_SECONDS", "0.5"))
+SOURCEGRAPH_RETRY_MAX_DELAY_SECONDS     = float(os.environ.get("SOURCEGRAPH_RETRY_MAX_DELAY_SECONDS", "10"))
+# After this many failed attempts in a row, stop sending requests to the Sourcegraph instance for the reset time,
+# then let one request through to see if it's recovered
+SOURCEGRAPH_CIRCUIT_FAILURE_THRESHOLD   = int(os.environ.get("SOURCEGRAPH_CIRCUIT_FAILURE_THRESHOLD", "5"))
+SOURCEGRAPH_CIRCUIT_RESET_SECONDS       = float(os.environ.get("SOURCEGRAPH_CIRCUIT_RESET_SECONDS", "30"))
+
+# HTTP statuses that mean try again later, rather than don't try again
+SOURCEGRAPH_RETRYABLE_STATUSES = frozenset([429, 500, 502, 503, 504])
+
+
+# Raised instead of sending a request, while the circuit breaker for the Sourcegraph instance is open
+class SourcegraphUnavailable(Exception):
+
+    def __init__(self, retry_after):
+        super().__init__(f"Sourcegraph instance is degraded, not sending requests for {math.ceil(retry_after)} s")
+        self.retry_after = retry_after
+
+
+# Tracks consecutive failed attempts to one Sourcegraph instance, and fails fast while it's down,
+# so commands get a quick answer instead of stacking up slow requests against it
+class CircuitBreaker:
+
+    def __init__(self, name, failure_threshold=SOURCEGRAPH_CIRCUIT_FAILURE_THRESHOLD, reset_seconds=SOURCEGRAPH_CIRCUIT_RESET_SECONDS):
+        self.name                   = name
+        self.failure_threshold      = max(1, failure_threshold)
+        self.reset_seconds          = reset_seconds
+        self.consecutive_failures   = 0
+        # time.monotonic() when the circuit opened, or None while it's closed
+        self.opened_at              = None
+        # While the circuit is half open, only one trial request goes through
+        self.trial_in_flight        = False
+
+    def is_open(self):
+        return self.opened_at is not None
+
+    # Call before each attempt, raises SourcegraphUnavailable if the attempt shouldn't be sent
+    def before_call(self):
+        if self.opened_at is None:
+            return
+
+        remaining = self.opened_at + self.reset_seconds - time.monotonic()
+        if remaining > 0 or self.trial_in_flight:
+            raise SourcegraphUnavailable(max(remaining, 1))
+
+        self.trial_in_flight = True
+
+    def record_success(self):
+        if self.opened_at is not None:
+            logging.warning("Sourcegraph instance %s recovered, closing circuit breaker", self.name)
+        self.consecutive_failures   = 0
+        self.opened_at              = None
+        self.trial_in_flight        = False
+
+    def record_failure(self):
+        self.consecutive_failures   += 1
+        self.trial_in_flight        = False
+
+        # A failed trial request re-opens the circuit for another reset period
+        if self.opened_at is not None or self.consecutive_failures >= self.failure_threshold:
+            if self.opened_at is None:
+                logging.warning(
+                    "Sourcegraph instance %s failed %d times in a row, opening circuit breaker for %s s",
+                    self.name,
+                    self.consecutive_failures,
+                    self.reset_seconds,
+                )
+            self.opened_at = time.monotonic()
+
+    # The attempt didn't tell us anything about the instance's health, ie. it was cancelled, or rate limited
+    def release(self):
+        self.trial_in_flight = False
+
+
+# One circuit breaker per Sourcegraph GraphQL endpoint
+sourcegraph_circuit_breakers = {}
+Gauge(
+    "discordbot_sourcegraph_circuit_breakers_open",
+    "Sourcegraph instances currently failing fast because their circuit breaker is open",
+    lambda: sum(breaker.is_open() for breaker in sourcegraph_circuit_breakers.values()),
+)
+
+
+# Parse a Retry-After header, which is either a number of seconds, or an HTTP date
+# Returns the number of seconds to wait, or None if there's no usable header
+def parse_retry_after(value):
+    if not value:
+        return None
+
+    try:
+        return max(0.0, float(value))
+    except ValueError:
+        pass
+
+    try:
+        retry_at = parsedate_to_datetime(value)
+    except (TypeError, ValueError):
+        return None
+
+    if retry_at.tzinfo is None:
+        retry_at = retry_at.replace(tzinfo=timezone.utc)
+
+    return max(0.0, retry_at.timestamp() - time.time())
+
+
+# How long to wait before the next attempt, or None if it's not worth waiting
+def sourcegraph_retry_delay(attempt, retry_after):
+    if retry_after is not None:
+        if retry_after > SOURCEGRAPH_RETRY_MAX_DELAY_SECONDS:
+            return None
+        return retry_after
+
+    # Full jitter, so commands that failed together don't all retry together
+    return random.uniform(0, min(SOURCEGRAPH_RETRY_MAX_DELAY_SECONDS, SOURCEGRAPH_RETRY_BASE_DELAY_SECONDS * 2 ** (attempt - 1)))
+
+
+# Post a GraphQL request to the Sourcegraph instance, retrying transient failures, behind its circuit breaker
+# Returns the (status, text) of the last response, raises the last exception if no attempt got a response,
+# and raises SourcegraphUnavailable without sending anything if the circuit breaker is open
+# Requests that aren't idempotent are only retried if Sourcegraph can't have acted on them:
+# the connection never opened, or we were rate limited
+async def request_sourcegraph_graphql(query_body, sg_server_api, idempotent=True):
+    breaker = sourcegraph_circuit_breakers.get(sg_server_api)
+    if breaker is None:
+        breaker = CircuitBreaker(sg_server_api)
+        sourcegraph_circuit_breakers[sg_server_api] = breaker
+
+    session = await create_http_session()
+    attempt = 0
+
+    while True:
+        attempt += 1
+        breaker.before_call()
+
+        response_status = None
+        retry_after = None
+
+        try:
+            async with sourcegraph_call_semaphore, session.post(
+                url=sg_server_api,
+                json={"query": query_body},
+                headers={"Authorization": f"token {SG_TOKEN}"},
+                timeout=aiohttp.ClientTimeout(
+                    total=SOURCEGRAPH_ATTEMPT_TIMEOUT_SECONDS,
+                    connect=HTTP_CONNECT_TIMEOUT,
+                ),
+            ) as response:
+                response_status = response.status
+                response_text = await response.text()
+                retry_after = parse_retry_after(response.headers.get("Retry-After"))
+
+        except (asyncio.TimeoutError, aiohttp.ClientError) as exception:
+            breaker.record_failure()
+            retry_reason = "timeout" if isinstance(exception, asyncio.TimeoutError) else "connection"
+            retryable = idempotent or isinstance(exception, aiohttp.ClientConnectorError)
+            if not retryable or attempt >= SOURCEGRAPH_MAX_ATTEMPTS:
+                raise
+
+        except BaseException:
+            breaker.release()
+            raise
+
+        else:
+            if response_status not in SOURCEGRAPH_RETRYABLE_STATUSES:
+                # Any other response, even a 4xx, means the instance is up
+                breaker.record_success()
+                return response_status, response_text
+
+            # 429 means we're sending too much, not that the instance is down
+            if response_status == 429:
+                breaker.release()
+            else:
+                breaker.record_failure()
+
+            retry_reason = f"http_{response_status}"
+            retryable = idempotent or response_status == 429
+            if not retryable or attempt >= SOURCEGRAPH_MAX_ATTEMPTS:
+                return response_status, response_text
+
+        # Only a response can ask us to wait too long, so there's always a response to return here
+        delay = sourcegraph_retry_delay(attempt, retry_after)
+        if delay is None:
+            return response_status, response_text
+
+        graphql_retries.inc(retry_reason)
+        logging.info("Retrying GraphQL request to %s in %.2f s, after attempt %d failed: %s", sg_server_api, delay, attempt, retry_reason)
+        await asyncio.sleep(delay)
+
+
+# Send the GraphQL API mutation to the Sourcegraph instance
+# Accepts a list of sanitized repo urls, so the batcher below can schedule several repos in one round trip
+# Returns success, a message for the user, and whether the Sourcegraph server rejected the repos
+# (as opposed to the request not making it to the server), so the batcher knows if splitting the batch could help
+# force asks Sourcegraph to rebuild the embeddings, even if they're up to date
+async def send_graphql_request(sanitized_repo_urls, sg_server_api, force=False):
+    graphql_response_message = ""
+    success = False
+    rejected = False
+
+    # json.dumps quotes and escapes each repo name for us
+    repo_names = ", ".join(json.dumps(repo_url) for repo_url in sanitized_repo_urls)
+
+    # Only send force when the user asked for a rebuild, otherwise leave it to the server's default
+    force_argument = "\n                force: true" if force else ""
+
+    queryBody = f"""
+        mutation {{
+            scheduleRepositoriesForEmbedding(
+                repoNames: [
+            {repo_names}
+                ]{force_argument}
+            ) {{
+                alwaysNil
+            }}
+        }}
+    """
+
+    # Try / except block for GraphQL mutation
+    # Scheduling a repo that's already queued doesn't queue it again, so the mutation is safe to retry, unless it's forced
+    start = time.perf_counter()
+    try:
+        response_status, response_text = await request_sourcegraph_graphql(
+            queryBody,
+            sg_server_api,
+            idempotent=not force,
+        )
+
+    except SourcegraphUnavailable as exception:
+        graphql_request_seconds.observe(time.perf_counter() - start)
+        graphql_errors.inc("circuit_open")
+        logging.warning("GraphQL query not sent: %s", exception)
+        graphql_response_message = (
+            "⚠️ The Sourcegraph server looks degraded right now, so I didn't send the request. "
+            + f"Please try again in {math.ceil(exception.retry_after)} s."
+        )
+        success = False
+        return success, graphql_response_message, rejected
+
+    except asyncio.TimeoutError as exception:
+        graphql_request_seconds.observe(time.perf_counter() - start)
+        graphql_errors.inc("timeout")
+        logging.exception("GraphQL query timed out: %s", exception)
+        graphql_response_message = "⚠️ Timed out submitting embeddings job to the Sourcegraph server, please try again!"
+        success = False
+        return success, graphql_response_message, rejected
+
+    except Exception as exception:
+        graphql_request_seconds.observe(time.perf_counter() - start)
+        graphql_errors.inc("connection")
+        logging.exception("GraphQL query failed: %s", exception)
+        graphql_response_message = "⚠️ Failed to connect to the Sourcegraph server, please try again!"
+        success = False
+        return success, graphql_response_message, rejected
+
+    graphql_request_seconds.observe(time.perf_counter() - start)
+
+    if response_status == 200:
+        logging.debug("GraphQL query connection succeeded: %s %s", response_status, response_text)
+        success = True
+        response_json = json.loads(response_text)
+
+        if response_json.get("errors"):
+            logging.error("GraphQL query returned errors: %s", response_text)
+            graphql_errors.inc("graphql_errors")
+            success = False
+            rejected = True
+            errors = response_json.get("errors")
+
+            # GraphQL returns the error messages in an array
+            messages = []
+            for error in errors:
+                messages.append(str(error.get("message")))
+            graphql_response_message = "\n".join(messages)
+
+    else:
+        logging.error("GraphQL query connection failed: %s %s", response_status, response_text)
+        graphql_response_message = "Sourcegraph server returned HTTP " + str(response_status)
+        graphql_errors.inc("http_status")
+        success = False
+
+    return success, graphql_response_message, rejected
+
+
+# Micro-batching settings for embeddings submissions
+# How long, in seconds, to wait for more repos to arrive before sending a batch
+EMBEDDING_BATCH_WINDOW_SECONDS  = float(os.environ.get("EMBEDDING_BATCH_WINDOW_SECONDS", "0.5"))
+# The most repos to send in one scheduleRepositoriesForEmbedding mutation
+# Single commands can only fill a batch up to EMBEDDING_MAX_CONCURRENT_SUBMISSIONS, see above
+EMBEDDING_BATCH_MAX_SIZE        = int(os.environ.get("EMBEDDING_BATCH_MAX_SIZE", "50"))
+# The size the shared batchers send at, and the size of the chunks bulk commands submit, so each chunk fills one batch
+EMBEDDING_SHARED_BATCH_SIZE     = max(1, min(EMBEDDING_BATCH_MAX_SIZE, EMBEDDING_MAX_CONCURRENT_SUBMISSIONS))
+
+
+# Collects the sanitized repo urls submitted within a short window, and sends them in one mutation
+# Each caller of submit() waits for, and gets back, the result for its own repo
+class EmbeddingSubmissionBatcher:
+
+    def __init__(self, sg_server_api, force=False, window_seconds=EMBEDDING_BATCH_WINDOW_SECONDS, max_size=EMBEDDING_BATCH_MAX_SIZE):
+        self.sg_server_api  = sg_server_api
+        self.force          = force
+        self.window_seconds = window_seconds
+        self.max_size       = max(1, max_size)
+        # List of (sanitized_repo_url, future) waiting for the next batch
+        self.pending        = []
+        self.flush_timer    = None
+        # Keep references to the in-flight batch tasks, so they aren't garbage collected
+        self.batch_tasks    = set()
+
+    # Queue a repo for the next batch, and wait for its result
+    async def submit(self, sanitized_repo_url):
+        loop = asyncio.get_running_loop()
+        future = loop.create_future()
+        self.pending.append((sanitized_repo_url, future))
+
+        # Send the batch now if it's full, otherwise start the window timer for the first repo in the batch
+        if len(self.pending) >= self.max_size:
+            self.flush()
+        elif self.flush_timer is None:
+            self.flush_timer = loop.call_later(self.window_seconds, self.flush)
+
+        return await future
+
+    # Send whatever is pending as one batch
+    def flush(self):
+        if self.flush_timer is not None:
+            self.flush_timer.cancel()
+            self.flush_timer = None
+
+        if not self.pending:
+            return
+
+        batch = self.pending
+        self.pending = []
+
+        task = asyncio.get_running_loop().create_task(self.send_batch(batch))
+        self.batch_tasks.add(task)
+        task.add_done_callback(self.batch_tasks.discard)
+
+    async def send_batch(self, batch):
+        # Several users may have asked for the same repo in the same window, only send it once
+        sanitized_repo_urls = list(dict.fromkeys(repo_url for repo_url, _ in batch))
+        logging.info("Submitting batch of %d repos for embeddings", len(sanitized_repo_urls))
+
+        try:
+            results = await self.submit_repos(sanitized_repo_urls)
+        except Exception as exception:
+            logging.exception(exception)
+            results = {}
+            for repo_url in sanitized_repo_urls:
+                results[repo_url] = (False, "⚠️ Error submitting embeddings job, please try again!")
+
+        # Hand each waiting caller its own result
+        for repo_url, future in batch:
+            if not future.done():
+                future.set_result(results[repo_url])
+
+    # Submit a list of repos, and return a dict of repo_url: (success, message)
+    async def submit_repos(self, sanitized_repo_urls):
+        success, graphql_response_message, rejected = await send_graphql_request(
+            sanitized_repo_urls,
+            self.sg_server_api,
+            force=self.force,
+        )
+
+        # If the server rejected a batch of more than one repo, we don't know which repo(s) it didn't like
+        # Split the batch in half and retry each half, until the bad repos are isolated
+        # Connection failures and timeouts would fail the same way for every repo, so don't split those
+        if not success and rejected and len(sanitized_repo_urls) > 1:
+            middle = len(sanitized_repo_urls) // 2
+            first_half_results, second_half_results = await asyncio.gather(
+                self.submit_repos(sanitized_repo_urls[:middle]),
+                self.submit_repos(sanitized_repo_urls[middle:]),
+            )
+            return {**first_half_results, **second_half_results}
+
+        results = {}
+        for repo_url in sanitized_repo_urls:
+            results[repo_url] = (success, graphql_response_message)
+        return results
+
+
+# One batcher per Sourcegraph GraphQL endpoint, and per force, as force applies to the whole mutation
+embedding_submission_batchers = {}
+
+# Concurrent submissions of the same repo to the same Sourcegraph instance share one submission
+embedding_submission_single_flight = SingleFlight()
+
+# How long, in seconds, after a successful submission to tell later requesters the repo is already queued, instead of scheduling it again
+RECENTLY_SUBMITTED_WINDOW_SECONDS = float(os.environ.get("RECENTLY_SUBMITTED_WINDOW_SECONDS", "600"))
+
+# Repos recently submitted successfully, keyed on (sg_server_api, sanitized_repo_url)
+recently_submitted_repos = TTLCache(10000, RECENTLY_SUBMITTED_WINDOW_SECONDS, 0)
+
+
+# Check if this repo was successfully submitted to this Sourcegraph instance within the last RECENTLY_SUBMITTED_WINDOW_SECONDS, by any replica
+async def is_recently_submitted(sanitized_repo_url, sg_server_api):
+    found, _ = await get_shared_cached(recently_submitted_repos, "recently_submitted", (sg_server_api, sanitized_repo_url))
+    return found
+
+
+async def mark_recently_submitted(sanitized_repo_url, sg_server_api):
+    await set_shared_cached(recently_submitted_repos, "recently_submitted", (sg_server_api, sanitized_repo_url), True)
+
+
+# Submit a sanitized repo url for embeddings, batched with any other repos submitted around the same time
+async def submit_embedding_request(sanitized_repo_url, sg_server_api, force=False):
+    return await embedding_submission_single_flight.do(
+        (sg_server_api, sanitized_repo_url, force),
+        submit_embedding_request_to_batcher,
+        sanitized_repo_url,
+        sg_server_api,
+        force,
+    )
+
+
+async def submit_embedding_request_to_batcher(sanitized_repo_url, sg_server_api, force=False):
+    batcher = embedding_submission_batchers.get((sg_server_api, force))
+    if batcher is None:
+        # Every repo from a single command holds a submission slot while it waits, so once all the slots are in the batch, no more can join it
+        batcher = EmbeddingSubmissionBatcher(sg_server_api, force=force, max_size=EMBEDDING_SHARED_BATCH_SIZE)
+        embedding_submission_batchers[(sg_server_api, force)] = batcher
+
+    success, graphql_response_message = await batcher.submit(sanitized_repo_url)
+
+    # Remember successful submissions, so repeat requests in the next few minutes don't schedule the job again
+    # and check the embeddings' freshness again once the job's done, rather than trusting the cache
+    if success:
+        await mark_recently_submitted(sanitized_repo_url, sg_server_api)
+        await invalidate_shared_cached(embeddings_freshness_cache, "embeddings_fresh", (sg_server_api, sanitized_repo_url))
+
+    return success, graphql_response_message
+
+
+# Post a GraphQL query to the Sourcegraph instance, and return the parsed response json
+# Transient failures are retried, then it raises on connection failures, timeouts, non-200 responses,
+# and SourcegraphUnavailable, so background callers can decide whether to retry later
+async def post_graphql_query(query_body, sg_server_api):
+    response_status, response_text = await request_sourcegraph_graphql(query_body, sg_server_api)
+
+    if response_status != 200:
+        raise RuntimeError(
+            "GraphQL query connection failed: "
+            + str(response_status)
+            + response_text
+        )
+
+    return json.loads(response_text)
+
+
+# Aliased query batching settings
+# How long, in seconds, to collect lookups from concurrent commands before sending them in one GraphQL query
+ALIASED_QUERY_BATCH_WINDOW_SECONDS  = float(os.environ.get("ALIASED_QUERY_BATCH_WINDOW_SECONDS", "0.05"))
+# The most repos to look up in one GraphQL query
+ALIASED_QUERY_BATCH_MAX_SIZE        = int(os.environ.get("ALIASED_QUERY_BATCH_MAX_SIZE", "100"))
+
+
+# Coalesces per-repo lookups from concurrent callers into one GraphQL query, with aliased fields per repo
+# build_fields(alias, repo_name) returns the GraphQL fields to query for a repo, ie. alias: repository(name: "...") { id }
+# A repo can have more than one field, as long as the extra aliases start with alias + "_"
+# parse_fields(data, alias, repo_name) turns the response data into the result for that repo
+# Callers get None back if the lookup failed, so they can decide whether to carry on without it
+class AliasedQueryBatcher:
+
+    def __init__(self, sg_server_api, build_fields, parse_fields, window_seconds=ALIASED_QUERY_BATCH_WINDOW_SECONDS, max_size=ALIASED_QUERY_BATCH_MAX_SIZE):
+        self.sg_server_api  = sg_server_api
+        self.build_fields   = build_fields
+        self.parse_fields   = parse_fields
+        self.window_seconds = window_seconds
+        self.max_size       = max(1, max_size)
+        # repo_name: list of futures waiting on it
+        self.pending        = {}
+        self.flush_timer    = None
+        self.batch_tasks    = set()
+
+    async def lookup(self, repo_name):
+        loop = asyncio.get_running_loop()
+        future = loop.create_future()
+        self.pending.setdefault(repo_name, []).append(future)
+
+        if len(self.pending) >= self.max_size:
+            self.flush()
+        elif self.flush_timer is None:
+            self.flush_timer = loop.call_later(self.window_seconds, self.flush)
+
+        return await future
+
+    def flush(self):
+        if self.flush_timer is not None:
+            self.flush_timer.cancel()
+            self.flush_timer = None
+
+        if not self.pending:
+            return
+
+        batch = self.pending
+        self.pending = {}
+
+        task = asyncio.get_running_loop().create_task(self.send_batch(batch))
+        self.batch_tasks.add(task)
+        task.add_done_callback(self.batch_tasks.discard)
+
+    async def send_batch(self, batch):
+        repo_names = list(batch)
+        results = {}
+
+        try:
+            query_body = "query {\n" + "\n".join(
+                self.build_fields(f"repo{index}", repo_name)
+                for index, repo_name in enumerate(repo_names)
+            ) + "\n}"
+            response_json = await post_graphql_query(query_body, self.sg_server_api)
+
+            # A field that errored is unknown, rather than empty
+            errored_aliases = set()
+            for error in response_json.get("errors") or []:
+                path = error.get("path") or []
+                if path:
+                    # Map repo0_jobs back to repo0
+                    errored_aliases.add(str(path[0]).split("_", 1)[0])
+                else:
+                    raise RuntimeError(f"GraphQL query returned errors: {response_json.get('errors')}")
+
+            data = response_json.get("data") or {}
+            for index, repo_name in enumerate(repo_names):
+                alias = f"repo{index}"
+                if alias in errored_aliases or alias not in data:
+                    results[repo_name] = None
+                else:
+                    results[repo_name] = self.parse_fields(data, alias, repo_name)
+
+        except Exception as exception:
+            logging.warning("Aliased GraphQL query failed: %s", exception)
+
+        for repo_name, futures in batch.items():
+            for future in futures:
+                if not future.done():
+                    future.set_result(results.get(repo_name))
+
+
+# Repo presence settings
+# How long, in seconds, to remember that a repo is, or isn't, on the Sourcegraph instance
+REPO_PRESENCE_CACHE_POSITIVE_TTL    = float(os.environ.get("REPO_PRESENCE_CACHE_POSITIVE_TTL", "3600"))
+REPO_PRESENCE_CACHE_NEGATIVE_TTL    = float(os.environ.get("REPO_PRESENCE_CACHE_NEGATIVE_TTL", "300"))
+
+# Repo presence results, keyed on (sg_server_api, repo_name)
+repo_presence_cache = TTLCache(10000, REPO_PRESENCE_CACHE_POSITIVE_TTL, REPO_PRESENCE_CACHE_NEGATIVE_TTL)
+Counter("discordbot_repo_presence_cache_hits_total", "Sourcegraph repo presence cache hits", function=lambda: repo_presence_cache.hits)
+Counter("discordbot_repo_presence_cache_misses_total", "Sourcegraph repo presence cache misses", function=lambda: repo_presence_cache.misses)
+
+
+# Embeddings freshness settings
+# How long, in seconds, to remember that a repo's embeddings are, or aren't, up to date with its default branch
+# Stale results are kept for less time, as the repo's embeddings job may be about to finish
+EMBEDDINGS_FRESHNESS_CACHE_POSITIVE_TTL = float(os.environ.get("EMBEDDINGS_FRESHNESS_CACHE_POSITIVE_TTL", "600"))
+EMBEDDINGS_FRESHNESS_CACHE_NEGATIVE_TTL = float(os.environ.get("EMBEDDINGS_FRESHNESS_CACHE_NEGATIVE_TTL", "60"))
+# How many of the latest completed embeddings jobs to look through for this repo's
+# repoEmbeddingJobs(query: ...) is a substring match, so it can return jobs for other repos with similar names
+EMBEDDINGS_FRESHNESS_JOBS_TO_CHECK      = 10
+
+# Embeddings freshness results, keyed on (sg_server_api, repo_name)
+embeddings_freshness_cache = TTLCache(10000, EMBEDDINGS_FRESHNESS_CACHE_POSITIVE_TTL, EMBEDDINGS_FRESHNESS_CACHE_NEGATIVE_TTL)
+Counter("discordbot_embeddings_freshness_cache_hits_total", "Embeddings freshness cache hits", function=lambda: embeddings_freshness_cache.hits)
+Counter("discordbot_embeddings_freshness_cache_misses_total", "Embeddings freshness cache misses", function=lambda: embeddings_freshness_cache.misses)
+
+
+
+# Query whether the repo is on the instance, whether it has embeddings, the commit at the head of its default branch,
+# and the commit its latest completed embeddings jobs indexed, so one query answers both the presence and freshness checks
+def build_repo_status_fields(alias, repo_name):
+    quoted_repo_name = json.dumps(repo_name)
+    return (
+        f"{alias}: repository(name: {quoted_repo_name}) "
+        "{ id embeddingExists defaultBranch { target { oid } } }\n"
+        f"{alias}_jobs: repoEmbeddingJobs(first: {EMBEDDINGS_FRESHNESS_JOBS_TO_CHECK}, query: {quoted_repo_name}, state: \"COMPLETED\") "
+        "{ nodes { repo { name } revision { oid } } }"
+    )
+
+
+# The embeddings are fresh if they exist, and the latest completed job for this repo indexed the head of the default branch
+def parse_embeddings_freshness_fields(data, alias, repo_name):
+    repository = data[alias]
+    if repository is None or not repository.get("embeddingExists"):
+        return False
+
+    head_commit = ((repository.get("defaultBranch") or {}).get("target") or {}).get("oid")
+    if not head_commit:
+        return False
+
+    for job in (data.get(f"{alias}_jobs") or {}).get("nodes") or []:
+        if (job.get("repo") or {}).get("name") != repo_name:
+            continue
+        return (job.get("revision") or {}).get("oid") == head_commit
+
+    return False
+
+
+# Returns (present, fresh) for the repo
+def parse_repo_status_fields(data, alias, repo_name):
+    return data[alias] is not None, parse_embeddings_freshness_fields(data, alias, repo_name)
+
+
+# One repo status batcher per Sourcegraph GraphQL endpoint, shared by the presence and freshness checks
+repo_status_batchers = {}
+
+
+# Look up whether the repo is on the instance, and whether its embeddings are fresh, in one query, and cache both
+# Returns (present, fresh), or (None, None) if we couldn't find out
+async def lookup_repo_status(repo_name, sg_server_api):
+    batcher = repo_status_batchers.get(sg_server_api)
+    if batcher is None:
+        batcher = AliasedQueryBatcher(
+            sg_server_api,
+            build_repo_status_fields,
+            parse_repo_status_fields,
+        )
+        repo_status_batchers[sg_server_api] = batcher
+
+    status = await batcher.lookup(repo_name)
+    if status is None:
+        return None, None
+
+    present, fresh = status
+    await set_shared_cached(repo_presence_cache, "repo_presence", (sg_server_api, repo_name), present, positive=present)
+    await set_shared_cached(embeddings_freshness_cache, "embeddings_fresh", (sg_server_api, repo_name), fresh, positive=fresh)
+    return present, fresh
+
+
+# Check if the repo is on the Sourcegraph instance, before spending a scheduler mutation on it
+# Returns True or False, or None if we couldn't find out
+async def check_repo_presence(repo_name, sg_server_api):
+    found, present = await get_shared_cached(repo_presence_cache, "repo_presence", (sg_server_api, repo_name))
+    if found:
+        return present
+
+    present, _ = await lookup_repo_status(repo_name, sg_server_api)
+    return present
+
+
+# Check if the repo's embeddings are already up to date, so we don't ask the scheduler to rebuild them for nothing
+# Returns True or False, or None if we couldn't find out
+async def check_embeddings_fresh(repo_name, sg_server_api):
+    found, fresh = await get_shared_cached(embeddings_freshness_cache, "embeddings_fresh", (sg_server_api, repo_name))
+    if found:
+        return fresh
+
+    _, fresh = await lookup_repo_status(repo_name, sg_server_api)
+    return fresh
+
+
+# Embeddings job store settings
+# Path to the SQLite database file that records each submission, so pending jobs survive restarts
+JOB_STORE_PATH = os.environ.get("JOB_STORE_PATH", "discordbot.db")
+
+# Embeddings job statuses in the job store
+JOB_STATUS_PENDING      = "pending"
+JOB_STATUS_COMPLETED    = "completed"
+JOB_STATUS_FAILED       = "failed"
+JOB_STATUS_EXPIRED      = "expired"
+
+
+# Persistent, indexed record of every embeddings submission, in a local SQLite database
+# All database access happens on one background thread, so disk writes never block the event loop
+class EmbeddingJobStore:
+
+    def __init__(self, path=JOB_STORE_PATH):
+        self.path       = path
+        self.connection = None
+        # SQLite connections belong to the thread that uses them, so use exactly one worker thread
+        self.executor   = ThreadPoolExecutor(max_workers=1, thread_name_prefix="job-store")
+
+    async def run(self, function, *args):
+        return await asyncio.get_running_loop().run_in_executor(self.executor, function, *args)
+
+    async def open(self):
+        await self.run(self.open_sync)
+        logging.info("Opened embeddings job store: %s", self.path)
+
+    def open_sync(self):
+        self.connection = sqlite3.connect(self.path, check_same_thread=False)
+        self.connection.row_factory = sqlite3.Row
+        # Write-ahead logging, so reads don't wait on writes, and fewer fsyncs per write
+        self.connection.execute("PRAGMA journal_mode=WAL")
+        self.connection.execute("PRAGMA synchronous=NORMAL")
+        self.connection.executescript("""
+            CREATE TABLE IF NOT EXISTS embedding_jobs (
+                id              INTEGER PRIMARY KEY AUTOINCREMENT,
+                repo_name       TEXT    NOT NULL,
+                user_id         INTEGER,
+                user_mention    TEXT,
+                thread_id       INTEGER,
+                sg_server       TEXT    NOT NULL,
+                sg_server_api   TEXT    NOT NULL,
+                status          TEXT    NOT NULL,
+                status_message  TEXT,
+                submitted_at    REAL    NOT NULL,
+                updated_at      REAL    NOT NULL,
+                bulk            INTEGER NOT NULL DEFAULT 0
+            );
+            CREATE INDEX IF NOT EXISTS embedding_jobs_repo_name ON embedding_jobs (repo_name, submitted_at);
+            CREATE INDEX IF NOT EXISTS embedding_jobs_status    ON embedding_jobs (status, submitted_at);
+        """)
+        # Job stores created before bulk commands were summarized don't have the bulk column yet
+        columns = [row["name"] for row in self.connection.execute("PRAGMA table_info(embedding_jobs)")]
+        if "bulk" not in columns:
+            self.connection.execute("ALTER TABLE embedding_jobs ADD COLUMN bulk INTEGER NOT NULL DEFAULT 0")
+        self.connection.commit()
+
+    async def close(self):
+        if self.connection is not None:
+            await self.run(self.connection.close)
+            self.connection = None
+        self.executor.shutdown(wait=True)
+
+    # Record a new submission, and return its job id
+    # Failed submissions are recorded too, with JOB_STATUS_FAILED, so the history shows every attempt
+    # Jobs from bulk commands are flagged, so the poller can send one summary per bulk thread
+    async def record_submission(self, repo_name, user_id, user_mention, thread_id, sg_server, sg_server_api, submitted_at=None, status=JOB_STATUS_PENDING, status_message="", bulk=False):
+        submitted_at = submitted_at if submitted_at is not None else time.time()
+        return await self.run(
+            self.record_submission_sync,
+            (repo_name, user_id, user_mention, thread_id, sg_server, sg_server_api, status, status_message, submitted_at, submitted_at, int(bulk)),
+        )
+
+    def record_submission_sync(self, values):
+        cursor = self.connection.execute(
+            """
+            INSERT INTO embedding_jobs
+                (repo_name, user_id, user_mention, thread_id, sg_server, sg_server_api, status, status_message, submitted_at, updated_at, bulk)
+            VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
+            """,
+            values,
+        )
+        self.connection.commit()
+        return cursor.lastrowid
+
+    async def update_status(self, job_id, status, status_message=""):
+        await self.run(self.update_status_sync, (status, status_message, time.time(), job_id))
+
+    def update_status_sync(self, values):
+        self.connection.execute(
+            "UPDATE embedding_jobs SET status = ?, status_message = ?, updated_at = ? WHERE id = ?",
+            values,
+        )
+        self.connection.commit()
+
+    # All jobs still waiting on the embeddings scheduler, oldest first, served from the status index
+    async def load_pending(self):
+        return await self.run(self.select_sync, (
+            "SELECT * FROM embedding_jobs WHERE status = ? ORDER BY submitted_at",
+            (JOB_STATUS_PENDING,),
+        ))
+
+    # The submission history of a repo on one Sourcegraph instance, newest first, served from the repo_name index
+    async def load_repo_history(self, repo_name, sg_server_api, limit=10):
+        return await self.run(self.select_sync, (
+            "SELECT * FROM embedding_jobs WHERE repo_name = ? AND sg_server_api = ? ORDER BY submitted_at DESC LIMIT ?",
+            (repo_name, sg_server_api, limit),
+        ))
+
+    # The most recently requested repos, newest first, for warming the caches at startup
+    async def load_recent_repos(self, limit):
+        return await self.run(self.select_sync, (
+            """
+            SELECT repo_name, sg_server_api, MAX(submitted_at) AS last_submitted_at
+            FROM embedding_jobs
+            GROUP BY repo_name, sg_server_api
+            ORDER BY last_submitted_at DESC
+            LIMIT ?
+            """,
+            (limit,),
+        ))
+
+    def select_sync(self, query_and_parameters):
+        query, parameters = query_and_parameters
+        return [dict(row) for row in self.connection.execute(query, parameters).fetchall()]
+
+
+# One job store for the process, opened at startup
+embedding_job_store = EmbeddingJobStore()
+
+
+# Hash in the shared state backend of the jobs every replica is waiting on, for the leader's poller to check on
+PENDING_EMBEDDING_JOBS_KEY = "pending_embedding_jobs"
+
+
+# Record a successful submission in the job store, and start checking on it in the background
+# With a shared state backend, the job goes in the backend instead, for whichever replica is the leader to check on
+async def track_embedding_job(repo_name, user, thread_id, sg_server, sg_server_api, submitted_at=None, bulk=False):
+    job_id = None
+    submitted_at = submitted_at if submitted_at is not None else time.time()
+
+    try:
+        job_id = await embedding_job_store.record_submission(
+            repo_name,
+            user.id,
+            user.mention,
+            thread_id,
+            sg_server,
+            sg_server_api,
+            submitted_at,
+            bulk=bulk,
+        )
+    except Exception as exception:
+        # Keep tracking the job in memory, it just won't survive a restart
+        logging.exception(exception)
+
+    job = PendingEmbeddingJob(sg_server_api, repo_name, thread_id, user.mention, submitted_at, job_id, bulk=bulk)
+
+    if state_backend.shared:
+        try:
+            await state_backend.hash_set(PENDING_EMBEDDING_JOBS_KEY, job.job_key, json.dumps(job.to_dict()))
+        except Exception as exception:
+            # Check on it from this replica if it's the leader, the user just won't be tagged if leadership moves
+            state_backend_errors.inc("hash_set")
+            logging.warning("Failed to share embeddings job for %s: %s", repo_name, repr(exception))
+
+    if leader_election.is_leader:
+        embedding_completion_poller.add(job)
+
+    # Suggest it to the next users who start typing its name
+    repo_name_index.add(repo_name, recent=True)
+
+    return job
+
+
+# Record a submission that didn't make it to the embeddings scheduler, so the history shows the attempt
+async def record_failed_submission(repo_name, user, thread_id, sg_server, sg_server_api, message):
+    try:
+        await embedding_job_store.record_submission(
+            repo_name,
+            user.id,
+            user.mention,
+            thread_id,
+            sg_server,
+            sg_server_api,
+            status=JOB_STATUS_FAILED,
+            status_message=message,
+        )
+    except Exception as exception:
+        logging.exception(exception)
+
+
+# Describe the last time this repo was requested, for the progress message, or None if it never was
+async def describe_repo_history(repo_name, sg_server_api):
+    try:
+        history = await embedding_job_store.load_repo_history(repo_name, sg_server_api, limit=1)
+    except Exception as exception:
+        logging.exception(exception)
+        return None
+
+    if not history:
+        return None
+
+    last_job = history[0]
+    description = f"Last requested <t:{int(last_job['submitted_at'])}:R>, status: {last_job['status']}"
+    if last_job["status_message"]:
+        description += f" ({last_job['status_message']})"
+    return description
+
+
+# Reload the jobs that were still pending when the bot last stopped
+# With a shared state backend, pending jobs are kept there instead, and the leader's poller loads them
+async def reload_pending_embedding_jobs():
+    if state_backend.shared:
+        return
+
+    pending_jobs = await embedding_job_store.load_pending()
+    now = time.time()
+
+    for row in pending_jobs:
+        embedding_completion_poller.track(
+            row["sg_server_api"],
+            row["repo_name"],
+            row["thread_id"],
+            row["user_mention"],
+            row["submitted_at"],
+            row["id"],
+            bool(row["bulk"]),
+        )
+
+        # Recent submissions still count for de-duplication
+        if now - row["submitted_at"] < RECENTLY_SUBMITTED_WINDOW_SECONDS:
+            await mark_recently_submitted(row["repo_name"], row["sg_server_api"])
+
+    logging.info("Reloaded %d pending embeddings jobs from the job store", len(pending_jobs))
+
+
+# Embeddings completion poller settings
+# How often, in seconds, the poller wakes up to look for jobs that are due to be checked
+POLLER_TICK_SECONDS             = float(os.environ.get("POLLER_TICK_SECONDS", "5"))
+# Shortest and longest time, in seconds, between checks of the same job
+POLLER_MIN_INTERVAL_SECONDS     = float(os.environ.get("POLLER_MIN_INTERVAL_SECONDS", "60"))
+POLLER_MAX_INTERVAL_SECONDS     = float(os.environ.get("POLLER_MAX_INTERVAL_SECONDS", "900"))
+# The time between checks grows with the age of the job, as this fraction of its age
+POLLER_BACKOFF_FACTOR           = float(os.environ.get("POLLER_BACKOFF_FACTOR", "0.25"))
+# How many repos to check in one GraphQL request
+POLLER_BATCH_SIZE               = int(os.environ.get("POLLER_BATCH_SIZE", "50"))
+# The most GraphQL requests the poller can send per minute, across all batches
+POLLER_MAX_REQUESTS_PER_MINUTE  = int(os.environ.get("POLLER_MAX_REQUESTS_PER_MINUTE", "30"))
+# Stop checking a job after this many seconds, and let the user know
+POLLER_MAX_JOB_AGE_SECONDS      = float(os.environ.get("POLLER_MAX_JOB_AGE_SECONDS", "86400"))
+# How many of the latest embeddings jobs to look through for each repo's
+# repoEmbeddingJobs(query: ...) is a substring match, so github.com/foo/bar also returns the jobs for github.com/foo/bar-baz
+POLLER_JOBS_TO_CHECK            = 10
+
+# Embeddings job states, from the repoEmbeddingJobs GraphQL query
+EMBEDDING_JOB_STATES_IN_PROGRESS    = {"QUEUED", "PROCESSING"}
+EMBEDDING_JOB_STATES_FAILED         = {"ERRORED", "FAILED", "CANCELED"}
+
+
+# A user waiting on an embeddings job, and the thread to tag them in when it's done
+class PendingEmbeddingJob:
+
+    def __init__(self, sg_server_api, repo_name, thread_id, user_mention, submitted_at=None, job_id=None, job_key=None, replica_id=REPLICA_ID, bulk=False, outcome=None):
+        self.job_id         = job_id
+        self.sg_server_api  = sg_server_api
+        self.repo_name      = repo_name
+        self.thread_id      = thread_id
+        self.user_mention   = user_mention
+        self.submitted_at   = submitted_at if submitted_at is not None else time.time()
+        self.next_poll_at   = self.submitted_at + POLLER_MIN_INTERVAL_SECONDS
+        # The replica whose job store has this job, only it can update the job's row
+        self.replica_id     = replica_id
+        # Unique across replicas, as each replica's job store numbers its jobs from 1
+        self.job_key        = job_key or f"{replica_id}:{uuid.uuid4().hex}"
+        # Jobs from a bulk command are reported in one summary per thread, once they've all finished
+        self.bulk           = bulk
+        # (job_status, message) once a bulk job has finished, while it waits for the rest of its thread's jobs
+        self.outcome        = outcome
+
+    def to_dict(self):
+        return {
+            "job_id":           self.job_id,
+            "sg_server_api":    self.sg_server_api,
+            "repo_name":        self.repo_name,
+            "thread_id":        self.thread_id,
+            "user_mention":     self.user_mention,
+            "submitted_at":     self.submitted_at,
+            "replica_id":       self.replica_id,
+            "job_key":          self.job_key,
+            "bulk":             self.bulk,
+            "outcome":          self.outcome,
+        }
+
+    @classmethod
+    def from_dict(cls, job_dict):
+        return cls(
+            job_dict["sg_server_api"],
+            job_dict["repo_name"],
+            job_dict["thread_id"],
+            job_dict["user_mention"],
+            job_dict["submitted_at"],
+            job_dict.get("job_id"),
+            job_dict["job_key"],
+            job_dict["replica_id"],
+            job_dict.get("bulk", False),
+            job_dict.get("outcome"),
+        )
+
+    # Check young jobs often, and back off as the job gets older
+    def schedule_next_poll(self, now):
+        age = now - self.submitted_at
+        interval = min(
+            POLLER_MAX_INTERVAL_SECONDS,
+            max(POLLER_MIN_INTERVAL_SECONDS, age * POLLER_BACKOFF_FACTOR),
+        )
+        self.next_poll_at = now + interval
+
+
+# Build one GraphQL query that checks the embeddings status of many repos, using field aliases
+def build_embedding_status_query(repo_names):
+    fields = []
+
+    for index, repo_name in enumerate(repo_names):
+        quoted_repo_name = json.dumps(repo_name)
+        fields.append(f"repo{index}: repository(name: {quoted_repo_name}) {{ embeddingExists }}")
+        fields.append(
+            f"jobs{index}: repoEmbeddingJobs(first: {POLLER_JOBS_TO_CHECK}, query: {quoted_repo_name}) "
+            "{ nodes { repo { name } state failureMessage } }"
+        )
+
+    return "query {\n" + "\n".join(fields) + "\n}"
+
+
+# Work out the status of each repo from the embeddings status query response
+# Returns a dict of repo_name: (status, message), where status is "completed", "failed", or "pending"
+def parse_embedding_status_response(repo_names, response_json):
+    data = response_json.get("data") or {}
+    statuses = {}
+
+    for index, repo_name in enumerate(repo_names):
+        repository = data.get(f"repo{index}")
+        jobs = data.get(f"jobs{index}") or {}
+        # Skip the jobs for other repos whose names contain this one, newest first, so the first one left is the latest
+        job_nodes = [job for job in jobs.get("nodes") or [] if ((job or {}).get("repo") or {}).get("name") == repo_name]
+        latest_job = job_nodes[0] if job_nodes else {}
+        job_state = str(latest_job.get("state") or "").upper()
+
+        if repository is None and f"repo{index}" in data:
+            statuses[repo_name] = ("failed", "Repo not found on the Sourcegraph instance")
+        elif job_state in EMBEDDING_JOB_STATES_IN_PROGRESS:
+            statuses[repo_name] = ("pending", "")
+        elif job_state in EMBEDDING_JOB_STATES_FAILED:
+            statuses[repo_name] = ("failed", latest_job.get("failureMessage") or job_state.lower())
+        elif repository is not None and repository.get("embeddingExists"):
+            statuses[repo_name] = ("completed", "")
+        else:
+            statuses[repo_name] = ("pending", "")
+
+    return statuses
+
+
+# Send a message to the thread the embedding command created
+async def notify_thread(thread_id, content):
+    thread = bot.get_channel(thread_id)
+    if thread is None:
+        thread = await bot.fetch_channel(thread_id)
+
+    await discord_api_call(thread.send(
+        content=content,
+        suppress=True,
+    ))
+
+
+# One message for all of a bulk command's jobs, once they've all finished
+def render_bulk_completion_summary(jobs):
+    completed_count = sum(1 for job in jobs if job.outcome[0] == JOB_STATUS_COMPLETED)
+    lines = [f"{jobs[0].user_mention} The embeddings jobs for this request are done, {completed_count} of {len(jobs)} repos are ready to use."]
+
+    for job in jobs:
+        job_status, message = job.outcome
+        if job_status == JOB_STATUS_FAILED:
+            lines.append(f"❌ {job.repo_name}: {message}")
+        elif job_status == JOB_STATUS_EXPIRED:
+            lines.append(f"⚠️ {job.repo_name}: still not ready, so I've stopped checking")
+
+    return trim_middle("\n".join(lines), DISCORD_MESSAGE_MAX_LENGTH)
+
+
+# Tracks pending embeddings jobs in the background, checks on them in batches, and tags the user in their thread when they finish
+# Jobs from a bulk command are held until all of the thread's jobs have finished, then reported in one summary
+class EmbeddingCompletionPoller:
+
+    def __init__(self):
+        # (sg_server_api, repo_name): list of PendingEmbeddingJob, as several users can wait on the same repo
+        self.jobs           = {}
+        # job_key of every job in self.jobs and self.bulk_outcomes, so jobs loaded from the shared state backend aren't added twice
+        self.job_keys       = set()
+        # thread_id: list of finished bulk jobs, waiting for the rest of the thread's jobs to finish
+        self.bulk_outcomes  = {}
+        # Timestamps of the GraphQL requests sent in the last minute, to cap the request rate
+        self.request_times  = []
+        self.task           = None
+
+    def track(self, sg_server_api, repo_name, thread_id, user_mention, submitted_at=None, job_id=None, bulk=False):
+        return self.add(PendingEmbeddingJob(sg_server_api, repo_name, thread_id, user_mention, submitted_at, job_id, bulk=bulk))
+
+    def add(self, job):
+        if job.job_key in self.job_keys:
+            return job
+        self.job_keys.add(job.job_key)
+        # A bulk job the previous leader saw finish, but hadn't summarized yet
+        if job.outcome is not None:
+            self.bulk_outcomes.setdefault(job.thread_id, []).append(job)
+            return job
+        self.jobs.setdefault((job.sg_server_api, job.repo_name), []).append(job)
+        logging.info("Tracking embeddings job for %s in thread %s", job.repo_name, job.thread_id)
+        return job
+
+    # Forget every job, when this replica stops being the leader, as the new leader will check on them
+    def clear(self):
+        self.jobs.clear()
+        self.job_keys.clear()
+        self.bulk_outcomes.clear()
+
+    # Pick up jobs any replica has put in the shared state backend since the last tick
+    async def load_jobs_from_state_backend(self):
+        try:
+            shared_jobs = await state_backend.hash_get_all(PENDING_EMBEDDING_JOBS_KEY)
+        except Exception as exception:
+            state_backend_errors.inc("hash_get_all")
+            logging.warning("Failed to load shared embeddings jobs: %s", repr(exception))
+            return
+
+        for job_key, job_json in shared_jobs.items():
+            if job_key not in self.job_keys:
+                try:
+                    self.add(PendingEmbeddingJob.from_dict(json.loads(job_json)))
+                except (ValueError, KeyError, TypeError) as exception:
+                    logging.warning("Skipping malformed shared embeddings job %s: %s", job_key, repr(exception))
+
+    def start(self):
+        if self.task is None or self.task.done():
+            self.task = asyncio.get_event_loop().create_task(self.run())
+        return self.task
+
+    async def stop(self):
+        if self.task is not None:
+            self.task.cancel()
+            try:
+                await self.task
+            except asyncio.CancelledError:
+                pass
+            self.task = None
+
+    async def run(self):
+        while True:
+            try:
+                if state_backend.shared:
+                    await self.load_jobs_from_state_backend()
+                await self.poll_due_jobs()
+                await self.send_bulk_summaries()
+            except asyncio.CancelledError:
+                raise
+            except Exception as exception:
+                logging.exception(exception)
+
+            await asyncio.sleep(POLLER_TICK_SECONDS)
+
+    # How many more GraphQL requests the poller can send in the current minute
+    def request_budget(self, now):
+        self.request_times = [request_time for request_time in self.request_times if now - request_time < 60]
+        return max(0, POLLER_MAX_REQUESTS_PER_MINUTE - len(self.request_times))
+
+    async def poll_due_jobs(self):
+        now = time.time()
+
+        # Find the repos with at least one job due for a check, grouped by Sourcegraph instance, oldest first
+        due_keys = []
+        for key, jobs in self.jobs.items():
+            if min(job.next_poll_at for job in jobs) <= now:
+                due_keys.append((min(job.submitted_at for job in jobs), key))
+        due_keys.sort()
+
+        repo_names_by_api = {}
+        for _, (sg_server_api, repo_name) in due_keys:
+            repo_names_by_api.setdefault(sg_server_api, []).append(repo_name)
+
+        for sg_server_api, repo_names in repo_names_by_api.items():
+            for batch_start in range(0, len(repo_names), POLLER_BATCH_SIZE):
+                # Leave the rest for the next tick if we're out of request budget
+                if self.request_budget(time.time()) <= 0:
+                    return
+
+                batch = repo_names[batch_start:batch_start + POLLER_BATCH_SIZE]
+                self.request_times.append(time.time())
+                await self.poll_batch(sg_server_api, batch)
+
+    async def poll_batch(self, sg_server_api, repo_names):
+        try:
+            response_json = await post_graphql_query(
+                build_embedding_status_query(repo_names),
+                sg_server_api,
+            )
+        except Exception as exception:
+            # Try again on the jobs' next scheduled poll
+            logging.warning("Embeddings status query failed: %s", exception)
+            statuses = {}
+        else:
+            if response_json.get("errors"):
+                logging.warning("Embeddings status query returned errors: %s", response_json.get("errors"))
+            statuses = parse_embedding_status_response(repo_names, response_json)
+
+        now = time.time()
+        for repo_name in repo_names:
+            status, message = statuses.get(repo_name, ("pending", ""))
+            await self.handle_status(sg_server_api, repo_name, status, message, now)
+
+    async def handle_status(self, sg_server_api, repo_name, status, message, now):
+        key = (sg_server_api, repo_name)
+        jobs = self.jobs.get(key, [])
+        remaining_jobs = []
+
+        # The job finishing changes the repo's freshness, check it again next time it's requested
+        if status != "pending":
+            await invalidate_shared_cached(embeddings_freshness_cache, "embeddings_fresh", key)
+
+        for job in jobs:
+            if status == "completed":
+                job_status = JOB_STATUS_COMPLETED
+                content = f"{job.user_mention} ✅ Embeddings for {repo_name} are ready to use!"
+            elif status == "failed":
+                job_status = JOB_STATUS_FAILED
+                content = f"{job.user_mention} ❌ Embeddings job for {repo_name} failed: {message}"
+            elif now - job.submitted_at > POLLER_MAX_JOB_AGE_SECONDS:
+                job_status = JOB_STATUS_EXPIRED
+                content = (
+                    f"{job.user_mention} ⚠️ Embeddings for {repo_name} still aren't ready, "
+                    "so I've stopped checking. Please check on Sourcegraph, or tag us for support."
+                )
+            else:
+                if job.next_poll_at <= now:
+                    job.schedule_next_poll(now)
+                remaining_jobs.append(job)
+                continue
+
+            if job.bulk:
+                await self.hold_bulk_outcome(job, job_status, message)
+            else:
+                try:
+                    await notify_thread(job.thread_id, content)
+                except Exception as exception:
+                    # The thread may have been deleted, don't keep retrying
+                    logging.exception(exception)
+
+                await self.forget_job(job)
+
+            # Other replicas' job stores aren't reachable from here, their rows stay pending
+            if job.job_id is not None and job.replica_id == REPLICA_ID:
+                try:
+                    await embedding_job_store.update_status(job.job_id, job_status, message)
+                except Exception as exception:
+                    logging.exception(exception)
+
+        if remaining_jobs:
+            self.jobs[key] = remaining_jobs
+        else:
+            self.jobs.pop(key, None)
+
+    # Keep a finished bulk job until the rest of its thread's jobs finish
+    # With a shared state backend, the outcome goes back in the backend too, so a new leader can still include it in the summary
+    async def hold_bulk_outcome(self, job, job_status, message):
+        job.outcome = (job_status, message)
+        self.bulk_outcomes.setdefault(job.thread_id, []).append(job)
+
+        if state_backend.shared:
+            try:
+                await state_backend.hash_set(PENDING_EMBEDDING_JOBS_KEY, job.job_key, json.dumps(job.to_dict()))
+            except Exception as exception:
+                # The next leader would check on the job again, and still include it in the summary
+                state_backend_errors.inc("hash_set")
+                logging.warning("Failed to share finished embeddings job for %s: %s", job.repo_name, repr(exception))
+
+    # Send one summary to each bulk thread that has no jobs left waiting on the scheduler
+    async def send_bulk_summaries(self):
+        if not self.bulk_outcomes:
+            return
+
+        waiting_thread_ids = {job.thread_id for jobs in self.jobs.values() for job in jobs if job.bulk}
+
+        for thread_id in [thread_id for thread_id in self.bulk_outcomes if thread_id not in waiting_thread_ids]:
+            finished_jobs = self.bulk_outcomes.pop(thread_id)
+
+            try:
+                await notify_thread(thread_id, render_bulk_completion_summary(finished_jobs))
+            except Exception as exception:
+                # The thread may have been deleted, don't keep retrying
+                logging.exception(exception)
+
+            for job in finished_jobs:
+                await self.forget_job(job)
+
+    async def forget_job(self, job):
+        self.job_keys.discard(job.job_key)
+        if state_backend.shared:
+            try:
+                await state_backend.hash_delete(PENDING_EMBEDDING_JOBS_KEY, job.job_key)
+            except Exception as exception:
+                # The next leader may tag the user again, better than not at all
+                state_backend_errors.inc("hash_delete")
+                logging.warning("Failed to remove shared embeddings job for %s: %s", job.repo_name, repr(exception))
+
+
+# One poller for the process
+embedding_completion_poller = EmbeddingCompletionPoller()
+
+
+# Leader election settings
+# How long, in seconds, the leader's lock lasts if it stops renewing it, e.g. because it crashed
+LEADER_LOCK_TTL_SECONDS         = float(os.environ.get("LEADER_LOCK_TTL_SECONDS", "30"))
+# How often, in seconds, the leader renews its lock, and the other replicas try to take it
+LEADER_LOCK_RENEW_SECONDS       = float(os.environ.get("LEADER_LOCK_RENEW_SECONDS", "10"))
+
+LEADER_LOCK_KEY = "leader"
+
+
+# Picks one replica to run the embeddings completion poller, so users are only tagged once, and Sourcegraph is only polled once
+# The leader holds a lock in the shared state backend, and renews it, if it stops, another replica takes over when the lock expires
+# With a state backend that isn't shared, this replica is the only one, so it's always the leader
+class LeaderElection:
+
+    def __init__(self, poller, replica_id=REPLICA_ID):
+        self.poller             = poller
+        self.replica_id         = replica_id
+        self.is_leader          = False
+        # When our lock expires, if we can't renew it, by this replica's clock
+        self.lock_expires_at    = 0.0
+        self.task               = None
+
+    def start(self):
+        if not state_backend.shared:
+            self.become_leader()
+            return None
+
+        if self.task is None or self.task.done():
+            self.task = asyncio.get_event_loop().create_task(self.run())
+        return self.task
+
+    async def stop(self):
+        if self.task is not None:
+            self.task.cancel()
+            try:
+                await self.task
+            except asyncio.CancelledError:
+                pass
+            self.task = None
+
+        was_leader = self.is_leader
+        await self.step_down()
+
+        # Let another replica take over straight away, rather than when the lock expires
+        if was_leader and state_backend.shared:
+            try:
+                await state_backend.release_if_owner(LEADER_LOCK_KEY, self.replica_id)
+            except Exception as exception:
+                logging.warning("Failed to release the leader lock: %s", repr(exception))
+
+    def become_leader(self):
+        if not self.is_leader:
+            self.is_leader = True
+            logging.info("Replica %s is now the leader, starting the embeddings completion poller", self.replica_id)
+            self.poller.start()
+
+    async def step_down(self):
+        if self.is_leader:
+            self.is_leader = False
+            logging.info("Replica %s is no longer the leader, stopping the embeddings completion poller", self.replica_id)
+            await self.poller.stop()
+            self.poller.clear()
+
+    async def run(self):
+        while True:
+            try:
+                if self.is_leader:
+                    holds_lock = await state_backend.renew_if_owner(LEADER_LOCK_KEY, self.replica_id, LEADER_LOCK_TTL_SECONDS)
+                else:
+                    holds_lock = await state_backend.set_if_absent(LEADER_LOCK_KEY, self.replica_id, LEADER_LOCK_TTL_SECONDS)
+            except asyncio.CancelledError:
+                raise
+            except Exception as exception:
+                state_backend_errors.inc("leader_lock")
+                logging.warning("Leader lock check failed: %s", repr(exception))
+                # Keep leading until our lock would have expired, another replica can't take it before then
+                holds_lock = self.is_leader and time.monotonic() < self.lock_expires_at
+            else:
+                if holds_lock:
+                    self.lock_expires_at = time.monotonic() + LEADER_LOCK_TTL_SECONDS
+
+            if holds_lock:
+                self.become_leader()
+            else:
+                await self.step_down()
+
+            await asyncio.sleep(LEADER_LOCK_RENEW_SECONDS)
+
+
+leader_election = LeaderElection(embedding_completion_poller)
+
+Gauge("discordbot_leader", "1 if this replica is the leader, and runs the embeddings completion poller", lambda: int(leader_election.is_leader))
+
+
+# Progress message settings
+# How long, in seconds, to collect updates to a progress message before sending them to Discord in one API call
+PROGRESS_MESSAGE_COALESCE_SECONDS   = float(os.environ.get("PROGRESS_MESSAGE_COALESCE_SECONDS", "1"))
+# Discord rejects messages longer than this
+DISCORD_MESSAGE_MAX_LENGTH          = 2000
+# When a progress message is too long, how much of it the lines before the latest update get, at least
+PROGRESS_MESSAGE_MIN_EARLIER_LENGTH = 400
+# Stands in for the text trimmed out of the middle of a progress message
+PROGRESS_MESSAGE_TRIM_MARKER        = "\n…\n"
+
+
+# Trim text to max_length by cutting out the middle, so the start and the end both survive
+# Cuts at line breaks where it can, so no line is left half cut
+def trim_middle(text, max_length):
+    if len(text) <= max_length:
+        return text
+    if max_length <= len(PROGRESS_MESSAGE_TRIM_MARKER):
+        return text[:max(0, max_length)]
+
+    keep_length = max_length - len(PROGRESS_MESSAGE_TRIM_MARKER)
+    start_length = keep_length // 2
+    end_length = keep_length - start_length
+
+    start = text[:start_length]
+    start_line_break = start.rfind("\n")
+    if start_line_break > 0:
+        start = start[:start_line_break]
+
+    end = text[len(text) - end_length:]
+    end_line_break = end.find("\n")
+    if 0 <= end_line_break < len(end) - 1:
+        end = end[end_line_break + 1:]
+
+    return start + PROGRESS_MESSAGE_TRIM_MARKER + end
+
+
+# One message in a thread, that's posted once, then edited in place as the command progresses
+# Updates that land within PROGRESS_MESSAGE_COALESCE_SECONDS of each other are sent in one API call,
+# so a fast command only costs a single thread.send, instead of one per stage
+class ProgressMessage:
+
+    def __init__(self, thread, coalesce_seconds=PROGRESS_MESSAGE_COALESCE_SECONDS):
+        self.thread             = thread
+        self.coalesce_seconds   = coalesce_seconds
+        # Lines that stay in the message
+        self.lines              = []
+        # The latest status line, replaced by each set_status()
+        self.status             = None
+        # Buttons to show under the message, ie. retry
+        self.view               = None
+        self.message            = None
+        self.sent_content       = None
+        self.sent_view          = None
+        self.flush_timer        = None
+        self.flush_tasks        = set()
+        # Only one send / edit in flight at a time, so they land in order
+        self.lock               = asyncio.Lock()
+
+    def render(self):
+        blocks = self.lines + ([self.status] if self.status else [])
+        content = "\n\n".join(blocks)
+        if len(content) <= DISCORD_MESSAGE_MAX_LENGTH:
+            return content
+
+        # Too long for one message, ie. a long list of input validation messages
+        # The latest update is what the user is waiting for, so it keeps the room it needs, and the lines before it are trimmed from the middle
+        earlier = "\n\n".join(blocks[:-1])
+        separator = "\n\n" if earlier else ""
+        latest = trim_middle(blocks[-1], DISCORD_MESSAGE_MAX_LENGTH - len(separator) - min(len(earlier), PROGRESS_MESSAGE_MIN_EARLIER_LENGTH))
+        earlier = trim_middle(earlier, DISCORD_MESSAGE_MAX_LENGTH - len(separator) - len(latest))
+        return earlier + separator + latest
+
+    # Add a line that stays in the message
+    def add(self, line):
+        self.lines.append(line)
+        self.schedule_flush()
+
+    # Replace the status line
+    def set_status(self, status):
+        self.status = status
+        self.schedule_flush()
+
+    # Set the final status, and any buttons to show with it, and send it now
+    async def finish(self, status, view=None):
+        self.status = status
+        self.view = view
+        await self.flush()
+
+    def schedule_flush(self):
+        if self.flush_timer is None:
+            self.flush_timer = asyncio.get_running_loop().call_later(self.coalesce_seconds, self.start_flush)
+
+    def start_flush(self):
+        self.flush_timer = None
+        task = asyncio.get_running_loop().create_task(self.flush())
+        self.flush_tasks.add(task)
+        task.add_done_callback(self.flush_tasks.discard)
+
+    async def flush(self):
+        if self.flush_timer is not None:
+            self.flush_timer.cancel()
+            self.flush_timer = None
+
+        async with self.lock:
+            content = self.render()
+            view = self.view
+            if content == self.sent_content and view is self.sent_view:
+                return
+
+            try:
+                if self.message is None:
+                    self.message = await discord_api_call(self.thread.send(
+                        content=content,
+                        suppress=True,
+                        view=view,
+                    ))
+                else:
+                    # view=None removes the buttons from an earlier status
+                    await discord_api_call(self.message.edit(
+                        content=content,
+                        suppress=True,
+                        view=view,
+                    ))
+                self.sent_content = content
+                self.sent_view = view
+            except Exception as exception:
+                # Don't fail the command if a progress update doesn't make it, the next one will include it
+                logging.exception(exception)
+
+
+# How long, in seconds, the retry button stays on a failed submission
+RETRY_BUTTON_TIMEOUT_SECONDS = float(os.environ.get("RETRY_BUTTON_TIMEOUT_SECONDS", "900"))
+
+
+# Retry button shown under a failed submission
+# Pressing it submits the already sanitized repo again, in the same thread and progress message
+class RetrySubmissionView(discord.ui.View):
+
+    def __init__(self, progress_message, sanitized_repo_url, user, thread_id, sg_server, sg_server_api, force_rebuild):
+        super().__init__(timeout=RETRY_BUTTON_TIMEOUT_SECONDS)
+        self.progress_message   = progress_message
+        self.sanitized_repo_url = sanitized_repo_url
+        self.user               = user
+        self.thread_id          = thread_id
+        self.sg_server          = sg_server
+        self.sg_server_api      = sg_server_api
+        self.force_rebuild      = force_rebuild
+
+    @discord.ui.button(label="Retry", emoji="🔁", style=discord.ButtonStyle.primary)
+    async def retry(self, button, interaction):
+        log_request_id.set(interaction.id)
+        log_user_id.set(interaction.user.id)
+
+        # Only the user who requested the embeddings can retry, anyone else can run the command themselves
+        if interaction.user.id != self.user.id:
+            await discord_api_call(interaction.response.send_message(
+                content=f"Only {self.user.mention} can retry this request, run `/embedding` to request it yourself.",
+                ephemeral=True,
+            ))
+            return
+
+        # Retries count against the same rate limits as commands
+        allowed, retry_after, _ = await check_rate_limits(interaction.user.id, interaction.guild_id)
+        if not allowed:
+            await discord_api_call(interaction.response.send_message(
+                content="⏳ Rate limited, " + describe_rate_limit_retry(retry_after),
+                ephemeral=True,
+            ))
+            return
+
+        # Acknowledge the click before a worker can pick up the retry, so the retry's message edits don't race the acknowledgement
+        await discord_api_call(interaction.response.defer())
+
+        # Retries go ahead of new commands in the worker pool
+        try:
+            command_work_pool.submit(COMMAND_LANE_RETRY, self.process_retry)
+        except CommandQueueFull:
+            # The click is already acknowledged, so tell the user in a followup, and leave the button for them to try again
+            await discord_api_call(interaction.followup.send(
+                content="⏳ Too many embeddings requests are waiting right now, please retry in a few minutes.",
+                ephemeral=True,
+            ))
+            return
+
+        # One retry per failure, if this one fails too, it gets its own button
+        self.stop()
+
+    # Submit the repo again, on a command worker
+    async def process_retry(self):
+        embedding_requests_in_flight.inc()
+        try:
+            await submit_and_report_embedding_request(
+                self.progress_message,
+                self.sanitized_repo_url,
+                self.user,
+                self.thread_id,
+                self.sg_server,
+                self.sg_server_api,
+                self.force_rebuild,
+            )
+        except Exception as exception:
+            logging.exception(exception)
+            await self.progress_message.finish(
+                "❌ Error occurred: "
+                + str(exception)
+            )
+        finally:
+            embedding_requests_in_flight.dec()
+
+    # Take the button off the message once it's expired, unless it's already been replaced
+    async def on_timeout(self):
+        if self.progress_message.view is self:
+            self.progress_message.view = None
+            await self.progress_message.flush()
+
+
+# Submit a sanitized repo for embeddings, and report the result in the command's progress message
+# Used by the embedding command, and again by the retry button on failures, without sanitizing the repo_url again
+async def submit_and_report_embedding_request(progress_message, sanitized_repo_url, user, thread_id, sg_server, sg_server_api, force_rebuild=False):
+    # Respond to the user's command
+    progress_message.set_status(
+        "Submitting embeddings request for \n"
+        + sanitized_repo_url
+        + "\nto Sourcegraph instance \n"
+        + sg_server
+    )
+
+    # Tell the user where they are in line, if there are too many submissions in flight
+    async def notify_queued(position):
+        progress_message.set_status(f"⏳ Sourcegraph is busy, you're queued at position {position}.")
+
+    def retry_view():
+        return RetrySubmissionView(progress_message, sanitized_repo_url, user, thread_id, sg_server, sg_server_api, force_rebuild)
+
+    # Get the return value and respond to the user
+    try:
+        async with embedding_submission_queue.slot(notify_queued):
+            graphql_send_success, graphql_response_message = await submit_embedding_request(
+                sanitized_repo_url,
+                sg_server_api,
+                force=force_rebuild,
+            )
+    except AdmissionQueueFull:
+        await record_failed_submission(sanitized_repo_url, user, thread_id, sg_server, sg_server_api, "Too many submissions waiting for Sourcegraph")
+        await progress_message.finish(
+            "❌ Too many embeddings requests are waiting for Sourcegraph right now, please try again in a few minutes.",
+            view=retry_view(),
+        )
+        return
+
+    if graphql_send_success == True:
+        # Send a message back to the channel if the GraphQL mutation was successful
+        response_to_user = f"""✅ Embeddings are processing!
+Embeddings are usually available within 30 minutes, depending on the size of the repo.
+To check if the embeddings are completed and ready to use:
+1. Go to your repo on Sourcegraph {sg_server + "/" + sanitized_repo_url}
+2. Click the Ask Cody button, near the top right
+3. Check the Chat Context menu in the bottom left corner of the Ask Cody chat pane, for a checkmark (ready) or an X (not ready yet)
+4. If your Cody IDE extension doesn't show the embeddings are ready, try:
+ 1. Ensure you're logged in to your Cody extension via {sg_server}
+ 2. Reload your IDE window
+ 3. Ensure the output of `git remote get-url origin` matches the repo name you submitted for embeddings
+ 4. For best results, open a new IDE workspace at the root directory of the repo, and ensure `cody.codebase` is not in your workspace or user settings
+I'll tag you in this thread when the embeddings are ready."""
+        await progress_message.finish(response_to_user)
+
+        # Check on the job in the background, and tag the user when it's done
+        await track_embedding_job(sanitized_repo_url, user, thread_id, sg_server, sg_server_api)
+
+    else:
+        await record_failed_submission(sanitized_repo_url, user, thread_id, sg_server, sg_server_api, str(graphql_response_message))
+
+        # Send a message back to the channel if the GraphQL mutation was not successful, show an error to the user, with a retry button
+        await progress_message.finish(
+            "❌ Error submitting embeddings job to the Sourcegraph server: "
+            + graphql_response_message,
+            view=retry_view(),
+        )
+
+
+# repo_url autocomplete settings
+# Discord shows at most 25 choices, and rejects choice values longer than 100 characters
+AUTOCOMPLETE_MAX_CHOICES            = 25
+AUTOCOMPLETE_MAX_CHOICE_LENGTH      = 100
+# How many previously submitted repos to load from the job store at startup
+AUTOCOMPLETE_SUBMITTED_REPOS        = int(os.environ.get("AUTOCOMPLETE_SUBMITTED_REPOS", "100000"))
+# How many of the Sourcegraph instance's repos to load, 0 to only suggest previously submitted repos
+AUTOCOMPLETE_INSTANCE_REPOS         = int(os.environ.get("AUTOCOMPLETE_INSTANCE_REPOS", "100000"))
+# How often, in seconds, to reload the Sourcegraph instance's repos
+AUTOCOMPLETE_REFRESH_SECONDS        = float(os.environ.get("AUTOCOMPLETE_REFRESH_SECONDS", "3600"))
+# How many repos to ask for in each page of the repositories query
+AUTOCOMPLETE_PAGE_SIZE              = 1000
+
+# Matches what users type before the repo name, which the index doesn't store
+AUTOCOMPLETE_INPUT_PREFIX_REGEX     = regex.compile(r"^<?([a-z][a-z0-9+.-]*://)?(www\.)?")
+
+autocomplete_seconds = Histogram("discordbot_autocomplete_seconds", "Time to look up repo_url autocomplete choices")
+
+
+def contains_sorted_key(sorted_keys, key):
+    index = bisect_left(sorted_keys, key)
+    return index < len(sorted_keys) and sorted_keys[index] == key
+
+
+# Remember how to show a repo name whose key was lower cased, and its hostname
+def add_display_name(key, repo_name, display_names, hostnames):
+    if key != repo_name:
+        display_names[key] = repo_name
+    hostnames.add(key.split("/", 1)[0])
+
+
+# The sorted, de-duplicated, lower case keys of repo_names, filling in display_names and hostnames for them
+def sorted_keys(repo_names, display_names, hostnames):
+    keys = set()
+    for repo_name in repo_names:
+        key = repo_name.lower()
+        if key not in keys:
+            keys.add(key)
+            add_display_name(key, repo_name, display_names, hostnames)
+    return sorted(keys)
+
+
+# Merge lists of sorted keys into one sorted list, without duplicates
+# Sorting sorted runs back to back only merges them, and runs from different lists can overlap, so drop the duplicates
+def merge_sorted_keys(sorted_key_lists):
+    keys = [key for sorted_keys in sorted_key_lists for key in sorted_keys]
+    keys.sort()
+    return [key for index, key in enumerate(keys) if index == 0 or key != keys[index - 1]]
+
+
+# Prefix index of repo names, for autocompleting repo_url
+# A sorted list searched with bisect, rather than a trie, as a list of strings is far smaller than a tree of dicts
+# Lookups are case insensitive, and show the repo name as Sourcegraph has it
+class RepoNameIndex:
+
+    def __init__(self):
+        # Lower case repo names, sorted, from both of the lists below
+        self.keys                       = []
+        # key: repo name, only for the names that aren't already lower case
+        self.display_names              = {}
+        # Hostnames of the indexed repos, so users can type "org/repo" without the hostname
+        self.hostnames                  = set()
+        # Repos submitted through the bot, kept until the process stops
+        self.local_keys                 = []
+        self.local_display_names        = {}
+        self.local_hostnames            = set()
+        # Repos on the Sourcegraph instance, replaced by each refresh, so repos deleted from the instance drop out
+        self.instance_keys              = []
+        self.instance_display_names     = {}
+        self.instance_hostnames         = set()
+        # Most recently submitted repos, newest last, to suggest before the user has typed anything
+        self.recent_names               = deque(maxlen=AUTOCOMPLETE_MAX_CHOICES)
+
+    def __len__(self):
+        return len(self.keys)
+
+    def __contains__(self, repo_name):
+        return contains_sorted_key(self.keys, repo_name.lower())
+
+    # Add one repo name, e.g. as it's submitted
+    def add(self, repo_name, recent=False):
+        if recent:
+            if repo_name in self.recent_names:
+                self.recent_names.remove(repo_name)
+            self.recent_names.append(repo_name)
+
+        key = repo_name.lower()
+        for keys, display_names, hostnames in (
+            (self.local_keys, self.local_display_names, self.local_hostnames),
+            (self.keys, self.display_names, self.hostnames),
+        ):
+            if not contains_sorted_key(keys, key):
+                keys.insert(bisect_left(keys, key), key)
+                add_display_name(key, repo_name, display_names, hostnames)
+
+    # Add many submitted repo names at once, with one merge, rather than one insert each
+    def add_many(self, repo_names):
+        self.local_keys = merge_sorted_keys([
+            self.local_keys,
+            sorted_keys(repo_names, self.local_display_names, self.local_hostnames),
+        ])
+        self.rebuild()
+
+    # Swap in the Sourcegraph instance's repos, from lists of sorted keys built by sorted_keys, with their display names and hostnames
+    # Building the lists is split from this, so a large load can do that part a page at a time, between awaits
+    def replace_instance_keys(self, sorted_key_lists, display_names, hostnames):
+        self.instance_keys = merge_sorted_keys(sorted_key_lists)
+        self.instance_display_names = display_names
+        self.instance_hostnames = hostnames
+        self.rebuild()
+
+    # Rebuild the combined index from the local and instance lists
+    # Repos add() inserted while the instance was loading are in the local list, so they're kept
+    def rebuild(self):
+        self.keys = merge_sorted_keys([self.local_keys, self.instance_keys])
+        self.display_names = {**self.instance_display_names, **self.local_display_names}
+        self.hostnames = self.instance_hostnames | self.local_hostnames
+
+    # Append the repo names starting with prefix to matches, until there are limit of them
+    def collect_matches(self, prefix, matches, limit):
+        index = bisect_left(self.keys, prefix)
+        while index < len(self.keys) and len(matches) < limit and self.keys[index].startswith(prefix):
+            name = self.display_names.get(self.keys[index], self.keys[index])
+            if len(name) <= AUTOCOMPLETE_MAX_CHOICE_LENGTH and name not in matches:
+                matches.append(name)
+            index += 1
+
+    # Find up to limit repo names starting with what the user has typed so far
+    def search(self, text, limit=AUTOCOMPLETE_MAX_CHOICES):
+        prefix = AUTOCOMPLETE_INPUT_PREFIX_REGEX.sub("", text.strip().lower(), count=1)
+        if not prefix:
+            return list(reversed(self.recent_names))[:limit]
+
+        matches = []
+        self.collect_matches(prefix, matches, limit)
+
+        # Also try the text as the path on each code host, e.g. "sourcegraph/cody" for "github.com/sourcegraph/cody"
+        if len(matches) < limit and "." not in prefix.split("/", 1)[0]:
+            for hostname in sorted(self.hostnames):
+                self.collect_matches(hostname + "/" + prefix, matches, limit)
+                if len(matches) >= limit:
+                    break
+
+        return matches
+
+
+# One index for the process, filled at startup, and as repos are submitted
+repo_name_index = RepoNameIndex()
+
+Gauge("discordbot_autocomplete_index_size", "Repo names in the repo_url autocomplete index", lambda: len(repo_name_index))
+
+
+# Suggest repo names as the user types the repo_url option
+# Discord calls this on each keystroke, and gives up after 3 seconds, so it only reads the in-memory index
+async def repo_url_autocomplete(ctx: discord.AutocompleteContext):
+    start = time.perf_counter()
+    try:
+        return repo_name_index.search(ctx.value or "")
+    finally:
+        autocomplete_seconds.observe(time.perf_counter() - start)
+
+
+# Page through the repos on the Sourcegraph instance
+def build_repositories_query(after_cursor):
+    return (
+        "query {\n"
+        f"repositories(first: {AUTOCOMPLETE_PAGE_SIZE}, after: {json.dumps(after_cursor)}) "
+        "{ nodes { name } pageInfo { hasNextPage endCursor } }\n"
+        "}"
+    )
+
+
+# Load the repos the bot has seen submitted before into the autocomplete index
+async def load_submitted_repo_names(sg_server_api):
+    submitted_repos = await embedding_job_store.load_recent_repos(AUTOCOMPLETE_SUBMITTED_REPOS)
+    submitted_repo_names = [row["repo_name"] for row in submitted_repos if row["sg_server_api"] == sg_server_api]
+    repo_name_index.add_many(submitted_repo_names)
+
+    # Rows are newest first, and the recent list wants newest last
+    for repo_name in reversed(submitted_repo_names[:AUTOCOMPLETE_MAX_CHOICES]):
+        repo_name_index.recent_names.append(repo_name)
+
+
+# Load the Sourcegraph instance's repos into the autocomplete index, replacing the ones from the last load
+async def load_instance_repo_names(sg_server_api):
+    key_lists = []
+    display_names = {}
+    hostnames = set()
+    after_cursor = None
+    repo_count = 0
+    while repo_count < AUTOCOMPLETE_INSTANCE_REPOS:
+        response_json = await post_graphql_query(build_repositories_query(after_cursor), sg_server_api)
+        if response_json.get("errors"):
+            raise RuntimeError(f"repositories query returned errors: {response_json.get('errors')}")
+
+        # Sort each page as it arrives, so we don't hold up the event loop for the whole load
+        repositories = (response_json.get("data") or {}).get("repositories") or {}
+        key_lists.append(sorted_keys(
+            (node["name"] for node in repositories.get("nodes") or [] if node and node.get("name")),
+            display_names,
+            hostnames,
+        ))
+
+        repo_count += len(repositories.get("nodes") or [])
+
+        page_info = repositories.get("pageInfo") or {}
+        if not page_info.get("hasNextPage"):
+            break
+        after_cursor = page_info.get("endCursor")
+
+    # One merge for all the pages
+    repo_name_index.replace_instance_keys(key_lists, display_names, hostnames)
+    logging.info("Loaded %d repo names into the autocomplete index", len(repo_name_index))
+
+
+# Fill the autocomplete index, then keep the Sourcegraph instance's repos in it up to date, in the background
+async def load_repo_name_index(sg_server_api):
+    try:
+        await load_submitted_repo_names(sg_server_api)
+    except Exception as exception:
+        logging.warning("Failed to load submitted repo names for autocomplete: %s", repr(exception))
+
+    while AUTOCOMPLETE_INSTANCE_REPOS > 0:
+        try:
+            await load_instance_repo_names(sg_server_api)
+        except Exception as exception:
+            # Keep suggesting what we have
+            logging.warning("Failed to load repo names for autocomplete: %s", repr(exception))
+        await asyncio.sleep(AUTOCOMPLETE_REFRESH_SECONDS)
+
+
+# Discord gateway sharding settings, to spread the bot's guilds across replicas
+# How many shards the bot has in total, across all replicas, unset to run one unsharded connection
+SHARD_COUNT                     = os.environ.get("SHARD_COUNT")
+# Comma separated shard IDs this replica connects, e.g. "0,1" on the first of two replicas with SHARD_COUNT=4
+# Unset to connect all of them from this replica
+SHARD_IDS                       = os.environ.get("SHARD_IDS")
+
+
+# Configure and create an instance of the Discord bot
+intents = discord.Intents.default()
+intents.messages = True
+if SHARD_COUNT:
+    bot = AutoShardedBot(
+        command_prefix="embeddings",
+        intents=intents,
+        shard_count=int(SHARD_COUNT),
+        shard_ids=[int(shard_id) for shard_id in SHARD_IDS.split(",")] if SHARD_IDS else None,
+    )
+else:
+    bot = Bot(command_prefix="embeddings", intents=intents)
+
+
+# Define the event handler for when the slash_command is received
+@bot.slash_command(description="Request Cody embeddings for a repo")
+@discord.option(
+    name="repo_url",
+    description="Enter the public repo in the format: github.com/org/repo",
+    autocomplete=repo_url_autocomplete,
+)
+@discord.option(
+    name="force_rebuild",
+    description="Rebuild the embeddings, even if they're already up to date",
+    required=False,
+    default=False,
+)
+async def embedding(ctx: discord.ApplicationContext, repo_url: str, force_rebuild: bool = False):
+    log_request_id.set(ctx.interaction.id)
+    log_user_id.set(ctx.author.id)
+    embedding_requests_total.inc()
+
+    # Try / except block for Discord bot messages
+    try:
+        # Check the user's and guild's rate limits before doing any work
+        # If they're over, only tell the user, don't create a thread or make any outbound requests
+        allowed, retry_after, rate_limit_scope = await check_rate_limits(ctx.author.id, ctx.guild_id)
+        if not allowed:
+            await discord_api_call(ctx.send_response(
+                content=(
+                    "⏳ Rate limited, "
+                    + ("you've" if rate_limit_scope == "user" else "this server has")
+                    + " sent too many `/embedding` commands, "
+                    + describe_rate_limit_retry(retry_after)
+                ),
+                ephemeral=True,
+                delete_after=rate_limit_message_lifetime(retry_after),
+            ))
+            return
+
+        # Hand the rest of the work to the worker pool, so the acknowledgement doesn't wait for it
+        try:
+            position = command_work_pool.submit(COMMAND_LANE_SINGLE, process_embedding_command, ctx, repo_url, force_rebuild)
+        except CommandQueueFull:
+            await discord_api_call(ctx.send_response(
+                content="⏳ Too many embeddings requests are waiting right now, please try again in a few minutes.",
+                ephemeral=True,
+                delete_after=300,
+            ))
+            return
+
+        # Acknowledge the command, to avoid showing an error to the user, "The application did not respond"
+        await discord_api_call(ctx.send_response(
+            content=(
+                "Received `/embedding` command, creating new thread in this channel, and deleting this message."
+                + (f" There are {position} requests ahead of yours." if position else "")
+            ),
+            ephemeral=True,  # Only show this message to this user, which provides them a button to delete this message
+            delete_after=3600,  # Auto delete this message after x seconds
+        ))
+
+    except Exception as exception:
+        logging.exception(exception)
+
+
+# Process an embedding command, on a command worker, after the handler has acknowledged it
+async def process_embedding_command(ctx, repo_url, force_rebuild):
+    error_state = False
+    thread = None
+    progress_message = None
+    embedding_requests_in_flight.inc()
+
+    # Try / except block for Discord bot messages
+    try:
+        # Get the Sourcegraph server and GraphQL api endpoints
+        sg_server, sg_server_api = await get_sourcegraph_server_addresses()
+
+        # Sanitize the repo URL before responding to the Discord user, so the user can visually validate the sanitized repo URL is valid, and tag us for support if not
+        sanitized_repo_url, input_validation_messages_to_user = await sanitize_repo_url(
+            repo_url
+        )
+        if sanitized_repo_url is None:
+            thread_name = repo_url
+            error_state = True
+        else:
+            thread_name = sanitized_repo_url
+
+        # Create the thread to reply in
+        thread = await discord_api_call(ctx.interaction.channel.create_thread(
+            name=thread_name,
+            auto_archive_duration=60,  # Auto archive this thread after x minutes
+            type=discord.ChannelType.public_thread,
+        ))
+
+        # All of our replies go in one message in the thread, which is posted once, then edited as we go
+        progress_message = ProgressMessage(thread)
+
+        # The initial message
+        progress_message.add(
+            ctx.author.mention
+            + " requested embeddings for \n"
+            + repo_url
+        )
+
+        # If the sanitization returned input_validation_messages_to_user, then respond to the user with them
+        if len(input_validation_messages_to_user) > 0:
+            input_validation_messages_to_user_string = "Input validation:"
+
+            for input_validation_message in input_validation_messages_to_user:
+                input_validation_messages_to_user_string += str(
+                    "\n- " + input_validation_message
+                )
+
+            progress_message.add(input_validation_messages_to_user_string)
+
+        # If we're in an error state, then end the processing here
+        if error_state:
+            await progress_message.finish("❌ Terminating request")
+            return
+
+        # Let the user know if this repo has been requested before, and how that went
+        repo_history = await describe_repo_history(sanitized_repo_url, sg_server_api)
+        if repo_history is not None:
+            progress_message.add(repo_history)
+
+        # Check the repo is on the Sourcegraph instance, so we don't spend a scheduler mutation on a repo it can't find
+        # If we can't find out, carry on, and let the mutation tell us
+        if await check_repo_presence(sanitized_repo_url, sg_server_api) is False:
+            await progress_message.finish(
+                "❌ Repo not found on Sourcegraph instance \n"
+                + sg_server
+                + "\nPlease check the repo name, or tag us for support if it should be there."
+            )
+            return
+
+        # If the repo's embeddings are already up to date with its default branch, don't ask the scheduler to rebuild them
+        # unless the user asked for a rebuild, and if we can't find out, carry on and submit
+        if not force_rebuild and await check_embeddings_fresh(sanitized_repo_url, sg_server_api):
+            await progress_message.finish(
+                "✅ Embeddings are already available for \n"
+                + sanitized_repo_url
+                + "\nand up to date with its default branch, on Sourcegraph instance \n"
+                + sg_server
+                + "\nTo rebuild them anyway, run `/embedding` again with `force_rebuild: True`."
+            )
+            return
+
+        # If this repo was just submitted, by this user or someone else, don't schedule it again
+        # unless the user asked for a rebuild, which the earlier submission may not have been
+        if not force_rebuild and await is_recently_submitted(sanitized_repo_url, sg_server_api):
+            await progress_message.finish(
+                "✅ Embeddings for \n"
+                + sanitized_repo_url
+                + "\nwere already requested in the last few minutes, and are queued on Sourcegraph instance \n"
+                + sg_server
+                + "\nI'll tag you in this thread when they're ready."
+            )
+            await track_embedding_job(sanitized_repo_url, ctx.author, thread.id, sg_server, sg_server_api)
+            return
+
+        # Submit the repo, and report the result
+        await submit_and_report_embedding_request(
+            progress_message,
+            sanitized_repo_url,
+            ctx.author,
+            thread.id,
+            sg_server,
+            sg_server_api,
+            force_rebuild,
+        )
+
+    except Exception as exception:
+        logging.exception(exception)
+        if progress_message is not None:
+            await progress_message.finish(
+                "❌ Error occurred: "
+                + str(exception)
+            )
+
+    finally:
+        embedding_requests_in_flight.dec()
+
+
+# Bulk submission settings
+# The most repo_urls accepted in one bulk command
+BULK_MAX_REPO_URLS          = int(os.environ.get("BULK_MAX_REPO_URLS", "500"))
+# How many repo_urls to sanitize at once
+BULK_SANITIZE_WORKERS       = int(os.environ.get("BULK_SANITIZE_WORKERS", "16"))
+# The most attachment bytes to read, a list of 500 repo_urls is well under this
+BULK_MAX_ATTACHMENT_BYTES   = int(os.environ.get("BULK_MAX_ATTACHMENT_BYTES", "262144"))
+# The most repo rows to show in the summary table, to stay under Discord's message length limit
+BULK_SUMMARY_MAX_ROWS       = 20
+
+# Repo urls in a bulk request can be separated by whitespace, newlines or commas
+BULK_REPO_URL_SEPARATOR_REGEX = regex.compile(r"[\s,]+")
+
+# Bulk request row statuses, in the order they're shown in the summary table
+BULK_STATUS_FAILED          = "❌ failed"
+BULK_STATUS_INVALID         = "❌ invalid"
+BULK_STATUS_PENDING         = "⏳ validating"
+BULK_STATUS_SUBMITTING      = "⏳ submitting"
+BULK_STATUS_DUPLICATE       = "➖ duplicate"
+BULK_STATUS_ALREADY_QUEUED  = "✅ already queued"
+BULK_STATUS_FRESH           = "✅ already up to date"
+BULK_STATUS_SUBMITTED       = "✅ submitted"
+BULK_STATUS_ORDER = [
+    BULK_STATUS_FAILED,
+    BULK_STATUS_INVALID,
+    BULK_STATUS_PENDING,
+    BULK_STATUS_SUBMITTING,
+    BULK_STATUS_DUPLICATE,
+    BULK_STATUS_ALREADY_QUEUED,
+    BULK_STATUS_FRESH,
+    BULK_STATUS_SUBMITTED,
+]
+
+
+# Split the text of a bulk request into repo_urls
+def parse_bulk_repo_urls(text):
+    return [repo_url for repo_url in BULK_REPO_URL_SEPARATOR_REGEX.split(text) if repo_url]
+
+
+# The state of a bulk request, one row per repo_url the user gave us
+class BulkEmbeddingRequest:
+
+    def __init__(self, repo_urls):
+        # [repo_url, sanitized_repo_url, status, detail]
+        self.rows = [[repo_url, None, BULK_STATUS_PENDING, ""] for repo_url in repo_urls]
+
+    # A live-updating summary table, with the counts per status, then the rows that need attention first
+    def render_summary(self):
+        status_counts = {}
+        for row in self.rows:
+            status_counts[row[2]] = status_counts.get(row[2], 0) + 1
+
+        summary = " | ".join(
+            f"{status} {status_counts[status]}"
+            for status in BULK_STATUS_ORDER
+            if status in status_counts
+        )
+
+        sorted_rows = sorted(self.rows, key=lambda row: BULK_STATUS_ORDER.index(row[2]))
+        table_lines = []
+        for repo_url, sanitized_repo_url, status, detail in sorted_rows[:BULK_SUMMARY_MAX_ROWS]:
+            table_line = f"{status:<18} {sanitized_repo_url or repo_url}"
+            if detail:
+                table_line += " - " + detail
+            table_lines.append(table_line[:150])
+        if len(sorted_rows) > BULK_SUMMARY_MAX_ROWS:
+            table_lines.append(f"... and {len(sorted_rows) - BULK_SUMMARY_MAX_ROWS} more")
+
+        return (
+            f"{len(self.rows)} repos: {summary}\n"
+            + "```\n"
+            + "\n".join(table_lines)
+            + "\n```"
+        )
+
+
+# Sanitize all of the repo_urls in a bulk request, with at most BULK_SANITIZE_WORKERS at a time
+async def sanitize_bulk_repo_urls(bulk_request, on_progress):
+    work_queue = asyncio.Queue()
+    for row in bulk_request.rows:
+        work_queue.put_nowait(row)
+
+    async def worker():
+        while True:
+            try:
+                row = work_queue.get_nowait()
+            except asyncio.QueueEmpty:
+                return
+
+            try:
+                sanitized_repo_url, input_validation_messages_to_user = await sanitize_repo_url(row[0])
+            except Exception as exception:
+                logging.exception(exception)
+                sanitized_repo_url, input_validation_messages_to_user = None, [str(exception)]
+
+            if sanitized_repo_url is None:
+                row[2] = BULK_STATUS_INVALID
+                row[3] = input_validation_messages_to_user[-1] if input_validation_messages_to_user else ""
+            else:
+                row[1] = sanitized_repo_url
+                row[2] = BULK_STATUS_SUBMITTING
+            on_progress()
+
+    await asyncio.gather(*(worker() for _ in range(max(1, BULK_SANITIZE_WORKERS))))
+
+
+# Define the event handler for the bulk slash_command
+@bot.slash_command(description="Request Cody embeddings for a list of repos")
+@discord.default_permissions(manage_guild=True)
+@discord.option(
+    name="repo_urls",
+    description="Public repos, separated by spaces or commas, in the format: github.com/org/repo",
+    required=False,
+    default=None,
+)
+@discord.option(
+    name="attachment",
+    description="A text file of public repos, one per line",
+    required=False,
+    default=None,
+)
+@discord.option(
+    name="force_rebuild",
+    description="Rebuild the embeddings, even if they're already up to date",
+    required=False,
+    default=False,
+)
+async def embedding_bulk(ctx: discord.ApplicationContext, repo_urls: str = None, attachment: discord.Attachment = None, force_rebuild: bool = False):
+    log_request_id.set(ctx.interaction.id)
+    log_user_id.set(ctx.author.id)
+    embedding_requests_total.inc()
+
+    try:
+        # A bulk request only costs one token, it's for admins with a list of repos, not for spamming
+        allowed, retry_after, rate_limit_scope = await check_rate_limits(ctx.author.id, ctx.guild_id)
+        if not allowed:
+            await discord_api_call(ctx.send_response(
+                content="⏳ Rate limited, " + describe_rate_limit_retry(retry_after),
+                ephemeral=True,
+                delete_after=rate_limit_message_lifetime(retry_after),
+            ))
+            return
+
+        # Collect the repo_urls from the option and the attachment
+        text = repo_urls or ""
+        if attachment is not None:
+            if attachment.size > BULK_MAX_ATTACHMENT_BYTES:
+                await discord_api_call(ctx.send_response(
+                    content=f"❌ The attachment is too large, the limit is {BULK_MAX_ATTACHMENT_BYTES} bytes.",
+                    ephemeral=True,
+                ))
+                return
+            text += "\n" + (await attachment.read()).decode("utf-8", errors="replace")
+
+        parsed_repo_urls = parse_bulk_repo_urls(text)
+        if not parsed_repo_urls:
+            await discord_api_call(ctx.send_response(
+                content="❌ No repo urls found, provide them in `repo_urls`, or as a text file `attachment`.",
+                ephemeral=True,
+            ))
+            return
+
+        if len(parsed_repo_urls) > BULK_MAX_REPO_URLS:
+            await discord_api_call(ctx.send_response(
+                content=f"❌ Too many repo urls, the limit is {BULK_MAX_REPO_URLS} per request.",
+                ephemeral=True,
+            ))
+            return
+
+        # Hand the rest of the work to the worker pool, in the bulk lane, behind single commands
+        try:
+            position = command_work_pool.submit(COMMAND_LANE_BULK, process_bulk_embedding_command, ctx, parsed_repo_urls, force_rebuild)
+        except CommandQueueFull:
+            await discord_api_call(ctx.send_response(
+                content="⏳ Too many embeddings requests are waiting right now, please try again in a few minutes.",
+                ephemeral=True,
+                delete_after=300,
+            ))
+            return
+
+        # Acknowledge the command, to avoid showing an error to the user, "The application did not respond"
+        await discord_api_call(ctx.send_response(
+            content=(
+                f"Received `/embedding_bulk` command for {len(parsed_repo_urls)} repos, creating new thread in this channel."
+                + (f" There are {position} requests ahead of yours." if position else "")
+            ),
+            ephemeral=True,
+            delete_after=3600,
+        ))
+
+    except Exception as exception:
+        logging.exception(exception)
+
+
+# Process a bulk embedding command, on a command worker, after the handler has acknowledged it
+async def process_bulk_embedding_command(ctx, parsed_repo_urls, force_rebuild):
+    thread = None
+    progress_message = None
+    embedding_requests_in_flight.inc()
+
+    try:
+        # Get the Sourcegraph server and GraphQL api endpoints
+        sg_server, sg_server_api = await get_sourcegraph_server_addresses()
+
+        thread = await discord_api_call(ctx.interaction.channel.create_thread(
+            name=f"Bulk embeddings request for {len(parsed_repo_urls)} repos",
+            auto_archive_duration=60,
+            type=discord.ChannelType.public_thread,
+        ))
+
+        bulk_request = BulkEmbeddingRequest(parsed_repo_urls)
+        progress_message = ProgressMessage(thread)
+        progress_message.add(
+            ctx.author.mention
+            + f" requested embeddings for {len(parsed_repo_urls)} repos on Sourcegraph instance \n"
+            + sg_server
+        )
+
+        def update_summary():
+            progress_message.set_status(bulk_request.render_summary())
+
+        update_summary()
+
+        # Validate all of the repo_urls concurrently
+        await sanitize_bulk_repo_urls(bulk_request, update_summary)
+
+        # De-duplicate after normalization, and skip repos that were just submitted, unless the user asked for a rebuild
+        rows_by_sanitized_repo_url = {}
+        for row in bulk_request.rows:
+            if row[2] != BULK_STATUS_SUBMITTING:
+                continue
+            if row[1] in rows_by_sanitized_repo_url:
+                row[2] = BULK_STATUS_DUPLICATE
+            elif not force_rebuild and await is_recently_submitted(row[1], sg_server_api):
+                row[2] = BULK_STATUS_ALREADY_QUEUED
+            else:
+                rows_by_sanitized_repo_url[row[1]] = row
+
+        # Check the repos are on the Sourcegraph instance, these lookups are coalesced into a few GraphQL queries
+        repo_presences = await asyncio.gather(*(
+            check_repo_presence(sanitized_repo_url, sg_server_api)
+            for sanitized_repo_url in rows_by_sanitized_repo_url
+        ))
+        for sanitized_repo_url, present in zip(list(rows_by_sanitized_repo_url), repo_presences):
+            if present is False:
+                row = rows_by_sanitized_repo_url.pop(sanitized_repo_url)
+                row[2] = BULK_STATUS_INVALID
+                row[3] = "Repo not found on Sourcegraph instance"
+
+        # Skip repos whose embeddings are already up to date, unless the user asked for a rebuild
+        if not force_rebuild:
+            embeddings_freshness = await asyncio.gather(*(
+                check_embeddings_fresh(sanitized_repo_url, sg_server_api)
+                for sanitized_repo_url in rows_by_sanitized_repo_url
+            ))
+            for sanitized_repo_url, fresh in zip(list(rows_by_sanitized_repo_url), embeddings_freshness):
+                if fresh:
+                    rows_by_sanitized_repo_url.pop(sanitized_repo_url)[2] = BULK_STATUS_FRESH
+        update_summary()
+
+        # Submit the rest in chunks, each chunk fills one scheduleRepositoriesForEmbedding mutation in the shared batcher
+        # Each chunk waits its turn in the submission queue like a single command, and only a few chunks go at once,
+        # so a big bulk command can't crowd out everyone else, and repos other users are submitting right now are only sent once
+        sanitized_repo_urls = list(rows_by_sanitized_repo_url)
+        chunk_slots = asyncio.Semaphore(BULK_EMBEDDING_MAX_CONCURRENT_CHUNKS)
+        submitted_repo_urls = []
+
+        async def submit_chunk(chunk):
+            async with chunk_slots:
+                try:
+                    async with embedding_submission_queue.slot():
+                        results = await asyncio.gather(*(
+                            submit_embedding_request(sanitized_repo_url, sg_server_api, force=force_rebuild)
+                            for sanitized_repo_url in chunk
+                        ))
+                except AdmissionQueueFull:
+                    results = [(False, "Sourcegraph is too busy right now, please try again in a few minutes")] * len(chunk)
+
+            for sanitized_repo_url, (success, graphql_response_message) in zip(chunk, results):
+                row = rows_by_sanitized_repo_url[sanitized_repo_url]
+                if success:
+                    row[2] = BULK_STATUS_SUBMITTED
+                    submitted_repo_urls.append(sanitized_repo_url)
+                else:
+                    row[2] = BULK_STATUS_FAILED
+                    row[3] = str(graphql_response_message)
+                    await record_failed_submission(sanitized_repo_url, ctx.author, thread.id, sg_server, sg_server_api, row[3])
+            update_summary()
+
+        await asyncio.gather(*(
+            submit_chunk(sanitized_repo_urls[chunk_start:chunk_start + EMBEDDING_SHARED_BATCH_SIZE])
+            for chunk_start in range(0, len(sanitized_repo_urls), EMBEDDING_SHARED_BATCH_SIZE)
+        ))
+
+        # Only start checking on the jobs once they're all submitted, so the poller can't send the thread's summary
+        # while some of its repos are still waiting to be submitted
+        tracked_at = time.time()
+        for sanitized_repo_url in submitted_repo_urls:
+            await track_embedding_job(sanitized_repo_url, ctx.author, thread.id, sg_server, sg_server_api, tracked_at, bulk=True)
+
+        summary = bulk_request.render_summary()
+        if submitted_repo_urls:
+            summary += "\nI'll tag you in this thread once, when all of the embeddings jobs are done."
+        await progress_message.finish(summary)
+
+    except Exception as exception:
+        logging.exception(exception)
+        if progress_message is not None:
+            await progress_message.finish(
+                "❌ Error occurred: "
+                + str(exception)
+            )
+
+    finally:
+        embedding_requests_in_flight.dec()
+
+
+# Provide a healthcheck endpoint for the container / pod
+# The container platform calls it every few seconds, so only log a sample of the calls
+healthcheck_log_limiter = LogRateLimiter(HEALTHCHECK_LOG_INTERVAL_SECONDS)
+
+
+async def healthcheck(request):
+    if logging.getLogger().isEnabledFor(logging.DEBUG):
+        should_log, skipped = healthcheck_log_limiter.allow()
+        if should_log:
+            logging.debug("Healthcheck endpoint called - returned 200 OK response, %d more since the last log", skipped)
+    return web.Response(text="OK")
+
+
+# Provide a Prometheus metrics endpoint
+async def metrics(request):
+    return web.Response(
+        body=render_metrics().encode("utf-8"),
+        headers={"Content-Type": "text/plain; version=0.0.4; charset=utf-8"},
+    )
+
+
+# Whether the bot is connected to the Discord gateway, on every shard this replica runs
+def is_gateway_connected():
+    if not bot.is_ready() or bot.is_closed():
+        return False
+
+    if isinstance(bot, AutoShardedBot):
+        return bool(bot.shards) and not any(shard.is_closed() for shard in bot.shards.values())
+
+    return bot.ws is not None and bot.ws.open
+
+
+# Provide a readiness endpoint for the container / pod
+# Only ready once the bot is connected to the Discord gateway, and the startup warm-up is done,
+# so a new deployment doesn't take over until it can answer commands at full speed
+async def readyz(request):
+    gateway_connected = is_gateway_connected()
+
+    if gateway_connected and warm_up_complete:
+        return web.Response(text="OK")
+
+    return web.Response(
+        status=503,
+        text=(
+            "Not ready: "
+            + ("gateway connected" if gateway_connected else "waiting for the Discord gateway")
+            + ", "
+            + ("warm-up done" if warm_up_complete else "warming up")
+        ),
+    )
+
+
+# The web server's runner, so it can be cleaned up on shutdown
+web_runner = None
+
+
+async def start_web_server():
+    global web_runner
+
+    app = web.Application()
+    app.add_routes([
+        web.get("/healthcheck", healthcheck),
+        web.get("/readyz", readyz),
+        web.get("/metrics", metrics),
+    ])
+    # Only health checks and metrics scrapes come here, don't write an access log line for each of them
+    web_runner = web.AppRunner(app, access_log=None)
+    await web_runner.setup()
+    site = web.TCPSite(web_runner, os.environ.get("HTTP_HOST"), os.environ.get("HTTP_PORT"))
+    await site.start()
+
+
+async def stop_web_server():
+    global web_runner
+
+    if web_runner is not None:
+        await web_runner.cleanup()
+        web_runner = None
+
+
+# Startup warm-up settings
+# How many pooled connections to open to Sourcegraph and to each code host, so the first commands don't pay for TCP and TLS handshakes
+WARM_UP_CONNECTIONS_PER_HOST    = int(os.environ.get("WARM_UP_CONNECTIONS_PER_HOST", "2"))
+# How many of the most recently requested repos to load into the presence and freshness caches
+WARM_UP_RECENT_REPOS            = int(os.environ.get("WARM_UP_RECENT_REPOS", "200"))
+# Report ready after this long, in seconds, even if warm-up isn't done, as it only saves the first commands some time
+WARM_UP_TIMEOUT_SECONDS         = float(os.environ.get("WARM_UP_TIMEOUT_SECONDS", "30"))
+# The most code hosts to open connections to, if the Sourcegraph instance has a lot of them
+WARM_UP_MAX_CODE_HOSTS          = 20
+
+# Set once the startup warm-up is done, for readyz
+warm_up_complete = False
+
+# Keep references to the background tasks started by main(), so they aren't garbage collected, and can be cancelled on shutdown
+background_tasks = set()
+
+
+def start_background_task(coroutine):
+    task = asyncio.get_running_loop().create_task(coroutine)
+    background_tasks.add(task)
+    task.add_done_callback(background_tasks.discard)
+    return task
+
+
+# Open connections to a host in the shared HTTP client's pool, and leave them there for the first commands to reuse
+async def open_pooled_connections(url):
+    session = await create_http_session()
+
+    async def open_connection():
+        async with session.head(url, allow_redirects=False) as response:
+            return response.status
+
+    results = await asyncio.gather(
+        *(open_connection() for _ in range(WARM_UP_CONNECTIONS_PER_HOST)),
+        return_exceptions=True,
+    )
+    for result in results:
+        if isinstance(result, Exception):
+            logging.warning("Warm-up couldn't open a connection to %s: %s", url, result)
+
+
+# Load the presence and freshness of the most recently requested repos, as they're the most likely to be requested again
+async def preload_repo_caches(sg_server_api):
+    recent_repos = await embedding_job_store.load_recent_repos(WARM_UP_RECENT_REPOS)
+    repo_names = [row["repo_name"] for row in recent_repos if row["sg_server_api"] == sg_server_api]
+
+    # These lookups are coalesced into a few GraphQL queries, each repo's lookup fills both caches
+    await asyncio.gather(*(lookup_repo_status(repo_name, sg_server_api) for repo_name in repo_names))
+    logging.info("Warm-up loaded the caches for %d recently requested repos", len(repo_names))
+
+
+# Get everything the first commands need ready, then report ready
+async def warm_up(sg_server, sg_server_api):
+    global warm_up_complete
+
+    start = time.perf_counter()
+    # Only the public code hosts we probe, not the ones from the Sourcegraph instance's config
+    code_host_urls = ["https://" + hostname + "/" for hostname in sorted(code_hostnames_on_dotcom)[:WARM_UP_MAX_CODE_HOSTS]]
+
+    try:
+        await asyncio.wait_for(
+            asyncio.gather(
+                open_pooled_connections(sg_server),
+                *(open_pooled_connections(code_host_url) for code_host_url in code_host_urls),
+                preload_repo_caches(sg_server_api),
+            ),
+            WARM_UP_TIMEOUT_SECONDS,
+        )
+    except Exception as exception:
+        # Warm-up only saves time, don't stay unready because of it
+        logging.warning("Warm-up didn't finish, reporting ready anyway: %s", repr(exception))
+
+    warm_up_complete = True
+    logging.info("Warm-up done in %.2f s", time.perf_counter() - start)
+
+
+# Run the web server, background work, and bot, all on one event loop
+async def main():
+    configure_logging()
+    await create_http_session()
+
+    # Start the web server first, so the healthcheck answers while we start up, and readyz reports our progress
+    await start_web_server()
+
+    try:
+        command_work_pool.start()
+        await embedding_job_store.open()
+        await reload_pending_embedding_jobs()
+        # Runs the embeddings completion poller, if this replica is, or becomes, the leader
+        leader_election.start()
+
+        # Work out the Sourcegraph server addresses once, everything after this reuses them
+        sg_server, sg_server_api = await get_sourcegraph_server_addresses()
+
+        # Load the code hosts configured on the Sourcegraph instance, then keep them up to date in the background
+        # If the first load fails, keep going with the dotcom defaults, the background refresh will try again
+        try:
+            await refresh_code_host_rules(sg_server_api)
+        except Exception as exception:
+            logging.warning("Failed to load code hosts from the Sourcegraph instance, using the defaults: %s", exception)
+        start_background_task(refresh_code_host_rules_periodically(sg_server_api))
+        start_background_task(measure_event_loop_lag())
+        start_background_task(load_repo_name_index(sg_server_api))
+
+        # Warm up while the bot connects to the Discord gateway
+        start_background_task(warm_up(sg_server, sg_server_api))
+
+        await bot.start(DISCORD_TOKEN)
+
+    finally:
+        # Let the commands already acknowledged finish, while the bot can still reply to them
+        await command_work_pool.stop(COMMAND_DRAIN_SECONDS)
+        for task in list(background_tasks):
+            task.cancel()
+        if not bot.is_closed():
+            await bot.close()
+        await leader_election.stop()
+        await embedding_completion_poller.stop()
+        await state_backend.close()
+        await embedding_job_store.close()
+        await close_http_session()
+        await stop_web_server()
+
+
+if __name__ == "__main__":
+    # py-cord binds the bot to the event loop that was current when it was created, so run everything on that loop
+    loop = bot.loop
+    main_task = loop.create_task(main())
+
+    # Shut down cleanly on Ctrl+C, and when the container is stopped
+    for signal_number in (signal.SIGINT, signal.SIGTERM):
+        try:
+            loop.add_signal_handler(signal_number, main_task.cancel)
+        except NotImplementedError:
+            # Not supported on Windows, Ctrl+C still raises KeyboardInterrupt there
+            pass
+
+    try:
+        loop.run_until_complete(main_task)
+    except asyncio.CancelledError:
+        logging.info("Shut down")
+    finally:
+        loop.close()
+        # Write out any log records still queued
+        stop_logging()
@@ -0,0 +1,643 @@
+# End-to-end load test for the embedding command handler
+# Runs the handler against local stand-ins, so it can be run without touching production services:
+# - A local aiohttp server that mimics the Sourcegraph /.api/graphql endpoint, with configurable latency and error injection
+# - A fake code host, that answers the repo existence probes
+# - Fake Discord ApplicationContext / channel / thread objects, with configurable latency
+# - Optionally, a small Redis protocol server, to run the bot with its shared state backend
+# Drives N concurrent /embedding invocations, and reports throughput and p50 / p95 / p99 latency for each stage
+#
+# Usage:
+# python3 loadtest.py --invocations 500 --concurrency 100 --graphql-latency-ms 200 --graphql-error-rate 0.05
+
+from aiohttp                import web
+from urllib.parse           import urlsplit
+import argparse
+import asyncio
+import discordbot
+import itertools
+import json
+import os
+import random
+import re                   as regex
+import tempfile
+import time
+import types
+
+# Optional, runs the bot's Lua scripts for real in the Redis stand-in, instead of their Python equivalents
+try:
+    import lupa.lua51       as lupa
+except ImportError:
+    lupa = None
+
+
+# Aliased fields in the GraphQL queries the bot sends
+REPOSITORY_FIELD_REGEX              = regex.compile(r'(\w+): repository\(name: ("[^"]*")\)')
+REPO_EMBEDDING_JOBS_FIELD_REGEX     = regex.compile(r'(\w+): repoEmbeddingJobs\([^)]*?query: ("[^"]*")')
+
+# Latency samples per stage, in seconds
+stage_latencies = {}
+
+
+def record_latency(stage, seconds):
+    stage_latencies.setdefault(stage, []).append(seconds)
+
+
+# Wrap a coroutine function so each call's latency is recorded under stage
+def timed(stage, function):
+    async def timed_function(*args, **kwargs):
+        start = time.perf_counter()
+        try:
+            return await function(*args, **kwargs)
+        finally:
+            record_latency(stage, time.perf_counter() - start)
+
+    return timed_function
+
+
+def percentile(sorted_samples, fraction):
+    if not sorted_samples:
+        return 0.0
+    index = min(len(sorted_samples) - 1, int(round(fraction * (len(sorted_samples) - 1))))
+    return sorted_samples[index]
+
+
+# Stand-in for the Sourcegraph GraphQL API
+class FakeSourcegraphServer:
+
+    def __init__(self, latency_seconds, error_rate, reject_rate, fresh_rate):
+        self.latency_seconds    = latency_seconds
+        # Fraction of requests that fail with HTTP 500
+        self.error_rate         = error_rate
+        # Fraction of repos the server rejects with "repo not found"
+        self.reject_rate        = reject_rate
+        # Fraction of repos whose embeddings are already up to date
+        self.fresh_rate         = fresh_rate
+        self.requests           = 0
+        self.rejected_repos     = set()
+
+    # Decide which repos are fresh from their names, so every query agrees
+    def is_fresh(self, repo_name):
+        return random.Random(repo_name).random() < self.fresh_rate
+
+    async def handle_graphql(self, request):
+        self.requests += 1
+        body = await request.json()
+        query = body.get("query", "")
+
+        await asyncio.sleep(self.latency_seconds)
+
+        if random.random() < self.error_rate:
+            return web.Response(status=500, text="injected error")
+
+        if "scheduleRepositoriesForEmbedding" in query:
+            # Pull the repo names out of the mutation, and reject the batch if any of them are "not found"
+            repo_names = json.loads(query[query.index("[") : query.index("]") + 1])
+            for repo_name in repo_names:
+                if repo_name not in self.rejected_repos and random.random() < self.reject_rate:
+                    self.rejected_repos.add(repo_name)
+
+            rejected_repo_names = [repo_name for repo_name in repo_names if repo_name in self.rejected_repos]
+            if rejected_repo_names:
+                return web.json_response({
+                    "errors": [{"message": "repo not found: " + rejected_repo_names[0]}],
+                    "data": None,
+                })
+
+            return web.json_response({"data": {"scheduleRepositoriesForEmbedding": {"alwaysNil": None}}})
+
+        # Answer aliased repository(name: ...) lookups, repos that were "not found" by a mutation stay not found
+        data = {}
+        for alias, quoted_repo_name in REPOSITORY_FIELD_REGEX.findall(query):
+            repo_name = json.loads(quoted_repo_name)
+            if repo_name in self.rejected_repos:
+                data[alias] = None
+            else:
+                data[alias] = {
+                    "id":               repo_name,
+                    "embeddingExists":  self.is_fresh(repo_name),
+                    "defaultBranch":    {"target": {"oid": "head"}},
+                }
+        for alias, quoted_repo_name in REPO_EMBEDDING_JOBS_FIELD_REGEX.findall(query):
+            repo_name = json.loads(quoted_repo_name)
+            if self.is_fresh(repo_name):
+                data[alias] = {"nodes": [{"repo": {"name": repo_name}, "revision": {"oid": "head"}, "state": "COMPLETED"}]}
+            else:
+                data[alias] = {"nodes": []}
+
+        return web.json_response({"data": data})
+
+
+# Stand-in for a Redis server, with just the commands the bot's shared state backend sends
+# The bot's Lua scripts are run by their Python equivalents, matched on the script text,
+# or with run_lua, by a Lua 5.1 interpreter like Redis uses, which needs the lupa package
+class FakeRedisServer:
+
+    def __init__(self, run_lua=False, password=None):
+        # key: (expires_at or None, value), values are strings, or dicts for hashes
+        self.values      = {}
+        self.commands    = 0
+        # Connections have to AUTH with this before anything else, if it's set
+        self.password    = password
+        # Set to stop answering, like a hung server, connections are still accepted
+        self.hung        = False
+        self.connections = 0
+        self.lua         = None
+        if run_lua:
+            if lupa is None:
+                raise RuntimeError("Running the Lua scripts needs the lupa package")
+            self.lua = lupa.LuaRuntime()
+        self.scripts     = {
+            discordbot.REDIS_TAKE_TOKENS_SCRIPT:        self.take_tokens,
+            discordbot.REDIS_RENEW_IF_OWNER_SCRIPT:     self.renew_if_owner,
+            discordbot.REDIS_RELEASE_IF_OWNER_SCRIPT:   self.release_if_owner,
+        }
+
+    def lookup(self, key):
+        entry = self.values.get(key)
+        if entry is None:
+            return None
+        expires_at, value = entry
+        if expires_at is not None and expires_at <= time.monotonic():
+            del self.values[key]
+            return None
+        return value
+
+    def store(self, key, value, ttl_ms=None):
+        self.values[key] = (time.monotonic() + ttl_ms / 1000 if ttl_ms is not None else None, value)
+
+    def expire(self, key, ttl_ms):
+        value = self.lookup(key)
+        if value is None:
+            return 0
+        self.store(key, value, ttl_ms)
+        return 1
+
+    def hash_for(self, key):
+        value = self.lookup(key)
+        if value is None:
+            value = {}
+            self.store(key, value)
+        return value
+
+    def take_tokens(self, keys, argv):
+        now = time.time()
+        tokens = []
+        for index, key in enumerate(keys):
+            capacity, refill_per_second = float(argv[index * 2]), float(argv[index * 2 + 1])
+            bucket = self.lookup(key) or {}
+            bucket_tokens = float(bucket.get("tokens", capacity))
+            updated_at = float(bucket.get("updated_at", now))
+            bucket_tokens = min(capacity, bucket_tokens + max(0, now - updated_at) * refill_per_second)
+            if bucket_tokens < 1:
+                if refill_per_second <= 0:
+                    return [0, "blocked", index + 1]
+                return [0, str((1 - bucket_tokens) / refill_per_second), index + 1]
+            tokens.append(bucket_tokens)
+        for index, key in enumerate(keys):
+            capacity, refill_per_second = float(argv[index * 2]), float(argv[index * 2 + 1])
+            self.hash_for(key).update({"tokens": str(tokens[index] - 1), "updated_at": str(now)})
+            if refill_per_second > 0:
+                self.expire(key, capacity / refill_per_second * 1000)
+        return [1, "0", 0]
+
+    def renew_if_owner(self, keys, argv):
+        if self.lookup(keys[0]) == argv[0]:
+            return self.expire(keys[0], int(argv[1]))
+        return 0
+
+    def release_if_owner(self, keys, argv):
+        if self.lookup(keys[0]) == argv[0]:
+            del self.values[keys[0]]
+            return 1
+        return 0
+
+    def execute(self, name, *arguments):
+        self.commands += 1
+        name = name.upper()
+
+        if name in ("PING", "AUTH", "SELECT"):
+            return "+OK"
+        if name == "GET":
+            return self.lookup(arguments[0])
+        if name == "SET":
+            key, value, options = arguments[0], arguments[1], [option.upper() for option in arguments[2:]]
+            if "NX" in options and self.lookup(key) is not None:
+                return None
+            ttl_ms = int(arguments[2 + options.index("PX") + 1]) if "PX" in options else None
+            self.store(key, value, ttl_ms)
+            return "+OK"
+        if name == "DEL":
+            return sum(1 for key in arguments if self.values.pop(key, None) is not None)
+        if name == "PEXPIRE":
+            return self.expire(arguments[0], int(arguments[1]))
+        if name == "HSET":
+            hash_value = self.hash_for(arguments[0])
+            added = 0
+            for field, value in zip(arguments[1::2], arguments[2::2]):
+                added += field not in hash_value
+                hash_value[field] = value
+            return added
+        if name == "HDEL":
+            hash_value = self.lookup(arguments[0]) or {}
+            return sum(1 for field in arguments[1:] if hash_value.pop(field, None) is not None)
+        if name == "HGETALL":
+            hash_value = self.lookup(arguments[0]) or {}
+            return [item for field_and_value in hash_value.items() for item in field_and_value]
+        if name == "HMGET":
+            hash_value = self.lookup(arguments[0]) or {}
+            return [hash_value.get(field) for field in arguments[1:]]
+        if name == "TIME":
+            now = time.time()
+            return [str(int(now)), str(int(now % 1 * 1000000))]
+        if name == "EVAL":
+            script, key_count = arguments[0], int(arguments[1])
+            keys, argv = list(arguments[2:2 + key_count]), list(arguments[2 + key_count:])
+            if self.lua is not None:
+                return self.run_lua_script(script, keys, argv)
+            return self.scripts[script](keys, argv)
+
+        return discordbot.RedisError(f"ERR unknown command '{name}'")
+
+    # Run a script the way Redis does, with KEYS, ARGV, and redis.call, converting the replies both ways
+    def run_lua_script(self, script, keys, argv):
+        lua_globals = self.lua.globals()
+        lua_globals.KEYS = self.lua.table_from(keys)
+        lua_globals.ARGV = self.lua.table_from(argv)
+        lua_globals.redis = self.lua.table_from({"call": self.lua_call})
+        return self.redis_reply(self.lua.execute(script))
+
+    def lua_call(self, name, *arguments):
+        reply = self.execute(str(name), *(str(int(argument)) if isinstance(argument, float) and argument.is_integer() else str(argument) for argument in arguments))
+        if isinstance(reply, discordbot.RedisError):
+            raise reply
+        return self.lua_reply(reply)
+
+    # Redis replies as Lua values: nil becomes false, arrays become tables
+    def lua_reply(self, reply):
+        if reply is None:
+            return False
+        if isinstance(reply, list):
+            return self.lua.table_from([self.lua_reply(item) for item in reply])
+        if isinstance(reply, str) and reply.startswith("+"):
+            return self.lua.table_from({"ok": reply[1:]})
+        return reply
+
+    # Lua values as Redis replies: numbers are truncated to integers, false becomes nil, tables become arrays
+    def redis_reply(self, value):
+        if value is None or value is False:
+            return None
+        if value is True:
+            return 1
+        if isinstance(value, (int, float)):
+            return int(value)
+        if lupa.lua_type(value) == "table":
+            return [self.redis_reply(value[index]) for index in range(1, len(value) + 1)]
+        return str(value)
+
+    def encode(self, reply):
+        if isinstance(reply, discordbot.RedisError):
+            return b"-%s\r\n" % str(reply).encode("utf-8")
+        if reply is None:
+            return b"$-1\r\n"
+        if isinstance(reply, int):
+            return b":%d\r\n" % reply
+        if isinstance(reply, list):
+            return b"*%d\r\n" % len(reply) + b"".join(self.encode(item) for item in reply)
+        if reply.startswith("+"):
+            return reply.encode("utf-8") + b"\r\n"
+        encoded_reply = reply.encode("utf-8")
+        return b"$%d\r\n%s\r\n" % (len(encoded_reply), encoded_reply)
+
+    async def handle_connection(self, reader, writer):
+        self.connections += 1
+        authenticated = self.password is None
+        try:
+            while True:
+                line = await reader.readuntil(b"\r\n")
+                arguments = []
+                for _ in range(int(line[1:-2])):
+                    length = int((await reader.readuntil(b"\r\n"))[1:-2])
+                    arguments.append((await reader.readexactly(length + 2))[:-2].decode("utf-8"))
+
+                if self.hung:
+                    continue
+                if arguments[0].upper() == "AUTH":
+                    authenticated = arguments[-1] == self.password
+                    if not authenticated:
+                        writer.write(self.encode(discordbot.RedisError("WRONGPASS invalid username-password pair")))
+                        continue
+                if not authenticated:
+                    writer.write(self.encode(discordbot.RedisError("NOAUTH Authentication required.")))
+                    continue
+                writer.write(self.encode(self.execute(*arguments)))
+        except (asyncio.IncompleteReadError, ConnectionError):
+            pass
+        finally:
+            writer.close()
+
+
+# Stand-in for github.com / gitlab.com, answering repo existence probes
+class FakeCodeHost:
+
+    def __init__(self, latency_seconds, not_found_rate):
+        self.latency_seconds    = latency_seconds
+        self.not_found_rate     = not_found_rate
+        self.requests           = 0
+
+    async def handle_probe(self, request):
+        self.requests += 1
+        await asyncio.sleep(self.latency_seconds)
+
+        if random.random() < self.not_found_rate:
+            return web.Response(status=404, text="Not Found")
+
+        return web.Response(text="<html>repo</html>")
+
+
+# Wraps the shared HTTP client, and sends requests meant for Sourcegraph or the code hosts to the local stand-ins instead
+class RedirectingSession:
+
+    def __init__(self, session, graphql_url, code_host_url):
+        self.session        = session
+        self.graphql_url    = graphql_url
+        self.code_host_url  = code_host_url
+
+    @property
+    def closed(self):
+        return self.session.closed
+
+    def redirect(self, url):
+        split_url = urlsplit(str(url))
+        if split_url.path.endswith("/.api/graphql"):
+            return self.graphql_url
+        return self.code_host_url + "/" + split_url.hostname + split_url.path
+
+    def request(self, method, url, **kwargs):
+        return self.session.request(method, self.redirect(url), **kwargs)
+
+    def get(self, url, **kwargs):
+        return self.request("GET", url, **kwargs)
+
+    def head(self, url, **kwargs):
+        return self.request("HEAD", url, **kwargs)
+
+    def post(self, url, **kwargs):
+        return self.request("POST", url, **kwargs)
+
+    async def close(self):
+        await self.session.close()
+
+
+# Fake Discord objects, with just enough of the interface for the embedding handler
+class FakeMessage:
+
+    def __init__(self, channel, content):
+        self.channel    = channel
+        self.content    = content
+        self.id         = next(discord_ids)
+
+    async def edit(self, content=None, **kwargs):
+        await self.channel.simulate_api_call("message edit")
+        self.content = content
+
+    async def delete(self, **kwargs):
+        await self.channel.simulate_api_call("message delete")
+
+
+class FakeThread:
+
+    def __init__(self, name, latency_seconds):
+        self.name               = name
+        self.latency_seconds    = latency_seconds
+        self.id                 = next(discord_ids)
+        self.messages           = []
+
+    async def simulate_api_call(self, stage):
+        start = time.perf_counter()
+        await asyncio.sleep(self.latency_seconds)
+        record_latency(stage, time.perf_counter() - start)
+
+    async def send(self, content=None, **kwargs):
+        await self.simulate_api_call("message send")
+        message = FakeMessage(self, content)
+        self.messages.append(message)
+        return message
+
+
+class FakeChannel:
+
+    def __init__(self, latency_seconds):
+        self.latency_seconds    = latency_seconds
+        self.threads            = []
+
+    async def create_thread(self, name, **kwargs):
+        start = time.perf_counter()
+        await asyncio.sleep(self.latency_seconds)
+        thread = FakeThread(name, self.latency_seconds)
+        self.threads.append(thread)
+        record_latency("thread creation", time.perf_counter() - start)
+        return thread
+
+
+class FakeApplicationContext:
+
+    def __init__(self, channel, user_id, guild_id, latency_seconds):
+        self.latency_seconds    = latency_seconds
+        self.author             = types.SimpleNamespace(id=user_id, mention=f"<@{user_id}>", name=f"user{user_id}")
+        self.guild_id           = guild_id
+        self.guild              = types.SimpleNamespace(id=guild_id)
+        self.interaction        = types.SimpleNamespace(channel=channel, id=next(discord_ids))
+        self.channel            = channel
+
+    async def send_response(self, content=None, **kwargs):
+        start = time.perf_counter()
+        await asyncio.sleep(self.latency_seconds)
+        record_latency("acknowledgement", time.perf_counter() - start)
+
+    async def defer(self, **kwargs):
+        await self.send_response()
+
+    async def respond(self, content=None, **kwargs):
+        await self.send_response(content, **kwargs)
+
+
+discord_ids = itertools.count(1000)
+
+
+# Sample how late the event loop wakes up from a short sleep, to catch anything blocking the loop
+async def measure_event_loop_lag(interval_seconds, stop_event):
+    while not stop_event.is_set():
+        start = time.perf_counter()
+        await asyncio.sleep(interval_seconds)
+        record_latency("event loop lag", time.perf_counter() - start - interval_seconds)
+
+
+async def start_stand_in(routes):
+    app = web.Application()
+    app.add_routes(routes)
+    runner = web.AppRunner(app)
+    await runner.setup()
+    site = web.TCPSite(runner, "127.0.0.1", 0)
+    await site.start()
+    port = runner.addresses[0][1]
+    return runner, f"http://127.0.0.1:{port}"
+
+
+def build_repo_urls(invocations, distinct_repos):
+    messy_formats = [
+        "github.com/{org}/{repo}",
+        "https://github.com/{org}/{repo}",
+        "https://www.github.com/{org}/{repo}.git",
+        "https://github.com/{org}/{repo}/blob/main/README.md",
+        "https://gitlab.com/{org}/{repo}/-/tree/main",
+        "<github.com/{org}/{repo}@v1.0.0>",
+    ]
+    repo_urls = []
+    for index in range(invocations):
+        repo_index = index % distinct_repos
+        repo_urls.append(
+            messy_formats[repo_index % len(messy_formats)].format(
+                org=f"org{repo_index % 97}",
+                repo=f"repo{repo_index}",
+            )
+        )
+    random.shuffle(repo_urls)
+    return repo_urls
+
+
+async def run_load_test(arguments):
+    sourcegraph = FakeSourcegraphServer(
+        arguments.graphql_latency_ms / 1000,
+        arguments.graphql_error_rate,
+        arguments.graphql_reject_rate,
+        arguments.graphql_fresh_rate,
+    )
+    code_host = FakeCodeHost(
+        arguments.probe_latency_ms / 1000,
+        arguments.probe_not_found_rate,
+    )
+
+    sourcegraph_runner, sourcegraph_url = await start_stand_in([web.post("/.api/graphql", sourcegraph.handle_graphql)])
+    code_host_runner, code_host_url = await start_stand_in([web.route("*", "/{path:.*}", code_host.handle_probe)])
+
+    redis_server = None
+    if arguments.state_backend == "redis":
+        fake_redis = FakeRedisServer(run_lua=lupa is not None)
+        redis_server = await asyncio.start_server(fake_redis.handle_connection, "127.0.0.1", 0)
+        redis_port = redis_server.sockets[0].getsockname()[1]
+        discordbot.state_backend = discordbot.RedisStateBackend(f"redis://127.0.0.1:{redis_port}/0")
+
+    # Point the bot's shared HTTP client, and job store, at the local stand-ins
+    session = await discordbot.create_http_session()
+    discordbot.http_session = RedirectingSession(session, sourcegraph_url + "/.api/graphql", code_host_url)
+    job_store_directory = tempfile.TemporaryDirectory()
+    discordbot.embedding_job_store = discordbot.EmbeddingJobStore(os.path.join(job_store_directory.name, "loadtest.db"))
+    await discordbot.embedding_job_store.open()
+
+    # Time each stage of the handler, by wrapping the module level functions it calls
+    discordbot.sanitize_repo_url        = timed("sanitize", discordbot.sanitize_repo_url)
+    discordbot.probe_repo_exists        = timed("code host probe", discordbot.probe_repo_exists)
+    discordbot.send_graphql_request     = timed("graphql request", discordbot.send_graphql_request)
+    discordbot.submit_embedding_request = timed("graphql submission", discordbot.submit_embedding_request)
+    discordbot.process_embedding_command = timed("processing", discordbot.process_embedding_command)
+
+    channel = FakeChannel(arguments.discord_latency_ms / 1000)
+    repo_urls = build_repo_urls(arguments.invocations, arguments.distinct_repos)
+    concurrency = asyncio.Semaphore(arguments.concurrency)
+    handler = getattr(discordbot.embedding, "callback", discordbot.embedding)
+
+    async def invoke(index, repo_url):
+        async with concurrency:
+            ctx = FakeApplicationContext(
+                channel,
+                user_id=index % arguments.users,
+                guild_id=index % arguments.guilds,
+                latency_seconds=arguments.discord_latency_ms / 1000,
+            )
+            await timed("handler", handler)(ctx, repo_url)
+
+    stop_event = asyncio.Event()
+    lag_task = asyncio.create_task(measure_event_loop_lag(0.01, stop_event))
+    discordbot.command_work_pool.start()
+
+    # The handlers return once they've acknowledged the command, the run is done when the worker pool has processed them all
+    start = time.perf_counter()
+    await asyncio.gather(*(invoke(index, repo_url) for index, repo_url in enumerate(repo_urls)))
+    await discordbot.command_work_pool.join()
+    elapsed = time.perf_counter() - start
+
+    await discordbot.command_work_pool.stop(0)
+
+    stop_event.set()
+    await lag_task
+
+    await discordbot.embedding_job_store.close()
+    await discordbot.close_http_session()
+    await discordbot.state_backend.close()
+    if redis_server is not None:
+        redis_server.close()
+        await redis_server.wait_closed()
+    await sourcegraph_runner.cleanup()
+    await code_host_runner.cleanup()
+    job_store_directory.cleanup()
+
+    return elapsed, sourcegraph, code_host, channel
+
+
+def report(arguments, elapsed, sourcegraph, code_host, channel):
+    # Rate limited and turned away invocations are answered straight away, so only count the accepted ones towards the throughput
+    rate_limited = sum(discordbot.rate_limited_requests.values.values())
+    accepted = len(stage_latencies.get("processing", ()))
+    turned_away = arguments.invocations - rate_limited - accepted
+    print(
+        f"{arguments.invocations} invocations, {arguments.concurrency} concurrent, in {elapsed:.3f} s: "
+        f"{accepted} accepted, {accepted / elapsed:,.1f} accepted invocations/s"
+    )
+    print(f"Rejected: {rate_limited} rate limited, {turned_away} turned away by a full command queue")
+    print(
+        f"Stand-in requests: {sourcegraph.requests} GraphQL, {code_host.requests} code host probes, "
+        f"{len(channel.threads)} threads, {sum(len(thread.messages) for thread in channel.threads)} messages"
+    )
+    queue_wait = discordbot.command_queue_wait_seconds.series[discordbot.COMMAND_LANE_SINGLE]
+    print(f"Command queue wait: {queue_wait.sum / max(1, queue_wait.count) * 1000:.2f} ms mean, over {queue_wait.count} commands")
+    print(f"{'stage':<20} {'count':>7} {'p50 ms':>9} {'p95 ms':>9} {'p99 ms':>9} {'max ms':>9}")
+
+    for stage, samples in stage_latencies.items():
+        samples = sorted(samples)
+        print(
+            f"{stage:<20} {len(samples):>7} "
+            f"{percentile(samples, 0.50) * 1000:>9.2f} "
+            f"{percentile(samples, 0.95) * 1000:>9.2f} "
+            f"{percentile(samples, 0.99) * 1000:>9.2f} "
+            f"{samples[-1] * 1000:>9.2f}"
+        )
+
+
+def parse_arguments():
+    parser = argparse.ArgumentParser(description="Load test the embedding command handler against local stand-ins")
+    parser.add_argument("--invocations",            type=int,   default=200,    help="Number of /embedding invocations")
+    parser.add_argument("--concurrency",            type=int,   default=50,     help="Invocations in flight at once")
+    parser.add_argument("--distinct-repos",         type=int,   default=100,    help="Number of distinct repos requested")
+    parser.add_argument("--users",                  type=int,   default=50,     help="Number of distinct users")
+    parser.add_argument("--guilds",                 type=int,   default=5,      help="Number of distinct guilds")
+    parser.add_argument("--graphql-latency-ms",     type=float, default=100,    help="Latency of the fake Sourcegraph API")
+    parser.add_argument("--graphql-error-rate",     type=float, default=0.0,    help="Fraction of GraphQL requests that fail with HTTP 500")
+    parser.add_argument("--graphql-reject-rate",    type=float, default=0.0,    help="Fraction of repos the fake Sourcegraph API doesn't find")
+    parser.add_argument("--graphql-fresh-rate",     type=float, default=0.2,    help="Fraction of repos whose embeddings are already up to date")
+    parser.add_argument("--probe-latency-ms",       type=float, default=50,     help="Latency of the fake code host")
+    parser.add_argument("--probe-not-found-rate",   type=float, default=0.0,    help="Fraction of probes that return 404")
+    parser.add_argument("--discord-latency-ms",     type=float, default=30,     help="Latency of each fake Discord API call")
+    parser.add_argument("--state-backend",          default="memory", choices=["memory", "redis"], help="Shared state backend, redis uses a local stand-in")
+    parser.add_argument("--seed",                   type=int,   default=1,      help="Random seed, for repeatable runs")
+    return parser.parse_args()
+
+
+def main():
+    arguments = parse_arguments()
+    random.seed(arguments.seed)
+    elapsed, sourcegraph, code_host, channel = asyncio.run(run_load_test(arguments))
+    report(arguments, elapsed, sourcegraph, code_host, channel)
+
+
+if __name__ == "__main__":
+    main()
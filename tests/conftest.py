@@ -0,0 +1,5 @@
+# Make the bot's modules importable from the tests, without installing anything
+import os
+import sys
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
@@ -0,0 +1,104 @@
+# The command worker pool, and the retry button that submits to it
+
+import asyncio
+import discordbot
+import logging
+import types
+
+
+def test_stop_when_idle_neither_waits_nor_warns(caplog):
+    async def test():
+        pool = discordbot.CommandWorkPool(2, 10, {})
+        pool.start()
+        await pool.stop(0)
+        assert pool.workers == []
+
+    with caplog.at_level(logging.WARNING):
+        asyncio.run(test())
+    assert "unfinished" not in caplog.text
+
+
+def test_stop_warns_about_commands_left_unfinished(caplog):
+    async def test():
+        pool = discordbot.CommandWorkPool(1, 10, {})
+        pool.start()
+        pool.submit(discordbot.COMMAND_LANE_SINGLE, asyncio.sleep, 60)
+        pool.submit(discordbot.COMMAND_LANE_SINGLE, asyncio.sleep, 60)
+        await asyncio.sleep(0)
+        await pool.stop(0.01)
+
+    with caplog.at_level(logging.WARNING):
+        asyncio.run(test())
+    assert "Shutting down with 1 queued and 1 running commands unfinished" in caplog.text
+
+
+# Just enough of a button click for RetrySubmissionView.retry, recording the responses in order
+class FakeInteraction:
+
+    def __init__(self, user, events):
+        self.id         = 1
+        self.user       = user
+        self.guild_id   = 1
+        self.response   = types.SimpleNamespace(defer=lambda: self.record("defer"), send_message=lambda **kwargs: self.record("send_message"))
+        self.followup   = types.SimpleNamespace(send=lambda **kwargs: self.record("followup"))
+        self.events     = events
+
+    # Responses take a round trip to Discord, so record each one once it's done
+    async def record(self, event):
+        await asyncio.sleep(0.01)
+        self.events.append(event)
+
+
+def run_retry(monkeypatch, max_queued):
+    events = []
+
+    async def process_retry(view):
+        events.append("process_retry")
+
+    monkeypatch.setattr(discordbot.RetrySubmissionView, "process_retry", process_retry)
+    monkeypatch.setattr(discordbot, "state_backend", discordbot.InMemoryStateBackend())
+
+    async def test():
+        pool = discordbot.CommandWorkPool(1, max_queued, {})
+        monkeypatch.setattr(discordbot, "command_work_pool", pool)
+        pool.start()
+
+        user = types.SimpleNamespace(id=1, mention="@user")
+        view = discordbot.RetrySubmissionView(None, "github.com/example/repo", user, 1, "sourcegraph.example.com", "api", False)
+        await discordbot.RetrySubmissionView.retry(view, None, FakeInteraction(user, events))
+        await pool.join()
+        await pool.stop(0)
+        return view
+
+    return asyncio.run(test()), events
+
+
+def test_retry_acknowledges_the_click_before_the_retry_runs(monkeypatch):
+    view, events = run_retry(monkeypatch, max_queued=10)
+    assert events == ["defer", "process_retry"]
+    assert view.is_finished()
+
+
+def test_retry_with_a_full_queue_follows_up_and_keeps_the_button(monkeypatch):
+    view, events = run_retry(monkeypatch, max_queued=0)
+    assert events == ["defer", "followup"]
+    assert not view.is_finished()
+
+
+def test_queue_metrics_are_labelled_by_lane():
+    async def test():
+        pool = discordbot.CommandWorkPool(1, 10, {})
+        pool.start()
+        pool.submit(discordbot.COMMAND_LANE_BULK, asyncio.sleep, 0)
+        await pool.join()
+        await pool.stop(0)
+
+    asyncio.run(test())
+    metrics = discordbot.render_metrics()
+
+    # Every lane is exported, with or without commands, under one metric name
+    for lane in discordbot.COMMAND_LANES:
+        assert f'discordbot_command_queue_depth{{lane="{lane}"}} 0' in metrics
+        assert f'discordbot_command_queue_wait_seconds_bucket{{lane="{lane}",le="+Inf"}}' in metrics
+        assert f'discordbot_command_queue_wait_seconds_count{{lane="{lane}"}}' in metrics
+    assert "discordbot_command_queue_bulk_wait_seconds" not in metrics
@@ -0,0 +1,48 @@
+# Every repo_url in the benchmark corpus must normalize to its expected output
+# Plus the cases where the hostname came from the instance's code host config, rather than our list of public code hosts
+
+from benchmark              import load_corpus
+from types                  import MappingProxyType
+import discordbot
+import os
+import pytest
+
+
+CORPUS_PATH = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "benchmark_repo_urls.tsv")
+
+
+@pytest.mark.parametrize("repo_url, expected_repo_url", load_corpus(CORPUS_PATH))
+def test_normalize_repo_url_corpus(repo_url, expected_repo_url):
+    normalized_repo_url, _ = discordbot.normalize_repo_url(repo_url)
+    assert str(normalized_repo_url) == expected_repo_url
+
+
+# Swap in code host rules as if these hostnames were configured on the instance
+@pytest.fixture
+def instance_code_host(monkeypatch):
+    def configure(*hostnames):
+        rules = dict(discordbot.code_host_rules)
+        for hostname in hostnames:
+            rules[hostname] = dict(discordbot.DEFAULT_CODE_HOST_RULE)
+        monkeypatch.setattr(discordbot, "code_host_rules", MappingProxyType(rules))
+    return configure
+
+
+def test_instance_hostname_is_accepted(instance_code_host):
+    instance_code_host("git.example.org")
+    normalized_repo_url, _ = discordbot.normalize_repo_url("https://git.example.org/org/repo.git")
+    assert normalized_repo_url == "git.example.org/org/repo"
+
+
+@pytest.mark.parametrize("hostname", ["10.0.0.5", "192.168.1.20", "localhost"])
+def test_private_instance_hostname_is_rejected(instance_code_host, hostname):
+    instance_code_host(hostname)
+    normalized_repo_url, messages = discordbot.normalize_repo_url("https://" + hostname + "/org/repo")
+    assert normalized_repo_url is None
+    assert any(message.startswith("URL is not valid or public") for message in messages)
+
+
+def test_unconfigured_hostname_is_rejected():
+    normalized_repo_url, messages = discordbot.normalize_repo_url("https://git.example.org/org/repo")
+    assert normalized_repo_url is None
+    assert any(message.startswith("Code host not configured") for message in messages)
@@ -0,0 +1,62 @@
+# The repo_url autocomplete index, and refreshing it from the Sourcegraph instance
+
+import asyncio
+import discordbot
+import pytest
+
+
+@pytest.fixture
+def index(monkeypatch):
+    index = discordbot.RepoNameIndex()
+    monkeypatch.setattr(discordbot, "repo_name_index", index)
+    return index
+
+
+# Serve pages of repo names in place of the Sourcegraph instance, calling during_page(page_number) before each one
+def serve_instance_repos(monkeypatch, pages, during_page=lambda page_number: None):
+    async def post_graphql_query(query, sg_server_api):
+        page_number = 0 if '"' not in query else int(query.split('"')[1])
+        during_page(page_number)
+        await asyncio.sleep(0)
+        return {"data": {"repositories": {
+            "nodes": [{"name": name} for name in pages[page_number]],
+            "pageInfo": {"hasNextPage": page_number + 1 < len(pages), "endCursor": str(page_number + 1)},
+        }}}
+
+    monkeypatch.setattr(discordbot, "post_graphql_query", post_graphql_query)
+
+
+def test_search_by_prefix_and_by_path_without_hostname(index):
+    index.add_many(["github.com/sourcegraph/cody", "github.com/sourcegraph/Sourcegraph", "gitlab.com/gitlab-org/gitlab"])
+
+    assert index.search("github.com/sourcegraph/") == ["github.com/sourcegraph/cody", "github.com/sourcegraph/Sourcegraph"]
+    assert index.search("https://github.com/sourcegraph/s") == ["github.com/sourcegraph/Sourcegraph"]
+    assert index.search("gitlab-org/") == ["gitlab.com/gitlab-org/gitlab"]
+
+
+def test_refresh_drops_repos_deleted_from_the_instance(index, monkeypatch):
+    index.add("github.com/example/submitted", recent=True)
+
+    serve_instance_repos(monkeypatch, [["github.com/example/kept", "github.com/example/deleted"]])
+    asyncio.run(discordbot.load_instance_repo_names("https://sourcegraph.example.com/.api/graphql"))
+    assert "github.com/example/deleted" in index
+
+    serve_instance_repos(monkeypatch, [["github.com/example/kept"]])
+    asyncio.run(discordbot.load_instance_repo_names("https://sourcegraph.example.com/.api/graphql"))
+    assert "github.com/example/deleted" not in index
+    assert index.keys == ["github.com/example/kept", "github.com/example/submitted"]
+
+
+def test_repos_added_while_loading_are_kept_once(index, monkeypatch):
+    pages = [["github.com/example/a", "github.com/example/B"], ["github.com/example/c", "github.com/example/b"]]
+
+    # A repo the instance also has is submitted between the pages
+    def during_page(page_number):
+        if page_number == 1:
+            index.add("github.com/example/c", recent=True)
+
+    serve_instance_repos(monkeypatch, pages, during_page)
+    asyncio.run(discordbot.load_instance_repo_names("https://sourcegraph.example.com/.api/graphql"))
+
+    assert index.keys == ["github.com/example/a", "github.com/example/b", "github.com/example/c"]
+    assert index.search("example/") == ["github.com/example/a", "github.com/example/B", "github.com/example/c"]
@@ -0,0 +1,79 @@
+# Probing code hosts for whether a repo exists, falling back through the strategies
+
+import asyncio
+import discordbot
+import pytest
+import types
+
+
+# Just enough of an aiohttp response for the probe strategies
+class FakeResponse:
+
+    def __init__(self, url, status):
+        self.url        = types.SimpleNamespace(path="/" + url.split("/", 3)[-1])
+        self.status     = status
+        self.headers    = {}
+        self.content    = types.SimpleNamespace(read=self.read)
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *exc_info):
+        pass
+
+    async def read(self, max_bytes=-1):
+        return b""
+
+    def close(self):
+        pass
+
+
+# Rate limits HEAD requests, and answers every other request with status, recording the URLs asked for
+class FakeSession:
+
+    def __init__(self, status):
+        self.status     = status
+        self.urls       = []
+
+    def head(self, url, **kwargs):
+        self.urls.append(url)
+        return FakeResponse(url, 429)
+
+    def get(self, url, **kwargs):
+        self.urls.append(url)
+        return FakeResponse(url, self.status)
+
+
+@pytest.fixture
+def session(monkeypatch):
+    session = FakeSession(404)
+
+    async def create_http_session():
+        return session
+
+    monkeypatch.setattr(discordbot, "create_http_session", create_http_session)
+    monkeypatch.setattr(discordbot.repo_probe_cache, "set", lambda *args, **kwargs: None)
+    return session
+
+
+@pytest.mark.parametrize("hostname", ["github.com", "gitlab.com"])
+def test_api_strategies_pass_on_a_bare_hostname(hostname, session):
+    verdict = asyncio.run(discordbot.request_repo_probe(hostname, "https://"))
+
+    # The API strategy has no repo to ask about, so the git strategy after it answers
+    assert verdict == discordbot.PROBE_NOT_FOUND
+    assert session.urls == ["https://" + hostname, "https://" + hostname + "/info/refs"]
+
+
+def test_github_api_asks_about_the_repo_when_the_web_page_is_rate_limited(session):
+    session.status = 200
+    verdict = asyncio.run(discordbot.request_repo_probe("github.com/sourcegraph/cody", "https://"))
+
+    assert verdict == discordbot.PROBE_EXISTS
+    assert session.urls == ["https://github.com/sourcegraph/cody", "https://api.github.com/repos/sourcegraph/cody"]
+
+
+def test_gitlab_api_takes_the_project_path_as_one_segment(session):
+    asyncio.run(discordbot.request_repo_probe("gitlab.com/gitlab-org/gitlab", "https://"))
+
+    assert session.urls[1] == "https://gitlab.com/api/v4/projects/gitlab-org%2Fgitlab"
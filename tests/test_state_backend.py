@@ -0,0 +1,280 @@
+# The shared state backend, and leader election, against the Redis protocol stand-in from loadtest.py
+# The Lua scripts run for real when lupa is installed, and by their Python equivalents in the stand-in otherwise
+
+from loadtest               import FakeRedisServer
+import asyncio
+import discordbot
+import loadtest
+import pytest
+import time
+
+
+LUA_MODES = [
+    pytest.param(False, id="python"),
+    pytest.param(True, id="lua", marks=pytest.mark.skipif(loadtest.lupa is None, reason="needs lupa to run the Lua scripts")),
+]
+
+
+# Run test_function(backend, fake_redis) against a fresh stand-in, with the bot's state backend pointed at it
+def run_with_redis(test_function, run_lua, monkeypatch, password=None, backend_password=None, **backend_options):
+    async def run():
+        fake_redis = FakeRedisServer(run_lua=run_lua, password=password)
+        server = await asyncio.start_server(fake_redis.handle_connection, "127.0.0.1", 0)
+        port = server.sockets[0].getsockname()[1]
+        credentials = f":{backend_password}@" if backend_password else ""
+        backend = discordbot.RedisStateBackend(f"redis://{credentials}127.0.0.1:{port}/0", **backend_options)
+        monkeypatch.setattr(discordbot, "state_backend", backend)
+        try:
+            await test_function(backend, fake_redis)
+        finally:
+            await backend.close()
+            server.close()
+            await server.wait_closed()
+
+    asyncio.run(run())
+
+
+@pytest.mark.parametrize("run_lua", LUA_MODES)
+def test_get_set_and_hashes(run_lua, monkeypatch):
+    async def test(backend, fake_redis):
+        assert await backend.get("missing") is None
+        await backend.set("key", "value", 60)
+        assert await backend.get("key") == "value"
+        await backend.delete("key")
+        assert await backend.get("key") is None
+
+        await backend.hash_set("jobs", "a", "1")
+        await backend.hash_set("jobs", "b", "2")
+        await backend.hash_delete("jobs", "a")
+        assert await backend.hash_get_all("jobs") == {"b": "2"}
+
+    run_with_redis(test, run_lua, monkeypatch)
+
+
+@pytest.mark.parametrize("run_lua", LUA_MODES)
+def test_lock_is_only_renewed_and_released_by_its_owner(run_lua, monkeypatch):
+    async def test(backend, fake_redis):
+        assert await backend.set_if_absent("lock", "replica-a", 60)
+        assert not await backend.set_if_absent("lock", "replica-b", 60)
+
+        assert await backend.renew_if_owner("lock", "replica-a", 60)
+        assert not await backend.renew_if_owner("lock", "replica-b", 60)
+
+        await backend.release_if_owner("lock", "replica-b")
+        assert await backend.get("lock") == "replica-a"
+        await backend.release_if_owner("lock", "replica-a")
+        assert await backend.get("lock") is None
+
+    run_with_redis(test, run_lua, monkeypatch)
+
+
+@pytest.mark.parametrize("run_lua", LUA_MODES)
+def test_take_tokens_until_empty_then_retry_after(run_lua, monkeypatch):
+    async def test(backend, fake_redis):
+        buckets = [("user", "1", 2, 1 / 60)]
+        assert await backend.take_tokens(buckets) == (True, 0.0, None)
+        assert await backend.take_tokens(buckets) == (True, 0.0, None)
+
+        allowed, retry_after, scope = await backend.take_tokens(buckets)
+        assert not allowed
+        assert scope == "user"
+        assert 0 < retry_after <= 60
+
+    run_with_redis(test, run_lua, monkeypatch)
+
+
+@pytest.mark.parametrize("run_lua", LUA_MODES)
+def test_take_tokens_is_all_or_nothing(run_lua, monkeypatch):
+    async def test(backend, fake_redis):
+        user_bucket = ("user", "1", 5, 1)
+        guild_bucket = ("guild", "1", 1, 1 / 60)
+        assert (await backend.take_tokens([user_bucket, guild_bucket]))[0]
+
+        # The empty guild bucket rejects the request, so the user's bucket isn't charged for it
+        allowed, _, scope = await backend.take_tokens([user_bucket, guild_bucket])
+        assert not allowed
+        assert scope == "guild"
+        user_tokens = (await fake_redis_hash(backend, "rate_limit:user:1"))["tokens"]
+        assert float(user_tokens) == pytest.approx(4, abs=0.1)
+
+    run_with_redis(test, run_lua, monkeypatch)
+
+
+@pytest.mark.parametrize("run_lua", LUA_MODES)
+def test_take_tokens_from_a_bucket_that_never_refills_is_blocked(run_lua, monkeypatch):
+    async def test(backend, fake_redis):
+        buckets = [("user", "1", 1, 0)]
+        assert (await backend.take_tokens(buckets))[0]
+        assert await backend.take_tokens(buckets) == (False, None, "user")
+
+    run_with_redis(test, run_lua, monkeypatch)
+
+
+def test_in_memory_bucket_that_never_refills_is_blocked():
+    async def test():
+        backend = discordbot.InMemoryStateBackend()
+        buckets = [("user", "1", 1, 0)]
+        assert (await backend.take_tokens(buckets))[0]
+        assert await backend.take_tokens(buckets) == (False, None, "user")
+
+    asyncio.run(test())
+
+
+def test_hung_backend_fails_fast_and_rate_limits_fall_back(monkeypatch):
+    monkeypatch.setattr(discordbot, "fallback_rate_limits", discordbot.InMemoryStateBackend())
+
+    async def test(backend, fake_redis):
+        assert await backend.get("key") is None
+        fake_redis.hung = True
+
+        # The first check waits out one timeout, the rest share it, or fail straight away while the backend is down
+        started_at = time.monotonic()
+        results = await asyncio.gather(*[discordbot.check_rate_limits(user_id, None) for user_id in range(20)])
+        assert time.monotonic() - started_at < 0.5
+        assert all(allowed for allowed, _, _ in results)
+
+        started_at = time.monotonic()
+        with pytest.raises(ConnectionError):
+            await backend.get("key")
+        assert time.monotonic() - started_at < 0.05
+
+        # Once the cooldown is over, the backend is tried again, with one shared connection attempt
+        fake_redis.hung = False
+        await asyncio.sleep(0.3)
+        connections = fake_redis.connections
+        await asyncio.gather(*[backend.get("key") for _ in range(20)])
+        assert fake_redis.connections == connections + 1
+
+    run_with_redis(test, False, monkeypatch, timeout_seconds=0.2, retry_seconds=0.3)
+
+
+def test_unreachable_backend_is_tried_once_per_cooldown(monkeypatch):
+    async def test():
+        # Nothing listens on a port we just closed
+        server = await asyncio.start_server(lambda reader, writer: None, "127.0.0.1", 0)
+        port = server.sockets[0].getsockname()[1]
+        server.close()
+        await server.wait_closed()
+
+        backend = discordbot.RedisStateBackend(f"redis://127.0.0.1:{port}/0", timeout_seconds=0.2, retry_seconds=60)
+        attempts = []
+        connect = backend.connect
+
+        async def counting_connect():
+            attempts.append(1)
+            await connect()
+
+        backend.connect = counting_connect
+        results = await asyncio.gather(*[backend.get("key") for _ in range(20)], return_exceptions=True)
+        assert all(isinstance(result, OSError) for result in results)
+        assert len(attempts) == 1
+        await backend.close()
+
+    asyncio.run(test())
+
+
+def test_failed_auth_closes_the_connection(monkeypatch):
+    async def test(backend, fake_redis):
+        with pytest.raises(discordbot.RedisError, match="WRONGPASS"):
+            await backend.get("key")
+        assert backend.writer is None
+
+        # Nothing is left connected without authenticating, to fail later commands with NOAUTH
+        with pytest.raises(ConnectionError):
+            await backend.get("key")
+
+        backend.password = "secret"
+        backend.down_until = 0
+        await backend.set("key", "value", 60)
+        assert await backend.get("key") == "value"
+
+    run_with_redis(test, False, monkeypatch, password="secret", backend_password="wrong")
+
+
+def test_rate_limit_messages():
+    assert discordbot.describe_rate_limit_retry(1.2) == "please retry in 2 s."
+    assert "-1" not in discordbot.describe_rate_limit_retry(None)
+    assert discordbot.rate_limit_message_lifetime(None) == 60
+    assert discordbot.rate_limit_message_lifetime(600.5) == 601
+
+
+async def fake_redis_hash(backend, key):
+    reply = await backend.command("HGETALL", backend.key(key))
+    return dict(zip(reply[0::2], reply[1::2]))
+
+
+# Just enough of the embeddings completion poller for leader election
+class FakePoller:
+
+    def __init__(self):
+        self.running = False
+
+    def start(self):
+        self.running = True
+
+    async def stop(self):
+        self.running = False
+
+    def clear(self):
+        pass
+
+
+async def wait_for(condition, timeout_seconds=2):
+    deadline = asyncio.get_running_loop().time() + timeout_seconds
+    while not condition():
+        if asyncio.get_running_loop().time() > deadline:
+            raise AssertionError("Timed out waiting for the condition")
+        await asyncio.sleep(0.01)
+
+
+@pytest.fixture
+def fast_leader_lock(monkeypatch):
+    monkeypatch.setattr(discordbot, "LEADER_LOCK_TTL_SECONDS", 0.3)
+    monkeypatch.setattr(discordbot, "LEADER_LOCK_RENEW_SECONDS", 0.05)
+
+
+@pytest.mark.parametrize("run_lua", LUA_MODES)
+def test_leader_failover_when_the_leader_stops_renewing(run_lua, monkeypatch, fast_leader_lock):
+    async def test(backend, fake_redis):
+        replica_a = discordbot.LeaderElection(FakePoller(), replica_id="replica-a")
+        replica_b = discordbot.LeaderElection(FakePoller(), replica_id="replica-b")
+
+        replica_a.start()
+        await wait_for(lambda: replica_a.is_leader)
+        replica_b.start()
+        await asyncio.sleep(0.2)
+        assert not replica_b.is_leader
+        assert replica_a.poller.running and not replica_b.poller.running
+
+        # Replica a dies without releasing its lock, replica b takes over once the lock expires
+        replica_a.task.cancel()
+        await wait_for(lambda: replica_b.is_leader)
+        assert replica_b.poller.running
+        assert await backend.get(discordbot.LEADER_LOCK_KEY) == "replica-b"
+
+        await replica_b.stop()
+
+    run_with_redis(test, run_lua, monkeypatch)
+
+
+@pytest.mark.parametrize("run_lua", LUA_MODES)
+def test_leader_hands_over_when_stopped(run_lua, monkeypatch, fast_leader_lock):
+    monkeypatch.setattr(discordbot, "LEADER_LOCK_TTL_SECONDS", 60)
+
+    async def test(backend, fake_redis):
+        replica_a = discordbot.LeaderElection(FakePoller(), replica_id="replica-a")
+        replica_b = discordbot.LeaderElection(FakePoller(), replica_id="replica-b")
+
+        replica_a.start()
+        await wait_for(lambda: replica_a.is_leader)
+        replica_b.start()
+
+        # Stopping releases the lock, so replica b doesn't have to wait out the 60 s lock
+        await replica_a.stop()
+        assert not replica_a.is_leader and not replica_a.poller.running
+        await wait_for(lambda: replica_b.is_leader)
+
+        await replica_b.stop()
+        assert await backend.get(discordbot.LEADER_LOCK_KEY) is None
+
+    run_with_redis(test, run_lua, monkeypatch)